@@ -0,0 +1,244 @@
+import asyncio
+import contextlib
+import math
+import os
+import threading
+import time
+from collections import deque
+
+import deadline
+from deadline import DeadlineExceeded
+from metrics import metrics
+from tracing import span
+
+
+def _provider_setting(name, provider, default):
+    # ADMISSION_CONCURRENCY_OPENAI overrides ADMISSION_CONCURRENCY for one provider
+    return os.getenv(f"{name}_{provider.upper()}", os.getenv(name, default))
+
+
+class AdmissionConfig:
+    ENABLED = os.getenv("ADMISSION_ENABLED", "true").strip().lower() in ("1", "true", "yes", "on")
+    # Status sent when a request cannot be admitted: 503 (overloaded) or 429
+    REJECT_STATUS = int(os.getenv("ADMISSION_REJECT_STATUS", "503"))
+
+    @staticmethod
+    def concurrency(provider):
+        """Upstream calls this process may have in flight to the provider."""
+        return int(_provider_setting("ADMISSION_CONCURRENCY", provider, "32"))
+
+    @staticmethod
+    def queue_size(provider):
+        """Requests that may wait for a free slot; beyond this they are rejected at once."""
+        return int(_provider_setting("ADMISSION_QUEUE_SIZE", provider, "64"))
+
+    @staticmethod
+    def max_wait(provider):
+        """Seconds a request may wait in the queue."""
+        return float(_provider_setting("ADMISSION_MAX_WAIT", provider, "5"))
+
+
+class Saturated(Exception):
+    """A provider had no free slot for a request within its queue limits."""
+
+    def __init__(self, provider, reason, retry_after):
+        super().__init__(f"{provider} is at capacity ({reason}); retry after {math.ceil(retry_after)}s")
+        self.provider = provider
+        self.reason = reason
+        self.retry_after = retry_after
+        self.status_code = AdmissionConfig.REJECT_STATUS
+
+
+def error_headers(error):
+    """Extra response headers for an error: Retry-After when we or the provider asked for a wait."""
+    retry_after = getattr(error, "retry_after", None)
+    if retry_after is None:
+        return {}
+    return {"Retry-After": str(math.ceil(retry_after))}
+
+
+class _Waiter:
+    def __init__(self, notify):
+        self.notify = notify
+        self.granted = False
+
+
+class ProviderLimiter:
+    """Concurrency limit for one provider, with a bounded FIFO queue of waiting requests.
+
+    Shared by request threads and event loops alike: a released slot is handed
+    straight to the oldest waiter, whether it blocks on an Event or awaits a Future.
+    """
+
+    def __init__(self, provider, limit, queue_size, max_wait):
+        self.provider = provider
+        self.limit = limit
+        self.queue_size = queue_size
+        self.max_wait = max_wait
+        self.in_use = 0
+        self._waiters = deque()
+        self._lock = threading.Lock()
+
+    def queued(self):
+        return len(self._waiters)
+
+    def _try_acquire(self):
+        if self.in_use < self.limit and not self._waiters:
+            self.in_use += 1
+            return True
+        return False
+
+    def _reject(self, reason):
+        metrics.inc("provider_admission_rejections_total", {"provider": self.provider, "reason": reason})
+        # A full queue drains in about the time its requests may wait
+        return Saturated(self.provider, reason, max(1.0, self.max_wait))
+
+    def _timed_out(self):
+        # A wait cut short by the request's own deadline is not the provider's saturation
+        if deadline.expired():
+            return DeadlineExceeded()
+        return self._reject("timeout")
+
+    def _enqueue(self, notify):
+        """Return None if a slot was taken at once, else the queued waiter; raises when the queue is full."""
+        with self._lock:
+            if self._try_acquire():
+                return None
+            if len(self._waiters) >= self.queue_size:
+                raise self._reject("queue_full")
+            waiter = _Waiter(notify)
+            self._waiters.append(waiter)
+            return waiter
+
+    def _abandon(self, waiter):
+        """Leave the queue; True if a slot was handed over meanwhile and is now ours."""
+        with self._lock:
+            if waiter.granted:
+                return True
+            self._waiters.remove(waiter)
+            return False
+
+    def _observe_wait(self, started):
+        metrics.observe("provider_admission_wait_seconds", {"provider": self.provider}, time.monotonic() - started)
+
+    def acquire(self, wait=True):
+        """Take a slot, queueing for up to max_wait seconds (or until the request's deadline).
+
+        Raises Saturated if no slot is free in time.
+        """
+        if not wait:
+            with self._lock:
+                if not self._try_acquire():
+                    raise self._reject("spilled")
+            return
+        started = time.monotonic()
+        max_wait = deadline.clamp(self.max_wait)
+        event = threading.Event()
+        waiter = self._enqueue(event.set)
+        if waiter is not None:
+            with span("queue", provider=self.provider):
+                if not event.wait(max_wait) and not self._abandon(waiter):
+                    self._observe_wait(started)
+                    raise self._timed_out()
+        self._observe_wait(started)
+
+    async def aacquire(self, wait=True):
+        """Async counterpart of acquire()."""
+        if not wait:
+            self.acquire(wait=False)
+            return
+        started = time.monotonic()
+        max_wait = deadline.clamp(self.max_wait)
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def notify():
+            loop.call_soon_threadsafe(lambda: future.done() or future.set_result(None))
+
+        waiter = self._enqueue(notify)
+        if waiter is not None:
+            with span("queue", provider=self.provider):
+                try:
+                    await asyncio.wait_for(future, max_wait)
+                except asyncio.TimeoutError:
+                    if not self._abandon(waiter):
+                        self._observe_wait(started)
+                        raise self._timed_out()
+                except BaseException:
+                    # Cancelled while queued: give back a slot that was already handed over
+                    if self._abandon(waiter):
+                        self.release()
+                    raise
+        self._observe_wait(started)
+
+    def release(self):
+        with self._lock:
+            if self._waiters:
+                # The slot passes to the oldest waiter, so in_use is unchanged
+                waiter = self._waiters.popleft()
+                waiter.granted = True
+                waiter.notify()
+            else:
+                self.in_use -= 1
+
+    @contextlib.contextmanager
+    def slot(self, wait=True):
+        self.acquire(wait)
+        try:
+            yield
+        finally:
+            self.release()
+
+    @contextlib.asynccontextmanager
+    async def aslot(self, wait=True):
+        await self.aacquire(wait)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def snapshot(self):
+        return {
+            "limit": self.limit,
+            "in_use": self.in_use,
+            "queued": self.queued(),
+            "queue_size": self.queue_size,
+            "max_wait": self.max_wait,
+        }
+
+
+class Admission:
+    """Per-provider limiters; a disabled controller admits everything."""
+
+    def __init__(self, providers, config=AdmissionConfig):
+        self.enabled = config.ENABLED
+        self.limiters = {
+            provider: ProviderLimiter(provider, config.concurrency(provider), config.queue_size(provider),
+                                      config.max_wait(provider))
+            for provider in providers
+        }
+
+    def slot(self, provider, wait=True):
+        if not self.enabled:
+            return contextlib.nullcontext()
+        return self.limiters[provider].slot(wait)
+
+    def aslot(self, provider, wait=True):
+        if not self.enabled:
+            return contextlib.nullcontext()
+        return self.limiters[provider].aslot(wait)
+
+    def snapshot(self):
+        return {provider: limiter.snapshot() for provider, limiter in self.limiters.items()}
+
+
+admission = Admission(("anthropic", "openai", "deepseek"))
+
+metrics.register_collector(
+    "provider_admission_queue_depth", "gauge", "Requests waiting for a provider concurrency slot",
+    lambda: [({"provider": provider}, limiter.queued()) for provider, limiter in admission.limiters.items()]
+)
+metrics.register_collector(
+    "provider_admission_slots_in_use", "gauge", "Provider concurrency slots taken",
+    lambda: [({"provider": provider}, limiter.in_use) for provider, limiter in admission.limiters.items()]
+)
@@ -0,0 +1,459 @@
+import time
+
+# Timed so the /ready report shows how long importing the app took
+_import_started = time.perf_counter()
+
+from quart import Quart, Response, g, jsonify, request
+from quart_cors import cors
+from dotenv import load_dotenv
+import asyncio
+import json
+import logging
+
+# Python/httpx compatibility patches shared with the Flask app
+import compat  # noqa: F401
+
+# Load environment variables
+load_dotenv()
+
+# JSON log lines, written by a background thread so requests never wait on log I/O
+import logs
+logs.configure()
+logger = logging.getLogger(__name__)
+
+import providers
+from clients import aclose_async_clients
+from providers import (
+    astream_chain,
+    chat_error,
+    code_error,
+    strip_code_fences,
+)
+import deadline
+from admission import Saturated, admission, error_headers
+from batch import batch_limits, parse_batch, run_batch, run_item
+from cache import response_cache
+from health import CLOSED, OPEN, breakers
+from metrics import CONTENT_TYPE, metrics
+from routing import router
+from security.rate_limit import RATE_LIMITED_BODY, client_identity, rate_limiter
+from catalog import UnknownModel, not_modified
+from deadline import DeadlineExceeded, InvalidTimeout
+from idempotency import IdempotencyError
+from jobs import JobNotFound, JobQueueFull, job_headers, job_pool, parse_job, parse_wait, view
+from dispatch import agenerate, arequest, coalescing_stats
+from sessions import SessionNotFound, session_store
+from shared_store import store_stats
+from similarity import similar_cache
+from singleflight import InvalidFlag
+from streaming import SSE_HEADERS, StreamCleaner, error_event, sse_event
+from tracing import MemoryExporter, tracer
+from warmup import warmup
+
+warmup.record("import app", time.perf_counter() - _import_started)
+
+# Async serving mode: the same routes as app.py, but provider calls run on the
+# event loop so a worker is never blocked waiting on an upstream response
+app = Quart(__name__)
+
+# Configure CORS
+# Server-Timing and X-Request-ID are exposed so the frontend can read them
+app = cors(app, allow_origin="http://localhost:5173", expose_headers=["Server-Timing", "X-Request-ID"])
+
+
+@app.before_serving
+async def start_warmup():
+    # Connections are opened on the serving loop; /ready reports when they are
+    app.add_background_task(warmup.arun)
+
+
+@app.after_serving
+async def close_clients():
+    await aclose_async_clients()
+
+
+def _route():
+    # The matched rule rather than the raw path keeps label cardinality bounded
+    return request.url_rule.rule if request.url_rule is not None else "unmatched"
+
+
+@app.before_request
+async def assign_request_id():
+    # Tags the request's log records; a client's own X-Request-ID is kept so logs can be joined up
+    g.request_id = logs.begin_request(request.headers)
+
+
+@app.after_request
+async def add_request_id(response):
+    if "request_id" in g:
+        response.headers[logs.LogConfig.REQUEST_ID_HEADER] = g.request_id
+    return response
+
+
+@app.before_request
+async def start_trace():
+    # Provider calls made for this request record their timings as spans of this trace
+    g.trace = tracer.begin(g.request_id, f"{request.method} {_route()}")
+
+
+@app.after_request
+async def finish_trace(response):
+    trace = g.get("trace")
+    server_timing = tracer.server_timing(trace)
+    if server_timing:
+        response.headers["Server-Timing"] = server_timing
+    if trace is not None and not trace.streaming:
+        tracer.end(trace)
+    return response
+
+
+@app.before_request
+async def start_request_metrics():
+    g.metrics_started = time.monotonic()
+    g.metrics_in_flight = True
+    metrics.inc("http_requests_in_flight", {"route": _route()})
+
+
+@app.after_request
+async def record_request_metrics(response):
+    route = _route()
+    metrics.inc("http_requests_total", {"route": route, "method": request.method, "status": response.status_code})
+    metrics.observe("http_request_duration_seconds", {"route": route}, time.monotonic() - g.metrics_started)
+    return response
+
+
+@app.teardown_request
+async def finish_request_metrics(error=None):
+    # Streamed responses tear the request context down more than once
+    if g.pop("metrics_in_flight", False):
+        metrics.inc("http_requests_in_flight", {"route": _route()}, -1)
+
+
+@app.before_request
+async def enforce_rate_limit():
+    client_ip, api_key = client_identity(request.headers, request.remote_addr)
+    allowed, headers = await rate_limiter.acheck(request.method, request.path, client_ip, api_key)
+    if not allowed:
+        return jsonify(RATE_LIMITED_BODY), 429, headers
+
+
+@app.route('/', methods=['GET'])
+async def read_root():
+    return jsonify({"message": "API is running"})
+
+
+@app.route('/ready', methods=['GET'])
+async def ready():
+    return jsonify(warmup.report()), 200 if warmup.ready() else 503
+
+
+def _models_response(name, build):
+    # The frontend polls these, so an unchanged listing is answered with a bare 304
+    body, etag = providers.models_view(name, build)
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if not_modified(request.headers.get('If-None-Match'), etag):
+        return Response("", status=304, headers=headers)
+    return Response(body, content_type="application/json", headers=headers)
+
+
+@app.route('/models', methods=['GET'])
+async def get_models():
+    return _models_response("models", lambda models: {"models": models})
+
+
+@app.route('/verify-key', methods=['GET'])
+async def verify_key():
+    return _models_response("verify-key", lambda models: {
+        "status": "OK", "available_models": [model["id"] for model in models]
+    })
+
+
+@app.route('/toggle-claude', methods=['POST'])
+async def toggle_claude():
+    status = "DOWN" if providers.toggle_simulated_down("anthropic") else "UP"
+    return jsonify({"status": f"Claude simulation is now {status}"})
+
+
+@app.route('/toggle-deepseek', methods=['POST'])
+async def toggle_deepseek():
+    status = "DOWN" if providers.toggle_simulated_down("deepseek") else "UP"
+    return jsonify({"status": f"DeepSeek simulation is now {status}"})
+
+
+@app.route('/health/providers', methods=['GET'])
+async def provider_health():
+    return jsonify({provider: breaker.snapshot() for provider, breaker in breakers.items()})
+
+
+@app.route('/health/providers/<provider>', methods=['POST'])
+async def override_provider_health(provider):
+    # Manually pin a provider's circuit: "open", "closed", or "auto" to clear the override
+    if provider not in breakers:
+        return jsonify({"error": f"Unknown provider: {provider}"}), 404
+    data = await request.get_json(silent=True) or {}
+    state = data.get('state', 'auto')
+    if state not in (OPEN, CLOSED, 'auto'):
+        return jsonify({"error": "state must be one of: open, closed, auto"}), 400
+    breakers[provider].force(None if state == 'auto' else state)
+    return jsonify({provider: breakers[provider].snapshot()})
+
+
+@app.route('/admin/routing', methods=['GET'])
+async def routing_status():
+    candidates = [provider for provider in providers.AUTO_CHAIN if providers.provider_available(provider)]
+    return jsonify(router.snapshot(candidates))
+
+
+@app.route('/admin/admission', methods=['GET'])
+async def admission_status():
+    return jsonify(admission.snapshot())
+
+
+@app.route('/admin/models', methods=['GET'])
+async def catalog_status():
+    return jsonify(providers.catalog.snapshot())
+
+
+@app.route('/admin/traces', methods=['GET'])
+async def recent_traces():
+    exporter = tracer.exporter(MemoryExporter)
+    if exporter is None:
+        return jsonify({"error": "The memory trace exporter is not enabled"}), 404
+    return jsonify({"traces": exporter.recent(request.args.get('limit', 20, type=int))})
+
+
+@app.route('/admin/traces/<trace_id>', methods=['GET'])
+async def get_trace(trace_id):
+    exporter = tracer.exporter(MemoryExporter)
+    trace = exporter.find(trace_id) if exporter is not None else None
+    if trace is None:
+        return jsonify({"error": f"Unknown or expired trace: {trace_id}"}), 404
+    return jsonify(trace)
+
+
+@app.route('/metrics', methods=['GET'])
+async def get_metrics():
+    return Response(metrics.render(), content_type=CONTENT_TYPE)
+
+
+@app.route('/cache/stats', methods=['GET'])
+async def cache_stats():
+    store = await asyncio.to_thread(store_stats)
+    return jsonify(dict(response_cache.stats(), coalescing=coalescing_stats(), similar=similar_cache.stats(), store=store))
+
+
+@app.route('/code-generate', methods=['POST'])
+async def code_generate():
+    try:
+        data = await request.get_json()
+        if not isinstance(data, dict) or 'prompt' not in data:
+            return jsonify({"error": "Missing prompt in request"}), 400
+
+        completion = await agenerate(await arequest("code", data, request.headers))
+        if completion is None:
+            return jsonify({
+                "code": "# No model available to generate code",
+                "model": "mock"
+            }), 503
+
+        return jsonify({
+            "code": strip_code_fences(completion.text),
+            "model": completion.model,
+            "provider": completion.provider,
+            **completion.meta
+        })
+
+    except (IdempotencyError, InvalidFlag, InvalidTimeout, UnknownModel) as e:
+        return jsonify({"error": str(e)}), e.status_code
+    except (Saturated, DeadlineExceeded) as e:
+        # Expected under load, so not logged with a traceback
+        body, status_code = code_error(e)
+        return jsonify(body), status_code, error_headers(e)
+    except Exception as e:
+        logger.exception("Error in code generation endpoint: %s", e)
+        body, status_code = code_error(e)
+        return jsonify(body), status_code, error_headers(e)
+
+
+@app.route('/chat', methods=['POST'])
+async def chat():
+    try:
+        data = await request.get_json()
+        if not isinstance(data, dict) or 'content' not in data:
+            return jsonify({"error": "Missing content in request"}), 400
+
+        completion = await agenerate(await arequest("chat", data, request.headers))
+        if completion is None:
+            return jsonify({
+                "response": "The requested AI model is not available.",
+                "model": "mock"
+            }), 503
+
+        return jsonify({
+            "response": completion.text,
+            "model": completion.model,
+            "provider": completion.provider,
+            **completion.meta
+        })
+
+    except SessionNotFound as e:
+        return jsonify({"error": str(e)}), 404
+    except (IdempotencyError, InvalidFlag, InvalidTimeout, UnknownModel) as e:
+        return jsonify({"error": str(e)}), e.status_code
+    except (Saturated, DeadlineExceeded) as e:
+        # Expected under load, so not logged with a traceback
+        body, status_code = chat_error(e)
+        return jsonify(body), status_code, error_headers(e)
+    except Exception as e:
+        logger.exception("Error in chat endpoint: %s", e)
+        body, status_code = chat_error(e)
+        return jsonify(body), status_code, error_headers(e)
+
+
+@app.route('/sessions/<session_id>', methods=['GET'])
+async def get_session(session_id):
+    try:
+        return jsonify((await session_store.aget(session_id)).snapshot())
+    except SessionNotFound as e:
+        return jsonify({"error": str(e)}), 404
+
+
+@app.route('/sessions/<session_id>', methods=['DELETE'])
+async def delete_session(session_id):
+    if not await session_store.adelete(session_id):
+        return jsonify({"error": f"Unknown or expired session: {session_id}"}), 404
+    return jsonify({"deleted": session_id})
+
+
+@app.route('/jobs', methods=['POST'])
+async def submit_job():
+    task, data, error = parse_job(await request.get_json())
+    if error:
+        return jsonify({"error": error}), 400
+    try:
+        # Writes the job to the shared store, so it runs on a worker thread
+        job = await asyncio.to_thread(job_pool.submit, task, data)
+    except (InvalidFlag, InvalidTimeout, UnknownModel) as e:
+        return jsonify({"error": str(e)}), e.status_code
+    except JobQueueFull as e:
+        return jsonify({"error": str(e)}), e.status_code, error_headers(e)
+    return jsonify(view(job)), 202, {"Location": f"/jobs/{job['id']}"}
+
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+async def get_job(job_id):
+    # ?wait=<seconds> holds the request open until the job finishes (a long-poll)
+    try:
+        job = await job_pool.aget(job_id, parse_wait(request.args.get('wait')))
+    except JobNotFound as e:
+        return jsonify({"error": str(e)}), 404
+    return jsonify(view(job)), 200, job_headers(job)
+
+
+@app.route('/code-generate/batch', methods=['POST'])
+async def code_generate_batch():
+    data = await request.get_json()
+    items, error = parse_batch(data)
+    if error:
+        return jsonify({"error": error}), 400
+    # One token per item, taken before any item is dispatched
+    client_ip, api_key = client_identity(request.headers, request.remote_addr)
+    allowed, headers = await rate_limiter.acheck(request.method, request.path, client_ip, api_key, cost=len(items))
+    if not allowed:
+        return jsonify(RATE_LIMITED_BODY), 429, headers
+
+    if not data.get('stream'):
+        return jsonify({"results": await run_batch(items)})
+
+    limits = batch_limits()
+    tasks = [asyncio.ensure_future(run_item(index, item, limits)) for index, item in enumerate(items)]
+
+    async def results():
+        try:
+            for next_result in asyncio.as_completed(tasks):
+                yield json.dumps(await next_result) + "\n"
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    response = Response(tracer.astreamed(g.trace, results()), mimetype="application/x-ndjson")
+    response.timeout = None
+    return response
+
+
+async def _event_stream(generation, strip_fences, error_body):
+    task = generation.task
+    cleaner = StreamCleaner(strip_fences=strip_fences)
+    # Attempts, retries and fallbacks have to start within the request's deadline
+    with deadline.scope(generation.deadline):
+        try:
+            async for event, value in astream_chain(generation.chain, task, generation.messages):
+                if event == "token":
+                    text = cleaner.feed(value)
+                    if text:
+                        yield sse_event("token", {"text": text})
+                else:
+                    text = cleaner.finish()
+                    if text:
+                        yield sse_event("token", {"text": text})
+                    await generation.aremember(value)
+                    yield sse_event("done", {
+                        "model": value.model,
+                        "provider": value.provider,
+                        "usage": value.usage,
+                        **value.meta
+                    })
+        except (Saturated, DeadlineExceeded) as e:
+            # Expected under load, so not logged with a traceback
+            logger.warning("Error in %s stream: %s", task, e)
+            yield error_event(e, error_body)
+        except Exception as e:
+            logger.exception("Error in %s stream: %s", task, e)
+            yield error_event(e, error_body)
+
+
+def _sse_response(events):
+    response = Response(tracer.astreamed(g.trace, events), mimetype="text/event-stream", headers=SSE_HEADERS)
+    # Long generations must not be cut off by Quart's default response timeout
+    response.timeout = None
+    return response
+
+
+@app.route('/code-generate/stream', methods=['POST'])
+async def code_generate_stream():
+    data = await request.get_json()
+    if not isinstance(data, dict) or 'prompt' not in data:
+        return jsonify({"error": "Missing prompt in request"}), 400
+
+    try:
+        generation = await arequest("code", data, request.headers)
+    except (InvalidFlag, InvalidTimeout, UnknownModel) as e:
+        return jsonify({"error": str(e)}), e.status_code
+    if not generation.chain:
+        return jsonify({
+            "code": "# No model available to generate code",
+            "model": "mock"
+        }), 503
+
+    return _sse_response(_event_stream(generation, True, code_error))
+
+
+@app.route('/chat/stream', methods=['POST'])
+async def chat_stream():
+    data = await request.get_json()
+    if not isinstance(data, dict) or 'content' not in data:
+        return jsonify({"error": "Missing content in request"}), 400
+
+    try:
+        generation = await arequest("chat", data, request.headers)
+    except SessionNotFound as e:
+        return jsonify({"error": str(e)}), 404
+    except (InvalidFlag, InvalidTimeout, UnknownModel) as e:
+        return jsonify({"error": str(e)}), e.status_code
+    if not generation.chain:
+        return jsonify({
+            "response": "The requested AI model is not available.",
+            "model": "mock"
+        }), 503
+
+    return _sse_response(_event_stream(generation, False, chat_error))
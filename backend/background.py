@@ -0,0 +1,69 @@
+import asyncio
+import atexit
+import logging
+import os
+import threading
+
+from clients import aclose_async_clients
+
+logger = logging.getLogger(__name__)
+
+
+class BackgroundLoop:
+    """An event loop on a daemon thread, so sync handlers can run and cancel async work."""
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever, name="background-loop", daemon=True)
+        self._thread.start()
+
+    def submit(self, coro):
+        """Schedule a coroutine and return a concurrent.futures.Future for its result."""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run(self, coro, timeout=None):
+        future = self.submit(coro)
+        try:
+            return future.result(timeout)
+        except BaseException:
+            future.cancel()
+            raise
+
+    def stop(self):
+        try:
+            asyncio.run_coroutine_threadsafe(aclose_async_clients(), self.loop).result(5)
+        except Exception as e:
+            logger.warning("Could not close async clients: %s", e)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join(5)
+
+
+_loop = None
+_loop_pid = None
+_loop_lock = threading.Lock()
+
+
+def get_background_loop():
+    global _loop, _loop_pid
+    pid = os.getpid()
+    if _loop is not None and _loop_pid == pid:
+        return _loop
+    with _loop_lock:
+        # Threads do not survive a fork, so each worker starts its own loop
+        if _loop is None or _loop_pid != pid:
+            _loop = BackgroundLoop()
+            _loop_pid = pid
+        return _loop
+
+
+def run_async(coro, timeout=None):
+    """Run a coroutine on this worker's background loop and wait for its result."""
+    return get_background_loop().run(coro, timeout)
+
+
+def _stop_loop():
+    if _loop is not None and _loop_pid == os.getpid():
+        _loop.stop()
+
+
+atexit.register(_stop_loop)
@@ -0,0 +1,83 @@
+import asyncio
+import logging
+import math
+import os
+
+from admission import Saturated
+from catalog import UnknownModel
+from deadline import DeadlineExceeded, InvalidTimeout
+from dispatch import GenerationRequest, agenerate
+from providers import PROVIDER_MODELS, code_error, strip_code_fences
+from singleflight import InvalidFlag
+
+logger = logging.getLogger(__name__)
+
+
+class BatchConfig:
+    MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "100"))
+    # Upstream calls a single batch may have in flight per provider
+    PROVIDER_CONCURRENCY = int(os.getenv("BATCH_PROVIDER_CONCURRENCY", "8"))
+
+
+# Batch-level fields that apply to every item unless the item sets its own
+ITEM_DEFAULTS = ("model", "language", "cache", "hedge", "hedge_delay", "timeout", "candidates")
+
+
+def parse_batch(data):
+    """Return (items, error) for a /code-generate/batch body."""
+    if not isinstance(data, dict) or not isinstance(data.get('items'), list) or not data['items']:
+        return None, "Missing items in request"
+    if len(data['items']) > BatchConfig.MAX_ITEMS:
+        return None, f"A batch can hold at most {BatchConfig.MAX_ITEMS} items"
+    defaults = {key: data[key] for key in ITEM_DEFAULTS if key in data}
+    items = []
+    for item in data['items']:
+        items.append(dict(defaults, **item) if isinstance(item, dict) else item)
+    return items, None
+
+
+def batch_limits():
+    return {provider: asyncio.Semaphore(BatchConfig.PROVIDER_CONCURRENCY) for provider in PROVIDER_MODELS}
+
+
+async def run_item(index, item, limits):
+    """Generate one batch item; failures are reported in the item instead of raised."""
+    if not isinstance(item, dict) or 'prompt' not in item:
+        return {"index": index, "status": 400, "error": "Missing prompt in request"}
+    try:
+        request = GenerationRequest("code", item, {})
+        request.limits = limits
+        completion = await agenerate(request)
+        if completion is None:
+            return {
+                "index": index,
+                "status": 503,
+                "code": "# No model available to generate code",
+                "model": "mock"
+            }
+        return {
+            "index": index,
+            "status": 200,
+            "code": strip_code_fences(completion.text),
+            "model": completion.model,
+            "provider": completion.provider,
+            **completion.meta
+        }
+    except Saturated as e:
+        body, status_code = code_error(e)
+        return dict(body, index=index, status=status_code, retry_after=math.ceil(e.retry_after))
+    except DeadlineExceeded as e:
+        body, status_code = code_error(e)
+        return dict(body, index=index, status=status_code)
+    except (InvalidFlag, InvalidTimeout, UnknownModel) as e:
+        return {"index": index, "status": e.status_code, "error": str(e)}
+    except Exception as e:
+        logger.exception("Error in batch item %d: %s", index, e)
+        body, status_code = code_error(e)
+        return dict(body, index=index, status=status_code)
+
+
+async def run_batch(items):
+    """Run every item concurrently and return the results in request order."""
+    limits = batch_limits()
+    return await asyncio.gather(*(run_item(index, item, limits) for index, item in enumerate(items)))
@@ -0,0 +1,409 @@
+"""Load-test the backend against local mock providers.
+
+Starts the mock providers, starts the backend (Flask or ASGI) pointed at them,
+then drives /chat and /code-generate at each concurrency level and reports
+req/s, latency percentiles and the server's socket and memory usage. With
+--stream it drives the /stream endpoints instead and also reports the time to
+the first token. Results are written as JSON so runs from different commits
+can be compared:
+
+    python benchmarks/loadtest.py run --mode async --concurrency 1,8,32,128
+    python benchmarks/loadtest.py run --mode async --stream
+    python benchmarks/loadtest.py compare results/before.json results/after.json
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import math
+import os
+import platform
+import socket
+import subprocess
+import sys
+import time
+
+import httpx
+
+from mock_providers import PROVIDERS, add_profile_arguments, profiles_from_args
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+BACKEND_DIR = os.path.dirname(BENCHMARKS_DIR)
+RESULTS_DIR = os.path.join(BENCHMARKS_DIR, "results")
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _git(*args):
+    try:
+        return subprocess.run(
+            ["git", *args], cwd=BACKEND_DIR, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _server_command(mode, port):
+    if mode == "async":
+        return [sys.executable, "-m", "uvicorn", "asgi:app", "--host", "127.0.0.1",
+                "--port", str(port), "--log-level", "warning"]
+    # The threaded development server without the debug reloader, so the measured pid serves requests
+    return [sys.executable, "-c",
+            f"from app import app; app.run(host='127.0.0.1', port={port}, threaded=True)"]
+
+
+def start_mocks(args):
+    """Run the mock providers in their own process so they do not compete with the load generator."""
+    command = [sys.executable, os.path.join(BENCHMARKS_DIR, "mock_providers.py"), "--base-port", "0",
+               "--mock", args.mock]
+    for provider in PROVIDERS:
+        command += [f"--{provider}", getattr(args, provider)]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+    mock_env = {}
+    for _ in PROVIDERS:
+        name, _, value = process.stdout.readline().strip().partition("=")
+        if not value:
+            process.kill()
+            raise RuntimeError("Mock providers failed to start")
+        mock_env[name] = value
+    return process, mock_env
+
+
+def stop_process(process):
+    process.terminate()
+    try:
+        process.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+
+def start_server(mode, port, mock_env, cache):
+    env = dict(os.environ)
+    env.update(mock_env)
+    env.update({
+        # Keys only reach the mocks, never a real provider
+        "ANTHROPIC_API_KEY": "benchmark",
+        "OPENAI_API_KEY": "benchmark",
+        "DEEPSEEK_API_KEY": "benchmark",
+        "RATE_LIMIT_ENABLED": "false",
+        "CACHE_ENABLED": "true" if cache else "false",
+    })
+    return subprocess.Popen(
+        _server_command(mode, port), cwd=BACKEND_DIR, env=env,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+
+
+def wait_until_ready(url, process, timeout=30.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Backend exited with status {process.returncode}")
+        try:
+            # /ready turns 200 once the backend has warmed its provider connections
+            if httpx.get(url + "/ready", timeout=1.0).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"Backend did not start within {timeout:.0f}s")
+
+
+class ProcessSampler:
+    """Peak resident memory and open sockets of a process, read from /proc (Linux only)."""
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.rss_peak = None
+        self.sockets_peak = None
+
+    def reset(self):
+        self.rss_peak = None
+        self.sockets_peak = None
+
+    def sample(self):
+        try:
+            with open(f"/proc/{self.pid}/status") as status:
+                for line in status:
+                    if line.startswith("VmRSS:"):
+                        rss = int(line.split()[1]) * 1024
+                        self.rss_peak = max(self.rss_peak or 0, rss)
+            fd_dir = f"/proc/{self.pid}/fd"
+            sockets = 0
+            for fd in os.listdir(fd_dir):
+                try:
+                    if os.readlink(os.path.join(fd_dir, fd)).startswith("socket:"):
+                        sockets += 1
+                except OSError:
+                    pass
+            self.sockets_peak = max(self.sockets_peak or 0, sockets)
+        except OSError:
+            pass
+
+    async def run(self, interval=0.25):
+        while True:
+            self.sample()
+            await asyncio.sleep(interval)
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    # Nearest-rank percentile
+    return sorted_values[max(0, math.ceil(q * len(sorted_values)) - 1)]
+
+
+def _body(route, n, model):
+    if route.startswith("/chat"):
+        body = {"content": f"Benchmark message {n}"}
+    else:
+        body = {"prompt": f"Write an add function, variant {n}", "language": "python"}
+    if model:
+        body["model"] = model
+    return body
+
+
+async def _post(client, route, body):
+    """Status of one plain request, and None as it has no first token."""
+    response = await client.post(route, json=body)
+    return str(response.status_code), None
+
+
+async def _post_stream(client, route, body):
+    """Status of one streamed request and the seconds until its first token.
+
+    A stream that answers 200 and then ends with an error event counts under
+    that event's status, as "stream-<status>".
+    """
+    started = time.monotonic()
+    first_token = None
+    async with client.stream("POST", route, json=body) as response:
+        if response.status_code != 200:
+            await response.aread()
+            return str(response.status_code), None
+        event = None
+        async for line in response.aiter_lines():
+            if line.startswith("event:"):
+                event = line[6:].strip()
+            elif line.startswith("data:") and event == "token" and first_token is None:
+                first_token = time.monotonic() - started
+            elif line.startswith("data:") and event == "error":
+                return f"stream-{json.loads(line[5:]).get('status')}", first_token
+            elif line.startswith("data:") and event == "done":
+                return "200", first_token
+    return "incomplete", first_token
+
+
+def _percentiles(values):
+    return {
+        "mean": sum(values) / len(values) if values else None,
+        "p50": percentile(values, 0.50),
+        "p95": percentile(values, 0.95),
+        "p99": percentile(values, 0.99),
+        "max": values[-1] if values else None,
+    }
+
+
+async def run_step(url, routes, concurrency, duration, model, counter, sampler):
+    """Keep `concurrency` requests in flight for `duration` seconds."""
+    latencies = []
+    first_tokens = []
+    statuses = {}
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    async with httpx.AsyncClient(base_url=url, timeout=120.0, limits=limits) as client:
+        deadline = time.monotonic() + duration
+
+        async def worker():
+            while time.monotonic() < deadline:
+                n = next(counter)
+                route = routes[n % len(routes)]
+                send = _post_stream if route.endswith("/stream") else _post
+                started = time.monotonic()
+                try:
+                    status, first_token = await send(client, route, _body(route, n, model))
+                except httpx.HTTPError as e:
+                    status, first_token = type(e).__name__, None
+                elapsed = time.monotonic() - started
+                statuses[status] = statuses.get(status, 0) + 1
+                if status == "200":
+                    latencies.append(elapsed)
+                    if first_token is not None:
+                        first_tokens.append(first_token)
+
+        sampler.reset()
+        sampling = asyncio.ensure_future(sampler.run())
+        started = time.monotonic()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.monotonic() - started
+        sampling.cancel()
+        sampler.sample()
+
+    latencies.sort()
+    first_tokens.sort()
+    total = sum(statuses.values())
+    return {
+        "concurrency": concurrency,
+        "seconds": round(elapsed, 3),
+        "requests": total,
+        "ok": len(latencies),
+        "statuses": statuses,
+        "error_rate": round(1 - len(latencies) / total, 4) if total else None,
+        "rps": round(len(latencies) / elapsed, 2) if elapsed else None,
+        "latency": _percentiles(latencies),
+        # Only streamed requests have a first token
+        "first_token": _percentiles(first_tokens) if first_tokens else None,
+        "server": {
+            "rss_peak_bytes": sampler.rss_peak,
+            "sockets_peak": sampler.sockets_peak,
+        },
+    }
+
+
+def _ms(seconds):
+    return f"{seconds * 1000:8.1f}" if seconds is not None else "       -"
+
+
+def print_step(step):
+    latency = step["latency"]
+    first_token = step.get("first_token")
+    rss = step["server"]["rss_peak_bytes"]
+    print(
+        f"c={step['concurrency']:<5} {step['rps'] or 0:9.1f} req/s"
+        f"  p50 {_ms(latency['p50'])}ms  p95 {_ms(latency['p95'])}ms  p99 {_ms(latency['p99'])}ms"
+        + (f"  ttft p50 {_ms(first_token['p50'])}ms p99 {_ms(first_token['p99'])}ms" if first_token else "")
+        + f"  errors {step['error_rate'] or 0:6.2%}"
+        f"  sockets {step['server']['sockets_peak'] or '-':>5}"
+        f"  rss {f'{rss / 2**20:.0f}MB' if rss else '-':>7}"
+    )
+
+
+async def run_ramp(url, args, pid):
+    routes = ["/" + route.strip().strip("/") for route in args.routes.split(",") if route.strip()]
+    if args.stream:
+        routes = [route if route.endswith("/stream") else route + "/stream" for route in routes]
+    counter = itertools.count()
+    sampler = ProcessSampler(pid)
+    # Warm the backend's connection pools and SDK clients before measuring
+    await run_step(url, routes, 1, args.warmup, args.model, counter, sampler)
+    steps = []
+    for concurrency in args.concurrency:
+        step = await run_step(url, routes, concurrency, args.duration, args.model, counter, sampler)
+        print_step(step)
+        steps.append(step)
+    return steps
+
+
+def run(args):
+    # Validate the mock settings before starting anything
+    profiles = profiles_from_args(args)
+    mocks, mock_env = start_mocks(args)
+    port = _free_port()
+    url = f"http://127.0.0.1:{port}"
+    server = start_server(args.mode, port, mock_env, args.cache)
+    try:
+        wait_until_ready(url, server)
+        streamed = ", streamed" if args.stream else ""
+        print(f"Benchmarking {args.mode} server at {url} ({args.routes}{streamed}, {args.duration:.0f}s per step)")
+        steps = asyncio.run(run_ramp(url, args, server.pid))
+    finally:
+        stop_process(server)
+        stop_process(mocks)
+
+    commit = _git("rev-parse", "--short", "HEAD")
+    result = {
+        "meta": {
+            "commit": commit,
+            "dirty": bool(_git("status", "--porcelain", "--untracked-files=no")),
+            "label": args.label,
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "mode": args.mode,
+            "routes": args.routes,
+            "stream": args.stream,
+            "model": args.model,
+            "duration": args.duration,
+            "cache": args.cache,
+            "mocks": {provider: vars(profile) for provider, profile in profiles.items()},
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+        },
+        "steps": steps,
+    }
+
+    output = args.output
+    if output is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        name = "-".join(filter(None, [time.strftime("%Y%m%d-%H%M%S"), commit, args.mode,
+                                      "stream" if args.stream else None, args.label]))
+        output = os.path.join(RESULTS_DIR, name + ".json")
+    with open(output, "w") as f:
+        json.dump(result, f, indent=2)
+    print(f"Results written to {output}")
+
+
+def _change(before, after):
+    if not before or after is None:
+        return "       -"
+    return f"{(after - before) / before:+8.1%}"
+
+
+def compare(args):
+    with open(args.before) as f:
+        before = json.load(f)
+    with open(args.after) as f:
+        after = json.load(f)
+    print(f"before: {before['meta'].get('commit')} ({before['meta'].get('mode')}, {before['meta'].get('timestamp')})")
+    print(f"after:  {after['meta'].get('commit')} ({after['meta'].get('mode')}, {after['meta'].get('timestamp')})")
+    print(f"{'conc':>5} {'req/s':>19} {'change':>8} {'p50 ms':>19} {'p95 ms':>19} {'p99 ms':>19} {'p99 change':>10}")
+
+    after_steps = {step["concurrency"]: step for step in after["steps"]}
+    for old in before["steps"]:
+        new = after_steps.get(old["concurrency"])
+        if new is None:
+            continue
+        cells = [f"{old['concurrency']:>5}", f"{old['rps'] or 0:>9.1f}{new['rps'] or 0:>10.1f}", _change(old["rps"], new["rps"])]
+        for q in ("p50", "p95", "p99"):
+            cells.append(f"{_ms(old['latency'][q])}{_ms(new['latency'][q])}".rjust(19))
+        cells.append(_change(old["latency"]["p99"], new["latency"]["p99"]).rjust(10))
+        print(" ".join(cells))
+
+
+def _concurrency_levels(value):
+    return [int(level) for level in value.split(",") if level.strip()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the backend against mock providers")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="Run a concurrency ramp and save the results")
+    run_parser.add_argument("--mode", choices=["flask", "async"], default="flask")
+    run_parser.add_argument("--concurrency", type=_concurrency_levels, default=[1, 4, 16, 64])
+    run_parser.add_argument("--duration", type=float, default=10.0, help="Seconds per concurrency level")
+    run_parser.add_argument("--warmup", type=float, default=2.0, help="Seconds of unmeasured traffic first")
+    run_parser.add_argument("--routes", default="chat,code-generate", help="Comma-separated routes, used in turn")
+    run_parser.add_argument("--stream", action="store_true",
+                            help="Use the /stream endpoints and report time to first token")
+    run_parser.add_argument("--model", default=None, help="Model sent with each request (default: the backend's)")
+    run_parser.add_argument("--cache", action="store_true", help="Leave the response cache on")
+    run_parser.add_argument("--label", default=None, help="Added to the result file name")
+    run_parser.add_argument("--output", default=None, help="Result file (default: benchmarks/results/...)")
+    add_profile_arguments(run_parser)
+
+    compare_parser = commands.add_parser("compare", help="Compare two result files")
+    compare_parser.add_argument("before")
+    compare_parser.add_argument("after")
+
+    args = parser.parse_args()
+    if args.command == "run":
+        run(args)
+    else:
+        compare(args)
+
+
+if __name__ == "__main__":
+    main()
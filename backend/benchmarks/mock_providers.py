@@ -0,0 +1,253 @@
+"""Local stand-ins for the Anthropic, OpenAI and DeepSeek APIs.
+
+Each provider gets its own HTTP server answering the endpoints the backend calls
+(/v1/messages or /v1/chat/completions) after a configurable, log-normally
+distributed delay, failing a configurable fraction of requests. Requests with
+"stream": true get the reply as that provider's Server-Sent Events, one chunk
+every token_interval seconds after the first.
+
+    python benchmarks/mock_providers.py --anthropic median=0.4,sigma=0.5,error_rate=0.02
+"""
+import argparse
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+PROVIDERS = ("anthropic", "openai", "deepseek")
+
+REPLY = "```python\ndef add(a, b):\n    return a + b\n```"
+# The reply in word-sized pieces, as a provider streams it
+REPLY_CHUNKS = re.findall(r"\s*\S+", REPLY)
+
+
+class MockProfile:
+    """Latency and failure behaviour of one mock provider."""
+
+    def __init__(self, median=0.3, sigma=0.4, error_rate=0.0, error_status=529, max_latency=30.0,
+                 token_interval=0.02):
+        self.median = median
+        self.sigma = sigma
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.max_latency = max_latency
+        self.token_interval = token_interval
+
+    @classmethod
+    def parse(cls, spec, base=None):
+        """Build a profile from "median=0.3,sigma=0.4,error_rate=0.01,error_status=500"."""
+        profile = cls(**vars(base)) if base is not None else cls()
+        for part in filter(None, (spec or "").split(",")):
+            name, _, value = part.partition("=")
+            name = name.strip()
+            if name not in vars(profile):
+                raise ValueError(f"Unknown mock setting: {name}")
+            setattr(profile, name, int(value) if name == "error_status" else float(value))
+        return profile
+
+    def delay(self):
+        if self.median <= 0:
+            return 0.0
+        return min(self.max_latency, random.lognormvariate(0, self.sigma) * self.median)
+
+    def fails(self):
+        return random.random() < self.error_rate
+
+
+def _anthropic_reply(body):
+    return {
+        "id": "msg_mock",
+        "type": "message",
+        "role": "assistant",
+        "model": body.get("model"),
+        "content": [{"type": "text", "text": REPLY}],
+        "stop_reason": "end_turn",
+        "stop_sequence": None,
+        "usage": {"input_tokens": 12, "output_tokens": 18},
+    }
+
+
+def _openai_reply(body):
+    return {
+        "id": "chatcmpl-mock",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": body.get("model"),
+        "choices": [{
+            "index": 0,
+            "message": {"role": "assistant", "content": REPLY},
+            "finish_reason": "stop",
+        }],
+        "usage": {"prompt_tokens": 12, "completion_tokens": 18, "total_tokens": 30},
+    }
+
+
+def _anthropic_events(body):
+    message = dict(_anthropic_reply(body), content=[], stop_reason=None,
+                   usage={"input_tokens": 12, "output_tokens": 1})
+    yield "message_start", {"type": "message_start", "message": message}
+    yield "content_block_start", {"type": "content_block_start", "index": 0,
+                                  "content_block": {"type": "text", "text": ""}}
+    for chunk in REPLY_CHUNKS:
+        yield "content_block_delta", {"type": "content_block_delta", "index": 0,
+                                      "delta": {"type": "text_delta", "text": chunk}}
+    yield "content_block_stop", {"type": "content_block_stop", "index": 0}
+    yield "message_delta", {"type": "message_delta", "delta": {"stop_reason": "end_turn", "stop_sequence": None},
+                            "usage": {"output_tokens": 18}}
+    yield "message_stop", {"type": "message_stop"}
+
+
+def _openai_events(body):
+    def chunk(delta, finish_reason=None):
+        return {
+            "id": "chatcmpl-mock",
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": body.get("model"),
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+        }
+
+    yield None, chunk({"role": "assistant", "content": ""})
+    for text in REPLY_CHUNKS:
+        yield None, chunk({"content": text})
+    yield None, chunk({}, "stop")
+    if (body.get("stream_options") or {}).get("include_usage"):
+        yield None, dict(chunk({}), choices=[],
+                         usage={"prompt_tokens": 12, "completion_tokens": 18, "total_tokens": 30})
+
+
+def _handler(provider, profile):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def _send(self, status, payload):
+            data = json.dumps(payload).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _write_chunk(self, data):
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+            self.wfile.flush()
+
+        def _stream(self, events):
+            # Chunked transfer encoding keeps the connection reusable, as with a real provider
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            for n, (event, payload) in enumerate(events):
+                if n:
+                    time.sleep(profile.token_interval)
+                prefix = f"event: {event}\n" if event else ""
+                self._write_chunk(f"{prefix}data: {json.dumps(payload)}\n\n".encode("utf-8"))
+            if provider != "anthropic":
+                self._write_chunk(b"data: [DONE]\n\n")
+            self._write_chunk(b"")
+
+        def do_GET(self):
+            if self.path.rstrip("/").endswith("/models"):
+                self._send(200, {"object": "list", "data": []})
+            else:
+                self._send(404, {"error": {"message": "Not found"}})
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            body = json.loads(self.rfile.read(length) or b"{}")
+            time.sleep(profile.delay())
+            if profile.fails():
+                self._send(profile.error_status, {"error": {"type": "overloaded_error", "message": "Mock failure"}})
+            elif provider == "anthropic" and self.path == "/v1/messages":
+                if body.get("stream"):
+                    self._stream(_anthropic_events(body))
+                else:
+                    self._send(200, _anthropic_reply(body))
+            elif provider != "anthropic" and self.path == "/v1/chat/completions":
+                if body.get("stream"):
+                    self._stream(_openai_events(body))
+                else:
+                    self._send(200, _openai_reply(body))
+            else:
+                self._send(404, {"error": {"message": f"Unknown path {self.path}"}})
+
+    return Handler
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    # A deep listen backlog so bursts of new connections are not dropped and retried
+    request_queue_size = 1024
+
+
+class MockProviders:
+    """One mock server per provider, each on its own port and thread."""
+
+    def __init__(self, profiles, host="127.0.0.1", ports=None):
+        self.profiles = profiles
+        self.host = host
+        self.ports = ports or {}
+        self._servers = {}
+
+    def start(self):
+        for provider in PROVIDERS:
+            server = _Server((self.host, self.ports.get(provider, 0)), _handler(provider, self.profiles[provider]))
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            self._servers[provider] = server
+        return self
+
+    def base_urls(self):
+        return {
+            provider: f"http://{self.host}:{server.server_port}"
+            for provider, server in self._servers.items()
+        }
+
+    def environ(self):
+        """Environment pointing the backend at these servers."""
+        return {f"{provider.upper()}_BASE_URL": url for provider, url in self.base_urls().items()}
+
+    def stop(self):
+        for server in self._servers.values():
+            server.shutdown()
+            server.server_close()
+        self._servers.clear()
+
+
+def add_profile_arguments(parser):
+    parser.add_argument("--mock", default="", help="Settings for every mock provider, e.g. median=0.3,sigma=0.4,error_rate=0.01")
+    for provider in PROVIDERS:
+        parser.add_argument(f"--{provider}", default="", help=f"Settings overriding --mock for {provider}")
+
+
+def profiles_from_args(args):
+    base = MockProfile.parse(args.mock)
+    return {provider: MockProfile.parse(getattr(args, provider), base) for provider in PROVIDERS}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve mock provider APIs for benchmarking")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--base-port", type=int, default=9100,
+                        help="anthropic, openai and deepseek listen on this port and the next two; 0 picks free ports")
+    add_profile_arguments(parser)
+    args = parser.parse_args()
+
+    ports = {provider: args.base_port + offset for offset, provider in enumerate(PROVIDERS)} if args.base_port else {}
+    mocks = MockProviders(profiles_from_args(args), host=args.host, ports=ports).start()
+    for name, value in mocks.environ().items():
+        print(f"{name}={value}", flush=True)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        mocks.stop()
+
+
+if __name__ == "__main__":
+    main()
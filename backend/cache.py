@@ -0,0 +1,161 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from metrics import metrics
+from shared_store import shared_store
+
+logger = logging.getLogger(__name__)
+
+
+class CacheConfig:
+    ENABLED = os.getenv("CACHE_ENABLED", "true").strip().lower() in ("1", "true", "yes", "on")
+    MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "1000"))
+    TTL = float(os.getenv("CACHE_TTL", "3600"))
+    # Back the in-memory tier with the shared store, so workers see each other's entries
+    SHARED = os.getenv("CACHE_SHARED", "true").strip().lower() in ("1", "true", "yes", "on")
+
+
+def normalize_text(text):
+    return " ".join(str(text).split())
+
+
+def cache_key(task, prompt, language, model, params):
+    """Hash the normalized request fields that determine a completion.
+
+    params holds the (system prompt, max_tokens, temperature) the model is called with.
+    """
+    raw = json.dumps([
+        task,
+        normalize_text(prompt),
+        normalize_text(language).lower(),
+        model,
+        params,
+    ])
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def cache_mode(task, data, headers):
+    """Return "use", "refresh" or "bypass" for a request.
+
+    Code generation is cached unless the request opts out; chat only when it
+    opts in, since conversations are rarely repeated verbatim.
+    """
+    if not CacheConfig.ENABLED:
+        return "bypass"
+    requested = data.get('cache')
+    cache_control = (headers.get('Cache-Control') or "").lower()
+    if requested in ("bypass", False) or "no-store" in cache_control:
+        return "bypass"
+    if requested == "refresh" or "no-cache" in cache_control:
+        return "refresh"
+    if task == "chat" and requested is not True:
+        return "bypass"
+    return "use"
+
+
+class ResponseCache:
+    """Size-bounded LRU with TTL in memory, optionally backed by the cross-worker shared store."""
+
+    NAMESPACE = "responses"
+
+    def __init__(self, max_entries=CacheConfig.MAX_ENTRIES, ttl=CacheConfig.TTL,
+                 store=shared_store if CacheConfig.SHARED else None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._shared = store
+        self.counters = {"hits": 0, "shared_hits": 0, "misses": 0, "stores": 0, "bypassed": 0, "refreshed": 0}
+
+    def count(self, name):
+        with self._lock:
+            self.counters[name] += 1
+        if self._shared is not None:
+            self._shared.incr(f"cache.{name}")
+
+    def get(self, key):
+        value = self._get_local(key)
+        if value is None and self._shared is not None:
+            value = self._get_shared(key)
+        if value is None:
+            self.count("misses")
+        return value
+
+    async def aget(self, key):
+        """get() for the event loop: a shared-store read runs on a worker thread."""
+        value = self._get_local(key)
+        if value is None and self._shared is not None:
+            value = await asyncio.to_thread(self._get_shared, key)
+        if value is None:
+            self.count("misses")
+        return value
+
+    def _get_local(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] <= now:
+                del self._entries[key]
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(key)
+        if entry is None:
+            return None
+        self.count("hits")
+        return entry[1]
+
+    def _get_shared(self, key):
+        try:
+            row = self._shared.get(self.NAMESPACE, key)
+        except Exception as e:
+            logger.warning("Could not read response cache entry from the shared store: %s", e)
+            return None
+        if row is None:
+            return None
+        value, expires_at = row
+        self._remember(key, value, expires_at)
+        self.count("shared_hits")
+        return value
+
+    def set(self, key, value):
+        expires_at = time.time() + self.ttl
+        self._remember(key, value, expires_at)
+        self.count("stores")
+        # Written behind the request, which already has its answer; other workers see it a moment later
+        if self._shared is not None and not self._shared.set_later(self.NAMESPACE, key, value, expires_at):
+            logger.warning("Shared store write queue is full, response cache entry kept in this worker only")
+
+    def _remember(self, key, value, expires_at):
+        with self._lock:
+            self._entries[key] = (expires_at, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+            stats["entries"] = len(self._entries)
+        stats["max_entries"] = self.max_entries
+        stats["ttl"] = self.ttl
+        stats["shared"] = self._shared is not None
+        return stats
+
+
+response_cache = ResponseCache()
+
+metrics.register_collector(
+    "response_cache_events_total", "counter", "Response cache lookups and writes by outcome",
+    lambda: [({"event": event}, count) for event, count in response_cache.stats().items()
+             if event in response_cache.counters]
+)
+metrics.register_collector(
+    "response_cache_entries", "gauge", "Entries held in the in-memory response cache",
+    lambda: [({}, response_cache.stats()["entries"])]
+)
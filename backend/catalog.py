@@ -0,0 +1,195 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+from clients import get_clients
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class CatalogConfig:
+    # Seconds between refreshes of each provider's model list; 0 keeps the static tables only
+    REFRESH_INTERVAL = float(os.getenv("MODEL_CATALOG_REFRESH_INTERVAL", "3600"))
+    # Seconds before a failed refresh is tried again
+    RETRY_INTERVAL = float(os.getenv("MODEL_CATALOG_RETRY_INTERVAL", "60"))
+    # Seconds one model-list request may take
+    TIMEOUT = float(os.getenv("MODEL_CATALOG_TIMEOUT", "10"))
+
+
+class UnknownModel(ValueError):
+    status_code = 400
+
+    def __init__(self, model):
+        super().__init__(f"Unknown model: {model}; see /models for the available models")
+        self.model = model
+
+
+# Model-list endpoint of each provider
+LIST_PATHS = {
+    "anthropic": "/v1/models?limit=1000",
+    "openai": "/v1/models",
+    "deepseek": "/models",
+}
+
+# OpenAI also lists embedding, audio and image models, which cannot serve /chat or /code-generate
+_OPENAI_CHAT = re.compile(r"^(gpt-|chatgpt-|o\d)")
+_OPENAI_NOT_CHAT = re.compile(r"audio|realtime|transcribe|tts|image|search|embedding|instruct")
+
+
+def _chat_model(provider, model_id):
+    if provider == "openai":
+        return bool(_OPENAI_CHAT.match(model_id)) and not _OPENAI_NOT_CHAT.search(model_id)
+    return True
+
+
+def etag(body):
+    # A hash of the body, so every worker hands out the same tag for the same catalog
+    return '"' + hashlib.sha1(body.encode()).hexdigest() + '"'
+
+
+def not_modified(if_none_match, current):
+    """Whether an If-None-Match header already names the current ETag."""
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    # A weak comparison is enough for a JSON listing
+    return "*" in tags or current in tags or f"W/{current}" in tags
+
+
+class ModelCatalog:
+    """Each provider's models: the static tables, kept current from the provider's model-list endpoint.
+
+    A background thread refetches the lists every REFRESH_INTERVAL seconds, so
+    requests only read the current snapshot. A provider that has no key, or
+    whose list could not be fetched, keeps its static table. Once a list has
+    been fetched it is authoritative: static entries it no longer has are dropped.
+    """
+
+    def __init__(self, static, api_key, headers, config=CatalogConfig):
+        self.static = static
+        self.api_key = api_key
+        self.headers = headers
+        self.config = config
+        self._models = {provider: dict(models) for provider, models in static.items()}
+        self._index = self._build_index(self._models)
+        self.sources = {provider: "static" for provider in static}
+        self.refreshed_at = {}
+        self.errors = {}
+        # Bumped on every change; serialized views are rebuilt when it moves
+        self.version = 0
+        self._views = {}
+        self._lock = threading.Lock()
+        self._refresher_pid = None
+
+    @staticmethod
+    def _build_index(models):
+        return {model_id: provider for provider, provider_models in models.items() for model_id in provider_models}
+
+    def models(self, provider):
+        """{model id: display name} for the provider."""
+        self._start_refresher()
+        return self._models[provider]
+
+    def provider_for(self, model):
+        self._start_refresher()
+        return self._index.get(model) if isinstance(model, str) else None
+
+    def check(self, model):
+        """Raise UnknownModel unless some provider lists the model."""
+        if self.provider_for(model) is None:
+            raise UnknownModel(model)
+
+    def fetch(self, provider):
+        """The provider's current {model id: display name}, in the order it lists them."""
+        response = get_clients().http(provider).get(
+            LIST_PATHS[provider], headers=self.headers(provider), timeout=self.config.TIMEOUT
+        )
+        response.raise_for_status()
+        return {
+            entry["id"]: entry.get("display_name") or entry["id"]
+            for entry in response.json().get("data", [])
+            if _chat_model(provider, entry["id"])
+        }
+
+    def _merge(self, provider, fetched):
+        # Static names are kept for the models they cover, and those models stay first
+        static = self.static[provider]
+        merged = {model_id: name for model_id, name in static.items() if model_id in fetched}
+        for model_id in sorted(fetched):
+            merged.setdefault(model_id, fetched[model_id])
+        return merged
+
+    def refresh(self, provider):
+        """Fetch one provider's list; returns whether the catalog now holds a fetched list for it."""
+        if not self.api_key(provider):
+            return False
+        try:
+            fetched = self.fetch(provider)
+        except Exception as e:
+            self.errors[provider] = str(e) or type(e).__name__
+            metrics.inc("model_catalog_refreshes_total", {"provider": provider, "outcome": "error"})
+            logger.warning("Could not refresh the %s model list, keeping the previous one: %s", provider, e)
+            return False
+        if not fetched:
+            self.errors[provider] = "The provider listed no chat models"
+            metrics.inc("model_catalog_refreshes_total", {"provider": provider, "outcome": "empty"})
+            return False
+        merged = self._merge(provider, fetched)
+        with self._lock:
+            changed = merged != self._models[provider]
+            if changed:
+                models = dict(self._models, **{provider: merged})
+                # Swapped in whole, so readers never see half an update
+                self._models, self._index = models, self._build_index(models)
+                self.version += 1
+            self.sources[provider] = "live"
+            self.refreshed_at[provider] = time.time()
+            self.errors.pop(provider, None)
+        metrics.inc("model_catalog_refreshes_total", {"provider": provider, "outcome": "changed" if changed else "unchanged"})
+        return True
+
+    def refresh_all(self):
+        """Refresh every provider; returns whether all of them succeeded."""
+        return all([self.refresh(provider) for provider in self.static if self.api_key(provider)])
+
+    def _start_refresher(self):
+        # One refresh thread per process; threads do not survive a fork
+        if self._refresher_pid == os.getpid() or self.config.REFRESH_INTERVAL <= 0:
+            return
+        with self._lock:
+            if self._refresher_pid != os.getpid():
+                self._refresher_pid = os.getpid()
+                threading.Thread(target=self._refresh_forever, name="model-catalog", daemon=True).start()
+
+    def _refresh_forever(self):
+        while True:
+            ok = self.refresh_all()
+            time.sleep(self.config.REFRESH_INTERVAL if ok else min(self.config.RETRY_INTERVAL, self.config.REFRESH_INTERVAL))
+
+    def render(self, name, key, build):
+        """Serialized JSON of build() and its ETag, rebuilt only when the catalog or `key` changes."""
+        version = self.version
+        cached = self._views.get(name)
+        if cached is not None and cached[0] == version and cached[1] == key:
+            return cached[2], cached[3]
+        body = json.dumps(build())
+        tag = etag(body)
+        self._views[name] = (version, key, body, tag)
+        return body, tag
+
+    def snapshot(self):
+        self._start_refresher()
+        return {
+            provider: {
+                "source": self.sources[provider],
+                "models": len(self._models[provider]),
+                "refreshed_at": self.refreshed_at.get(provider),
+                "error": self.errors.get(provider),
+            }
+            for provider in self.static
+        }
@@ -0,0 +1,331 @@
+import atexit
+import logging
+import os
+import ssl
+import threading
+import time
+import weakref
+
+import certifi
+import httpx
+
+import deadline
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Base URLs for the direct HTTP paths and the SDK clients; overridable to point
+# at a proxy or at the local stand-ins in benchmarks/
+PROVIDER_BASE_URLS = {
+    "anthropic": os.getenv("ANTHROPIC_BASE_URL", "https://api.anthropic.com").rstrip("/"),
+    "openai": os.getenv("OPENAI_BASE_URL", "https://api.openai.com").rstrip("/"),
+    "deepseek": os.getenv("DEEPSEEK_BASE_URL", "https://api.deepseek.com").rstrip("/"),
+}
+
+
+def _env_bool(name, default=False):
+    value = os.getenv(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+
+class ClientConfig:
+    # Total read/write timeout for a provider call, in seconds
+    TIMEOUT = float(os.getenv("PROVIDER_TIMEOUT", "60"))
+    CONNECT_TIMEOUT = float(os.getenv("PROVIDER_CONNECT_TIMEOUT", "10"))
+    # Connection pool limits, per provider
+    MAX_CONNECTIONS = int(os.getenv("PROVIDER_MAX_CONNECTIONS", "100"))
+    MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("PROVIDER_MAX_KEEPALIVE", "20"))
+    KEEPALIVE_EXPIRY = float(os.getenv("PROVIDER_KEEPALIVE_EXPIRY", "30"))
+    # The async pools multiplex many more in-flight calls per worker
+    ASYNC_MAX_CONNECTIONS = int(os.getenv("PROVIDER_ASYNC_MAX_CONNECTIONS", "1000"))
+    ASYNC_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("PROVIDER_ASYNC_MAX_KEEPALIVE", "100"))
+    # HTTP/2 needs the optional `h2` package
+    HTTP2 = _env_bool("PROVIDER_HTTP2")
+
+    @classmethod
+    def timeout(cls):
+        return httpx.Timeout(cls.TIMEOUT, connect=cls.CONNECT_TIMEOUT)
+
+    @classmethod
+    def attempt_timeout(cls):
+        """Timeout for one provider attempt, cut to what is left of the request's deadline."""
+        return httpx.Timeout(deadline.clamp(cls.TIMEOUT), connect=deadline.clamp(cls.CONNECT_TIMEOUT))
+
+    @classmethod
+    def limits(cls):
+        return httpx.Limits(
+            max_connections=cls.MAX_CONNECTIONS,
+            max_keepalive_connections=cls.MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=cls.KEEPALIVE_EXPIRY,
+        )
+
+    @classmethod
+    def async_limits(cls):
+        return httpx.Limits(
+            max_connections=cls.ASYNC_MAX_CONNECTIONS,
+            max_keepalive_connections=cls.ASYNC_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=cls.KEEPALIVE_EXPIRY,
+        )
+
+    @classmethod
+    def http2(cls):
+        if not cls.HTTP2:
+            return False
+        try:
+            import h2  # noqa: F401
+        except ImportError:
+            logger.warning("PROVIDER_HTTP2 is set but the h2 package is not installed, using HTTP/1.1")
+            return False
+        return True
+
+
+_ssl_context = None
+_ssl_lock = threading.Lock()
+
+
+def ssl_context():
+    """TLS context with the certifi CA bundle, loaded once and shared by every client."""
+    global _ssl_context
+    if _ssl_context is None:
+        with _ssl_lock:
+            if _ssl_context is None:
+                _ssl_context = ssl.create_default_context(cafile=certifi.where())
+    return _ssl_context
+
+
+def _ttfb_hooks(provider):
+    """httpx event hooks timing each upstream request until its response headers arrive."""
+    def on_request(request):
+        request.extensions["sent_at"] = time.monotonic()
+
+    def on_response(response):
+        sent_at = response.request.extensions.get("sent_at")
+        if sent_at is not None:
+            metrics.observe("provider_ttfb_seconds", {"provider": provider}, time.monotonic() - sent_at)
+
+    return {"request": [on_request], "response": [on_response]}
+
+
+def _async_ttfb_hooks(provider):
+    hooks = _ttfb_hooks(provider)
+    on_request, on_response = hooks["request"][0], hooks["response"][0]
+
+    async def aon_request(request):
+        on_request(request)
+
+    async def aon_response(response):
+        on_response(response)
+
+    return {"request": [aon_request], "response": [aon_response]}
+
+
+class ProviderClients:
+    """Keep-alive connection pools and SDK clients shared by every request in a worker."""
+
+    def __init__(self, config=ClientConfig):
+        self.config = config
+        self._lock = threading.Lock()
+        self._http = {}
+        self._sdk = {}
+        self._closed = False
+
+    def http(self, provider):
+        client = self._http.get(provider)
+        if client is not None:
+            return client
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("Provider clients have been closed")
+            client = self._http.get(provider)
+            if client is None:
+                client = httpx.Client(
+                    base_url=PROVIDER_BASE_URLS[provider],
+                    timeout=self.config.timeout(),
+                    limits=self.config.limits(),
+                    http2=self.config.http2(),
+                    verify=ssl_context(),
+                    event_hooks=_ttfb_hooks(provider),
+                )
+                self._http[provider] = client
+            return client
+
+    def post(self, provider, path, **kwargs):
+        return self.http(provider).post(path, **kwargs)
+
+    def _sdk_client(self, name, factory):
+        if name in self._sdk:
+            return self._sdk[name]
+        http_client = self.http(name)
+        with self._lock:
+            if name not in self._sdk:
+                self._sdk[name] = factory(http_client)
+            return self._sdk[name]
+
+    def anthropic(self, api_key):
+        def factory(http_client):
+            import anthropic
+            return anthropic.Anthropic(
+                api_key=api_key,
+                base_url=PROVIDER_BASE_URLS["anthropic"],
+                http_client=http_client,
+                # Retries are made by retries.py, which also covers the direct HTTP path
+                max_retries=0,
+            )
+        return self._sdk_client("anthropic", factory)
+
+    def openai(self, api_key):
+        def factory(http_client):
+            from openai import OpenAI
+            return OpenAI(
+                api_key=api_key,
+                base_url=PROVIDER_BASE_URLS["openai"] + "/v1",
+                http_client=http_client,
+                # Retries are made by retries.py, which also covers the direct HTTP path
+                max_retries=0,
+            )
+        return self._sdk_client("openai", factory)
+
+    def deepseek(self, api_key):
+        # The DeepSeek SDK is optional; remember a failed import instead of retrying it per request
+        def factory(http_client):
+            try:
+                import deepseek
+                return deepseek.Client(api_key=api_key)
+            except Exception as e:
+                logger.info("DeepSeek SDK unavailable, using direct API calls: %s", e)
+                return None
+        return self._sdk_client("deepseek", factory)
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            http_clients = list(self._http.values())
+            self._http.clear()
+            self._sdk.clear()
+        for client in http_clients:
+            try:
+                client.close()
+            except Exception as e:
+                logger.warning("Could not close HTTP client: %s", e)
+
+
+class AsyncProviderClients:
+    """Async counterpart of ProviderClients, bound to the event loop that created it."""
+
+    def __init__(self, config=ClientConfig):
+        self.config = config
+        self._http = {}
+        self._sdk = {}
+        self._closed = False
+
+    def http(self, provider):
+        if self._closed:
+            raise RuntimeError("Provider clients have been closed")
+        client = self._http.get(provider)
+        if client is None:
+            client = httpx.AsyncClient(
+                base_url=PROVIDER_BASE_URLS[provider],
+                timeout=self.config.timeout(),
+                limits=self.config.async_limits(),
+                http2=self.config.http2(),
+                verify=ssl_context(),
+                event_hooks=_async_ttfb_hooks(provider),
+            )
+            self._http[provider] = client
+        return client
+
+    async def post(self, provider, path, **kwargs):
+        return await self.http(provider).post(path, **kwargs)
+
+    def anthropic(self, api_key):
+        client = self._sdk.get("anthropic")
+        if client is None:
+            import anthropic
+            client = anthropic.AsyncAnthropic(
+                api_key=api_key,
+                base_url=PROVIDER_BASE_URLS["anthropic"],
+                http_client=self.http("anthropic"),
+                # Retries are made by retries.py, which also covers the direct HTTP path
+                max_retries=0,
+            )
+            self._sdk["anthropic"] = client
+        return client
+
+    def openai(self, api_key):
+        client = self._sdk.get("openai")
+        if client is None:
+            from openai import AsyncOpenAI
+            client = AsyncOpenAI(
+                api_key=api_key,
+                base_url=PROVIDER_BASE_URLS["openai"] + "/v1",
+                http_client=self.http("openai"),
+                # Retries are made by retries.py, which also covers the direct HTTP path
+                max_retries=0,
+            )
+            self._sdk["openai"] = client
+        return client
+
+    async def aclose(self):
+        self._closed = True
+        http_clients = list(self._http.values())
+        self._http.clear()
+        self._sdk.clear()
+        for client in http_clients:
+            try:
+                await client.aclose()
+            except Exception as e:
+                logger.warning("Could not close HTTP client: %s", e)
+
+
+_clients = None
+_clients_pid = None
+_clients_lock = threading.Lock()
+
+
+def get_clients():
+    """Return this worker's client registry, creating it on first use."""
+    global _clients, _clients_pid
+    pid = os.getpid()
+    if _clients is not None and _clients_pid == pid:
+        return _clients
+    with _clients_lock:
+        # A forked worker must not reuse sockets inherited from its parent
+        if _clients is None or _clients_pid != pid:
+            _clients = ProviderClients()
+            _clients_pid = pid
+        return _clients
+
+
+def close_clients():
+    global _clients
+    with _clients_lock:
+        clients, _clients = _clients, None
+    if clients is not None and _clients_pid == os.getpid():
+        clients.close()
+
+
+# One async registry per event loop, since httpx.AsyncClient cannot be shared across loops
+_async_clients = weakref.WeakKeyDictionary()
+
+
+def get_async_clients():
+    """Return the async client registry for the running event loop."""
+    import asyncio
+    loop = asyncio.get_running_loop()
+    clients = _async_clients.get(loop)
+    if clients is None:
+        clients = AsyncProviderClients()
+        _async_clients[loop] = clients
+    return clients
+
+
+async def aclose_async_clients():
+    import asyncio
+    clients = _async_clients.pop(asyncio.get_running_loop(), None)
+    if clients is not None:
+        await clients.aclose()
+
+
+atexit.register(close_clients)
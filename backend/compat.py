@@ -0,0 +1,24 @@
+import logging
+import sys
+
+# Fix for cgi module in Python 3.13
+if sys.version_info >= (3, 13):
+    sys.modules['cgi'] = type('CGIModule', (), {
+        'parse_header': lambda header: (header, {})
+    })
+
+# Patch for HTTPTransport socket_options incompatibility
+try:
+    import httpx
+    original_init = httpx.HTTPTransport.__init__
+    
+    def patched_init(self, *args, **kwargs):
+        # Remove socket_options if present (incompatible with older httpx versions)
+        if 'socket_options' in kwargs:
+            del kwargs['socket_options']
+        return original_init(self, *args, **kwargs)
+    
+    httpx.HTTPTransport.__init__ = patched_init
+except Exception as e:
+    logging.getLogger(__name__).warning("Could not patch HTTPTransport: %s", e)
+
@@ -0,0 +1,90 @@
+import asyncio
+import contextlib
+import contextvars
+import os
+import time
+
+
+class DeadlineConfig:
+    # Seconds a /chat or /code-generate request may take in total, across every retry and fallback
+    DEFAULT = float(os.getenv("REQUEST_DEADLINE", "60"))
+    # Longest budget a client may ask for
+    MAX = float(os.getenv("REQUEST_DEADLINE_MAX", "300"))
+    HEADER = "X-Request-Timeout"
+
+
+class InvalidTimeout(ValueError):
+    status_code = 400
+
+
+class DeadlineExceeded(Exception):
+    status_code = 504
+
+    def __init__(self, message="The request ran out of time before a provider answered"):
+        super().__init__(message)
+
+
+# Absolute time.monotonic() deadline of the request being served; copied into its tasks and threads
+_deadline = contextvars.ContextVar("deadline", default=None)
+
+
+def request_budget(data, headers):
+    """Seconds the client gave the request: the "timeout" field, the X-Request-Timeout header or the default.
+
+    Raises InvalidTimeout for a value that is not a positive number.
+    """
+    value = data.get('timeout')
+    if value is None:
+        value = headers.get(DeadlineConfig.HEADER)
+    if value is None:
+        return DeadlineConfig.DEFAULT
+    try:
+        seconds = float(value)
+    except (TypeError, ValueError):
+        raise InvalidTimeout("timeout must be a number of seconds")
+    if not seconds > 0:
+        raise InvalidTimeout("timeout must be greater than 0")
+    return min(seconds, DeadlineConfig.MAX)
+
+
+@contextlib.contextmanager
+def scope(deadline):
+    """Run the code inside under an absolute time.monotonic() deadline; an outer, earlier one still wins."""
+    outer = _deadline.get()
+    token = _deadline.set(deadline if outer is None else min(outer, deadline))
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def remaining():
+    """Seconds left before the current deadline, or None when there is none."""
+    deadline = _deadline.get()
+    return None if deadline is None else deadline - time.monotonic()
+
+
+def expired():
+    left = remaining()
+    return left is not None and left <= 0
+
+
+def clamp(seconds):
+    """The smaller of seconds and the time left; raises DeadlineExceeded once the deadline has passed."""
+    left = remaining()
+    if left is None:
+        return seconds
+    if left <= 0:
+        raise DeadlineExceeded()
+    return left if seconds is None else min(seconds, left)
+
+
+async def within(awaitable):
+    """Await with the current deadline, cancelling the work (and its upstream calls) when it passes."""
+    left = remaining()
+    if left is None:
+        return await awaitable
+    try:
+        return await asyncio.wait_for(awaitable, max(left, 0))
+    except asyncio.TimeoutError:
+        raise DeadlineExceeded() from None
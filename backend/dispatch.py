@@ -0,0 +1,291 @@
+import asyncio
+import time
+
+import deadline
+from background import run_async
+from cache import cache_key, cache_mode, response_cache
+from deadline import request_budget
+from hedging import ahedged_chain, parse_hedge_delay, wants_hedging
+from idempotency import idempotency
+from sessions import open_session, session_store
+from similarity import similar_cache, wants_similar
+from singleflight import AsyncSingleFlight, SingleFlight, parse_coalesce
+from speculative import aspeculative_chain, wants_candidates
+from tracing import span
+from validation import check, valid_code
+from providers import (
+    AUTO_CHAIN,
+    TASK_PARAMS,
+    Completion,
+    acomplete_chain,
+    build_code_prompt,
+    catalog,
+    complete_chain,
+    resolve_route,
+    strip_code_fences,
+)
+
+
+class GenerationRequest:
+    """A parsed /chat or /code-generate request and the way it will be served."""
+
+    def __init__(self, task, data, headers):
+        self.task = task
+        # The whole request, every retry and fallback included, must finish by this time.monotonic() (raises InvalidTimeout)
+        self.deadline = time.monotonic() + request_budget(data, headers)
+        self.requested_model = data.get('model', 'auto')
+        if self.requested_model not in ('auto', 'mock'):
+            # Rejected before any cache lookup or provider call (raises UnknownModel)
+            catalog.check(self.requested_model)
+        if task == "code":
+            self.prompt = data['prompt']
+            self.language = data.get('language', '')
+            content = build_code_prompt(self.prompt, self.language)
+        else:
+            self.prompt = data['content']
+            self.language = ''
+            content = self.prompt
+        # A chat session supplies the earlier turns, trimmed to its token budget (raises SessionNotFound)
+        self.session = open_session(data) if task == "chat" else None
+        if self.session is not None:
+            self.session.add("user", content)
+            self.session.trim()
+            self.messages = self.session.messages()
+        else:
+            self.messages = [{"role": "user", "content": content}]
+        self.chain, self.routing = resolve_route(self.requested_model, self.language)
+        self.hedge = wants_hedging(data, self.requested_model)
+        # Raises InvalidTimeout for a delay that is not a finite number of seconds
+        self.hedge_delay = parse_hedge_delay(data)
+        # Several code candidates raced at once, the first that passes the language's validator winning
+        self.candidates = wants_candidates(data, task)
+        # A session answer depends on the whole history, so it is neither cached nor shared
+        self.cache_mode = "bypass" if self.session is not None else cache_mode(task, data, headers)
+        # Raises InvalidFlag unless "coalesce" is a boolean
+        self.coalesce = parse_coalesce(data) and self.session is None
+        # On an exact-cache miss, serve the answer to a near-duplicate code prompt
+        self.similar = self.cache_mode == "use" and wants_similar(data, task)
+        # Optional per-provider semaphores bounding concurrent upstream calls (see batch.py)
+        self.limits = None
+        # A repeated key gets the first request's answer instead of a second provider call
+        self.idempotency_key = headers.get('Idempotency-Key') if idempotency.enabled() else None
+
+    def cache_key(self):
+        if self.requested_model == 'auto':
+            # The router may pick any provider, so auto requests share one key across them
+            params = [TASK_PARAMS[self.task][provider] for provider in AUTO_CHAIN]
+            return cache_key(self.task, self.prompt, self.language, 'auto', params)
+        provider, model = self.chain[0]
+        return cache_key(self.task, self.prompt, self.language, model, TASK_PARAMS[self.task][provider])
+
+    def flight_key(self):
+        # A request for validated candidates must not share a plain request's unvalidated answer
+        candidates = f":{self.candidates}" if self.candidates > 1 else ""
+        return f"{self.requested_model}:{self.cache_key()}{candidates}"
+
+    def fingerprint(self):
+        # What a reused Idempotency-Key must match; a session retry matches even after the first attempt saved
+        session_id = self.session.id if self.session is not None else ""
+        return f"{self.task}:{session_id}:{self.flight_key()}"
+
+    def remember(self, completion):
+        """Record the answer in the request's session, if it has one."""
+        if self.session is None:
+            return
+        self.session.add("assistant", completion.text)
+        self.session.trim()
+        session_store.save(self.session)
+        completion.meta["session_id"] = self.session.id
+
+    async def aremember(self, completion):
+        """remember() for the event loop: a shared-store write runs on a worker thread."""
+        if self.session is None:
+            return
+        self.session.add("assistant", completion.text)
+        self.session.trim()
+        await session_store.asave(self.session)
+        completion.meta["session_id"] = self.session.id
+
+
+async def arequest(task, data, headers):
+    """GenerationRequest for the event loop.
+
+    Continuing a session kept in the shared store (see open_session) reads it,
+    so the request is then built on a worker thread.
+    """
+    if task == "chat" and data.get('session_id') and session_store.shared():
+        return await asyncio.to_thread(GenerationRequest, task, data, headers)
+    return GenerationRequest(task, data, headers)
+
+
+# Identical requests arriving while one is in flight share its provider call
+coalescer = SingleFlight()
+async_coalescer = AsyncSingleFlight()
+
+
+def coalescing_stats():
+    stats = coalescer.stats()
+    for name, value in async_coalescer.stats().items():
+        stats[name] = stats.get(name, 0) + value
+    return stats
+
+
+def _skips_cache(request):
+    if request.cache_mode == "bypass":
+        response_cache.count("bypassed")
+        return True
+    if request.cache_mode == "refresh":
+        response_cache.count("refreshed")
+        return True
+    return False
+
+
+def _cached(request):
+    if _skips_cache(request):
+        return None
+    with span("cache") as lookup:
+        value = response_cache.get(request.cache_key())
+        lookup.set(hit=value is not None)
+    return _cache_hit(request, value)
+
+
+async def _acached(request):
+    if _skips_cache(request):
+        return None
+    with span("cache") as lookup:
+        value = await response_cache.aget(request.cache_key())
+        lookup.set(hit=value is not None)
+    return _cache_hit(request, value)
+
+
+def _cache_hit(request, value):
+    similarity = None
+    if value is None and request.similar:
+        with span("similar_cache") as lookup:
+            found = similar_cache.get(request.prompt, request.language, request.requested_model)
+            lookup.set(hit=found is not None)
+        if found is not None:
+            value, similarity = found
+    if value is None:
+        return None
+    if request.candidates > 1 and not valid_code(request.language, strip_code_fences(value["text"])):
+        # Asking for candidates asks for code that passes validation, so a cached answer that fails is regenerated
+        return None
+    completion = Completion(value["text"], value["provider"], value["model"], value["usage"])
+    completion.meta["cached"] = True
+    if similarity is not None:
+        completion.meta["similarity"] = round(similarity, 3)
+    return completion
+
+
+def _store(request, completion):
+    if request.cache_mode == "bypass":
+        return
+    value = {
+        "text": completion.text,
+        "provider": completion.provider,
+        "model": completion.model,
+        "usage": completion.usage,
+    }
+    response_cache.set(request.cache_key(), value)
+    if request.task == "code":
+        # Indexed for every code answer, so any request that asks for near-duplicates can find it
+        similar_cache.set(request.cache_key(), request.prompt, request.language, request.requested_model, value)
+
+
+def _shared(completion):
+    completion = completion.copy()
+    completion.meta["coalesced"] = True
+    return completion
+
+
+def _validated(request, completion):
+    # Feeds the per-model validation stats the router ranks code requests with
+    if request.task == "code":
+        check(completion, request.language, strip_code_fences(completion.text))
+    return completion
+
+
+def _dispatch(request):
+    if request.candidates > 1:
+        # Candidates validate themselves as they arrive
+        completion = run_async(deadline.within(
+            aspeculative_chain(request.chain, request.candidates, request.messages, request.language)
+        ))
+    elif request.hedge:
+        # Race the auto chain instead of waiting on each provider in turn
+        completion = _validated(request, run_async(deadline.within(
+            ahedged_chain(request.chain, request.task, request.messages, request.hedge_delay)
+        )))
+    else:
+        completion = _validated(request, complete_chain(request.chain, request.task, request.messages))
+    _store(request, completion)
+    request.remember(completion)
+    return completion
+
+
+def _routed(request, completion):
+    if request.routing is not None:
+        completion.meta["routing"] = request.routing
+    return completion
+
+
+def generate(request):
+    """Serve a request from the cache or the provider chain; None if no provider is available."""
+    if not request.chain:
+        return None
+    with deadline.scope(request.deadline):
+        if request.idempotency_key:
+            return idempotency.run(request.idempotency_key, request.fingerprint(), lambda: _generate(request))
+        return _generate(request)
+
+
+def _generate(request):
+    completion = _cached(request)
+    if completion is not None:
+        return completion
+
+    if not request.coalesce:
+        return _routed(request, _dispatch(request))
+    completion, shared = coalescer.do(request.flight_key(), lambda: _dispatch(request))
+    return _routed(request, _shared(completion) if shared else completion)
+
+
+async def _adispatch(request):
+    if request.candidates > 1:
+        completion = await aspeculative_chain(
+            request.chain, request.candidates, request.messages, request.language, request.limits
+        )
+    elif request.hedge:
+        completion = _validated(request, await ahedged_chain(
+            request.chain, request.task, request.messages, request.hedge_delay, request.limits
+        ))
+    else:
+        completion = _validated(request, await acomplete_chain(request.chain, request.task, request.messages, request.limits))
+    _store(request, completion)
+    await request.aremember(completion)
+    return completion
+
+
+async def agenerate(request):
+    """Async counterpart of generate()."""
+    if not request.chain:
+        return None
+    with deadline.scope(request.deadline):
+        # Cancels the provider calls still running when the deadline passes
+        if request.idempotency_key:
+            return await deadline.within(
+                idempotency.arun(request.idempotency_key, request.fingerprint(), lambda: _agenerate(request))
+            )
+        return await deadline.within(_agenerate(request))
+
+
+async def _agenerate(request):
+    completion = await _acached(request)
+    if completion is not None:
+        return completion
+
+    if not request.coalesce:
+        return _routed(request, await _adispatch(request))
+    completion, shared = await async_coalescer.do(request.flight_key(), lambda: _adispatch(request))
+    return _routed(request, _shared(completion) if shared else completion)
@@ -0,0 +1,164 @@
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class BreakerConfig:
+    # Rolling window the error and timeout rates are computed over, in seconds
+    WINDOW = float(os.getenv("BREAKER_WINDOW", "60"))
+    # Calls needed in the window before the breaker may trip
+    MIN_CALLS = int(os.getenv("BREAKER_MIN_CALLS", "5"))
+    ERROR_RATE = float(os.getenv("BREAKER_ERROR_RATE", "0.5"))
+    TIMEOUT_RATE = float(os.getenv("BREAKER_TIMEOUT_RATE", "0.3"))
+    # Seconds an open breaker waits before letting probes through
+    OPEN_SECONDS = float(os.getenv("BREAKER_OPEN_SECONDS", "30"))
+    HALF_OPEN_PROBES = int(os.getenv("BREAKER_HALF_OPEN_PROBES", "1"))
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker:
+    """Closed/open/half-open state machine for one provider.
+
+    A manual override (see force) pins the breaker open or closed regardless
+    of the calls it records.
+    """
+
+    def __init__(self, name, config=BreakerConfig):
+        self.name = name
+        self.config = config
+        self.state = CLOSED
+        self.forced = None
+        self.opened_at = None
+        self._probes = 0
+        self._calls = deque(maxlen=10000)
+        self._lock = threading.Lock()
+
+    def _trim(self, now):
+        cutoff = now - self.config.WINDOW
+        while self._calls and self._calls[0][0] < cutoff:
+            self._calls.popleft()
+
+    def _open(self, now):
+        self.state = OPEN
+        self.opened_at = now
+        self._probes = 0
+
+    def available(self):
+        """Whether a call would be let through right now, without reserving a probe."""
+        with self._lock:
+            if self.forced is not None:
+                return self.forced == CLOSED
+            if self.state == OPEN:
+                return time.monotonic() - self.opened_at >= self.config.OPEN_SECONDS
+            if self.state == HALF_OPEN:
+                return self._probes < self.config.HALF_OPEN_PROBES
+            return True
+
+    def acquire(self):
+        """Reserve a call; returns True if it is a half-open probe. Raises CircuitOpenError."""
+        now = time.monotonic()
+        with self._lock:
+            if self.forced == OPEN:
+                raise CircuitOpenError(f"{self.name} is marked down")
+            if self.forced == CLOSED:
+                return False
+            if self.state == OPEN and now - self.opened_at >= self.config.OPEN_SECONDS:
+                self.state = HALF_OPEN
+            if self.state == OPEN:
+                raise CircuitOpenError(f"{self.name} circuit is open")
+            if self.state == HALF_OPEN:
+                if self._probes >= self.config.HALF_OPEN_PROBES:
+                    raise CircuitOpenError(f"{self.name} circuit is half-open and already probing")
+                self._probes += 1
+                return True
+            return False
+
+    def release(self, probe, outcome):
+        """Record a call's outcome: "success", "error", "timeout", or None if it was cancelled."""
+        now = time.monotonic()
+        with self._lock:
+            if probe:
+                self._probes = max(0, self._probes - 1)
+            if outcome is None:
+                return
+            if self.state == HALF_OPEN and probe:
+                if outcome == "success":
+                    self.state = CLOSED
+                    self._calls.clear()
+                else:
+                    self._open(now)
+                return
+
+            self._calls.append((now, outcome))
+            if self.state != CLOSED:
+                return
+            self._trim(now)
+            total = len(self._calls)
+            if total < self.config.MIN_CALLS:
+                return
+            errors = sum(1 for _, result in self._calls if result != "success")
+            timeouts = sum(1 for _, result in self._calls if result == "timeout")
+            if errors / total >= self.config.ERROR_RATE or timeouts / total >= self.config.TIMEOUT_RATE:
+                logger.warning("Circuit for %s opened: %d/%d failed, %d timed out", self.name, errors, total, timeouts,
+                               extra={"provider": self.name})
+                self._open(now)
+
+    def force(self, state):
+        """Pin the breaker OPEN or CLOSED, or pass None to go back to automatic tracking."""
+        with self._lock:
+            self.forced = state
+            if state is None:
+                self.state = CLOSED
+                self._calls.clear()
+
+    def snapshot(self):
+        now = time.monotonic()
+        with self._lock:
+            self._trim(now)
+            total = len(self._calls)
+            errors = sum(1 for _, result in self._calls if result != "success")
+            timeouts = sum(1 for _, result in self._calls if result == "timeout")
+            snapshot = {
+                "state": self.forced or self.state,
+                "forced": self.forced is not None,
+                "calls": total,
+                "error_rate": errors / total if total else 0.0,
+                "timeout_rate": timeouts / total if total else 0.0,
+            }
+            if self.state == OPEN and self.forced is None:
+                snapshot["retry_in"] = max(0.0, self.config.OPEN_SECONDS - (now - self.opened_at))
+            return snapshot
+
+
+def is_timeout(error):
+    # httpx and both SDKs name their timeout exceptions *Timeout*; a ProviderError says so itself
+    return "Timeout" in type(error).__name__ or getattr(error, "timeout", False) is True
+
+
+breakers = {
+    "anthropic": CircuitBreaker("Claude"),
+    "openai": CircuitBreaker("OpenAI"),
+    "deepseek": CircuitBreaker("DeepSeek"),
+}
+
+
+# Exported as 0 (closed), 1 (half-open) or 2 (open)
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+metrics.register_collector(
+    "provider_circuit_state", "gauge", "Circuit breaker state per provider: 0 closed, 1 half-open, 2 open",
+    lambda: [({"provider": provider}, STATE_VALUES[breaker.forced or breaker.state])
+             for provider, breaker in breakers.items()]
+)
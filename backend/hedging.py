@@ -0,0 +1,112 @@
+import asyncio
+import logging
+import math
+import os
+
+import providers
+from admission import admission
+from deadline import InvalidTimeout
+from latency import latency
+
+logger = logging.getLogger(__name__)
+
+
+def _env_float(name):
+    value = os.getenv(name)
+    return float(value) if value else None
+
+
+class HedgeConfig:
+    # Hedge every model="auto" request unless the request says otherwise
+    ENABLED = os.getenv("HEDGE_AUTO", "").strip().lower() in ("1", "true", "yes", "on")
+    # Fixed hedge delay in seconds; when unset the provider's observed p95 latency is used
+    DELAY = _env_float("HEDGE_DELAY")
+    PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", "0.95"))
+    # Samples needed before the percentile is trusted, and the delay used until then
+    MIN_SAMPLES = int(os.getenv("HEDGE_MIN_SAMPLES", "20"))
+    DEFAULT_DELAY = float(os.getenv("HEDGE_DEFAULT_DELAY", "2.0"))
+
+
+def wants_hedging(data, requested_model):
+    if requested_model != 'auto':
+        return False
+    return bool(data.get('hedge', HedgeConfig.ENABLED))
+
+
+def parse_hedge_delay(data):
+    """The request's "hedge_delay" in seconds, or None to pick one per provider.
+
+    Raises InvalidTimeout for a value that is not a finite number of seconds, 0 or more.
+    """
+    value = data.get('hedge_delay')
+    if value is None:
+        return None
+    try:
+        seconds = float(value)
+    except (TypeError, ValueError):
+        raise InvalidTimeout("hedge_delay must be a number of seconds")
+    if not 0 <= seconds < math.inf:
+        raise InvalidTimeout("hedge_delay must be a finite number of seconds, 0 or more")
+    return seconds
+
+
+def hedge_delay(provider, requested_delay=None):
+    if requested_delay is not None:
+        return requested_delay
+    if HedgeConfig.DELAY is not None:
+        return HedgeConfig.DELAY
+    if latency.count(provider) >= HedgeConfig.MIN_SAMPLES:
+        return latency.percentile(provider, HedgeConfig.PERCENTILE)
+    return HedgeConfig.DEFAULT_DELAY
+
+
+async def _limited(limits, provider, model, task, messages, wait):
+    async with providers.concurrency_limit(limits, provider), admission.aslot(provider, wait=wait):
+        return await providers.acomplete(provider, model, task, messages)
+
+
+async def ahedged_chain(chain, task, messages, requested_delay=None, limits=None):
+    """Race the providers in chain, starting the next one whenever the latest is slow or fails.
+
+    The first successful completion wins and every other attempt is cancelled.
+    Returns None if the chain is empty.
+    """
+    if not chain:
+        return None
+    remaining = list(chain)
+    running = {}
+    started = []
+    last_error = None
+
+    def launch():
+        provider, model = remaining.pop(0)
+        started.append(provider)
+        # As in a plain chain, only the last provider queues for a slot
+        attempt = asyncio.ensure_future(_limited(limits, provider, model, task, messages, wait=not remaining))
+        running[attempt] = provider
+
+    launch()
+    try:
+        while running:
+            timeout = hedge_delay(started[-1], requested_delay) if remaining else None
+            done, _ = await asyncio.wait(running, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                # Nothing back within the hedge delay, start the next provider alongside
+                launch()
+                continue
+            for attempt in done:
+                provider = running.pop(attempt)
+                try:
+                    completion = attempt.result()
+                except Exception as e:
+                    logger.warning("%s API error: %s", providers.PROVIDER_NAMES[provider], e, extra={"provider": provider})
+                    last_error = e
+                    continue
+                completion.meta["hedge"] = {"started": started, "winner": provider}
+                return completion
+            if remaining:
+                launch()
+        raise last_error
+    finally:
+        for attempt in running:
+            attempt.cancel()
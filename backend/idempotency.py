@@ -0,0 +1,134 @@
+import asyncio
+import os
+import time
+
+import deadline
+from providers import Completion
+from shared_store import shared_store
+
+
+class IdempotencyConfig:
+    # Seconds a finished request's answer is replayed for a repeated Idempotency-Key
+    TTL = float(os.getenv("IDEMPOTENCY_TTL", "86400"))
+    # Seconds a request holds its key; after this a worker that died mid-request no longer blocks retries
+    LOCK_TIMEOUT = float(os.getenv("IDEMPOTENCY_LOCK_TIMEOUT", "300"))
+    # Seconds a repeat waits for the original request to finish before getting a 409
+    WAIT = float(os.getenv("IDEMPOTENCY_WAIT", "30"))
+    POLL_INTERVAL = 0.05
+    MAX_KEY_LENGTH = 255
+
+
+class IdempotencyError(Exception):
+    def __init__(self, message, status_code):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+CLAIMED = object()
+
+
+class IdempotencyRecords:
+    """Answers stored under client-supplied Idempotency-Keys, shared by every worker.
+
+    The first request with a key claims it and calls the provider; a repeat
+    gets the stored answer, or waits for it while the first is still running.
+    Reusing a key for a different request is rejected.
+    """
+
+    NAMESPACE = "idempotency"
+
+    def __init__(self, store=shared_store, config=IdempotencyConfig):
+        self.store = store
+        self.config = config
+
+    def enabled(self):
+        return self.store is not None
+
+    def _check(self, key):
+        if len(key) > self.config.MAX_KEY_LENGTH:
+            raise IdempotencyError(f"Idempotency-Key must be at most {self.config.MAX_KEY_LENGTH} characters", 400)
+
+    def _begin(self, key, fingerprint):
+        """CLAIMED if this request now owns the key, the stored answer if there is one, else None."""
+        row = self.store.get(self.NAMESPACE, key)
+        if row is None:
+            pending = {"fingerprint": fingerprint, "state": "pending"}
+            if self.store.add(self.NAMESPACE, key, pending, time.time() + self.config.LOCK_TIMEOUT):
+                return CLAIMED
+            row = self.store.get(self.NAMESPACE, key)
+            if row is None:
+                return None
+        record = row[0]
+        if record["fingerprint"] != fingerprint:
+            self.store.incr("idempotency.mismatched")
+            raise IdempotencyError("Idempotency-Key was already used for a different request", 422)
+        if record["state"] != "done":
+            return None
+        self.store.incr("idempotency.replayed")
+        completion = Completion(record["text"], record["provider"], record["model"], record["usage"])
+        completion.meta.update(record["meta"])
+        completion.meta["idempotent_replay"] = True
+        return completion
+
+    def _finish(self, key, fingerprint, completion):
+        self.store.set(self.NAMESPACE, key, {
+            "fingerprint": fingerprint,
+            "state": "done",
+            "text": completion.text,
+            "provider": completion.provider,
+            "model": completion.model,
+            "usage": completion.usage,
+            "meta": completion.meta,
+        }, time.time() + self.config.TTL)
+
+    def _in_progress(self):
+        self.store.incr("idempotency.conflicts")
+        return IdempotencyError("A request with this Idempotency-Key is still in progress", 409)
+
+    def run(self, key, fingerprint, produce):
+        self._check(key)
+        wait_until = time.monotonic() + deadline.clamp(self.config.WAIT)
+        while True:
+            result = self._begin(key, fingerprint)
+            if result is CLAIMED:
+                break
+            if result is not None:
+                return result
+            if time.monotonic() >= wait_until:
+                raise self._in_progress()
+            time.sleep(self.config.POLL_INTERVAL)
+
+        try:
+            completion = produce()
+        except BaseException:
+            # Let a retry with the same key try again
+            self.store.delete(self.NAMESPACE, key)
+            raise
+        self._finish(key, fingerprint, completion)
+        return completion
+
+    async def arun(self, key, fingerprint, produce):
+        """Async counterpart of run(); produce returns an awaitable."""
+        self._check(key)
+        wait_until = time.monotonic() + deadline.clamp(self.config.WAIT)
+        while True:
+            # Shared-store reads and writes run on a worker thread, off the event loop
+            result = await asyncio.to_thread(self._begin, key, fingerprint)
+            if result is CLAIMED:
+                break
+            if result is not None:
+                return result
+            if time.monotonic() >= wait_until:
+                raise self._in_progress()
+            await asyncio.sleep(self.config.POLL_INTERVAL)
+
+        try:
+            completion = await produce()
+        except BaseException:
+            await asyncio.to_thread(self.store.delete, self.NAMESPACE, key)
+            raise
+        await asyncio.to_thread(self._finish, key, fingerprint, completion)
+        return completion
+
+
+idempotency = IdempotencyRecords()
@@ -0,0 +1,399 @@
+import asyncio
+import contextvars
+import logging
+import math
+import os
+import queue
+import secrets
+import threading
+import time
+
+import logs
+from admission import Saturated
+from catalog import UnknownModel
+from deadline import DeadlineExceeded, InvalidTimeout, request_budget
+from dispatch import GenerationRequest, generate
+from hedging import parse_hedge_delay
+from metrics import metrics
+from providers import catalog, chat_error, code_error, strip_code_fences
+from sessions import SessionNotFound
+from shared_store import shared_store
+from singleflight import InvalidFlag, parse_coalesce
+from tracing import tracer
+
+logger = logging.getLogger(__name__)
+
+
+class JobsConfig:
+    # Threads per worker process running jobs
+    WORKERS = int(os.getenv("JOBS_WORKERS", "4"))
+    # Jobs waiting for a thread in one worker process; beyond this POST /jobs gets a 503
+    QUEUE_SIZE = int(os.getenv("JOBS_QUEUE_SIZE", "100"))
+    # Seconds a job and its result are kept
+    TTL = float(os.getenv("JOBS_TTL", "3600"))
+    # Longest a GET /jobs/<id>?wait= long-poll is held open
+    MAX_WAIT = float(os.getenv("JOBS_MAX_WAIT", "30"))
+    # Runs of a job cut short by a stopped worker before the job is failed instead of run again
+    MAX_ATTEMPTS = int(os.getenv("JOBS_MAX_ATTEMPTS", "2"))
+    # Seconds between scans for jobs left behind by a stopped worker
+    RECOVERY_INTERVAL = float(os.getenv("JOBS_RECOVERY_INTERVAL", "30"))
+    POLL_INTERVAL = 0.1
+    # Retry-After sent with a job that has not finished yet
+    RETRY_AFTER = 1
+
+
+TASKS = {"code": "prompt", "chat": "content"}
+
+QUEUED, RUNNING, SUCCEEDED, FAILED = "queued", "running", "succeeded", "failed"
+
+
+class JobNotFound(Exception):
+    pass
+
+
+class JobQueueFull(Exception):
+    status_code = 503
+
+    def __init__(self, retry_after):
+        super().__init__(f"The job queue is full; retry after {math.ceil(retry_after)}s")
+        self.retry_after = retry_after
+
+
+def parse_job(data):
+    """Return (task, request, error) for a POST /jobs body: {"task": "code" or "chat", ...the endpoint's fields}."""
+    if not isinstance(data, dict) or not data:
+        return None, None, "Missing job in request"
+    task = data.get('task', 'code')
+    if task not in TASKS:
+        return None, None, f"task must be one of: {', '.join(TASKS)}"
+    request = {key: value for key, value in data.items() if key != 'task'}
+    if TASKS[task] not in request:
+        return None, None, f"Missing {TASKS[task]} in request"
+    return task, request, None
+
+
+def execute(task, data):
+    """(status, body) the /code-generate or /chat endpoint would have answered the request with."""
+    error_body = code_error if task == "code" else chat_error
+    try:
+        completion = generate(GenerationRequest(task, data, {}))
+        if completion is None:
+            if task == "code":
+                return 503, {"code": "# No model available to generate code", "model": "mock"}
+            return 503, {"response": "The requested AI model is not available.", "model": "mock"}
+        if task == "code":
+            body = {"code": strip_code_fences(completion.text)}
+        else:
+            body = {"response": completion.text}
+        return 200, dict(body, model=completion.model, provider=completion.provider, **completion.meta)
+    except SessionNotFound as e:
+        return 404, {"error": str(e)}
+    except (InvalidFlag, InvalidTimeout, UnknownModel) as e:
+        return e.status_code, {"error": str(e)}
+    except Saturated as e:
+        body, status_code = error_body(e)
+        return status_code, dict(body, retry_after=math.ceil(e.retry_after))
+    except DeadlineExceeded as e:
+        body, status_code = error_body(e)
+        return status_code, body
+    except Exception as e:
+        logger.exception("Error in %s job: %s", task, e)
+        body, status_code = error_body(e)
+        return status_code, body
+
+
+def view(job):
+    """A job as GET /jobs/<id> shows it; the request itself and its owner stay internal."""
+    entry = {
+        "job_id": job["id"],
+        "task": job["task"],
+        "state": job["state"],
+        "created_at": job["created_at"],
+        "started_at": job["started_at"],
+        "finished_at": job["finished_at"],
+        "attempts": job["attempts"],
+    }
+    if job["state"] in (SUCCEEDED, FAILED):
+        entry["status"] = job["status"]
+        entry["result"] = job["result"]
+    return entry
+
+
+def finished(job):
+    return job["state"] in (SUCCEEDED, FAILED)
+
+
+def job_headers(job):
+    """Retry-After for a job that has not finished, as a hint for when to poll again."""
+    return {} if finished(job) else {"Retry-After": str(JobsConfig.RETRY_AFTER)}
+
+
+class JobStore:
+    """Job records, in the shared store when there is one so they outlive the worker that took them.
+
+    Without a shared store they live in this process only and go with it.
+    """
+
+    NAMESPACE = "jobs"
+
+    def __init__(self, ttl=JobsConfig.TTL, store=shared_store):
+        self.ttl = ttl
+        self._shared = store
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def shared(self):
+        return self._shared is not None
+
+    def get(self, job_id):
+        if self._shared is not None:
+            row = self._shared.get(self.NAMESPACE, job_id)
+            return row[0] if row is not None else None
+        with self._lock:
+            entry = self._jobs.get(job_id)
+            if entry is not None and entry[0] <= time.time():
+                del self._jobs[job_id]
+                entry = None
+        return entry[1] if entry is not None else None
+
+    def put(self, job):
+        expires_at = time.time() + self.ttl
+        if self._shared is not None:
+            self._shared.set(self.NAMESPACE, job["id"], job, expires_at)
+            return
+        with self._lock:
+            self._jobs[job["id"]] = (expires_at, job)
+
+    def replace(self, current, job):
+        """Store job only if the record is still `current`; returns whether it was stored."""
+        expires_at = time.time() + self.ttl
+        if self._shared is not None:
+            return self._shared.swap(self.NAMESPACE, job["id"], current, job, expires_at)
+        with self._lock:
+            entry = self._jobs.get(job["id"])
+            if entry is None or entry[1] != current:
+                return False
+            self._jobs[job["id"]] = (expires_at, job)
+            return True
+
+    def all(self):
+        if self._shared is not None:
+            return [job for _, job, _ in self._shared.scan(self.NAMESPACE)]
+        now = time.time()
+        with self._lock:
+            return [job for expires_at, job in self._jobs.values() if expires_at > now]
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        # Running, but owned by another user
+        return True
+    return True
+
+
+class JobPool:
+    """Runs queued jobs on a bounded pool of threads in each worker process.
+
+    A job belongs to the process that queued it. Its record names that process,
+    so when the process stops (a crash, a deploy, a gunicorn worker recycle),
+    any other process finds the job during its next scan or when a client polls
+    it, claims it and runs it again, up to MAX_ATTEMPTS runs.
+    """
+
+    def __init__(self, store=None, config=JobsConfig):
+        self.store = store or JobStore(config.TTL)
+        self.config = config
+        self._pid = None
+        self._owner = None
+        self._queue = None
+        self._finished = threading.Condition()
+        self._running = 0
+        self._lock = threading.Lock()
+
+    def _start(self):
+        # Threads do not survive a fork, so each process starts its own on first use
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            # Tells this process apart from an earlier one that had the same pid
+            self._owner = f"{os.getpid()}:{secrets.token_hex(4)}"
+            self._queue = queue.Queue()
+            self._finished = threading.Condition()
+            self._running = 0
+            for number in range(self.config.WORKERS):
+                threading.Thread(target=self._work, name=f"jobs-{number}", daemon=True).start()
+            threading.Thread(target=self._recover_forever, name="jobs-recovery", daemon=True).start()
+            self._pid = os.getpid()
+
+    def _alive(self, owner):
+        if owner == self._owner:
+            return True
+        pid = int(owner.split(":")[0])
+        # Our pid with another token is a stopped process whose pid we were given
+        return pid != os.getpid() and _pid_alive(pid)
+
+    def submit(self, task, data):
+        """Queue a job and return its record; raises InvalidFlag, InvalidTimeout, UnknownModel or JobQueueFull.
+
+        The request is checked now, so a bad one is refused instead of failing later.
+        """
+        request_budget(data, {})
+        parse_hedge_delay(data)
+        parse_coalesce(data)
+        model = data.get('model', 'auto')
+        if model not in ('auto', 'mock'):
+            catalog.check(model)
+        self._start()
+        with self._lock:
+            if self._queue.qsize() >= self.config.QUEUE_SIZE:
+                metrics.inc("jobs_total", {"task": task, "outcome": "rejected"})
+                raise JobQueueFull(self.config.RETRY_AFTER)
+            job = {
+                "id": secrets.token_urlsafe(16),
+                "task": task,
+                "state": QUEUED,
+                "request": data,
+                "owner": self._owner,
+                "attempts": 0,
+                "created_at": time.time(),
+                "started_at": None,
+                "finished_at": None,
+                "status": None,
+                "result": None,
+            }
+            self.store.put(job)
+            self._queue.put(job["id"])
+        metrics.inc("jobs_total", {"task": task, "outcome": "queued"})
+        return job
+
+    def _work(self):
+        while True:
+            job_id = self._queue.get()
+            try:
+                # A fresh context, so no request ID, trace or deadline carries over from the previous job
+                contextvars.Context().run(self._run, job_id)
+            except Exception as e:
+                logger.exception("Job %s could not be run: %s", job_id, e)
+
+    def _run(self, job_id):
+        job = self.store.get(job_id)
+        if job is None or job["state"] != QUEUED or job["owner"] != self._owner:
+            return
+        running = dict(job, state=RUNNING, started_at=time.time(), attempts=job["attempts"] + 1)
+        # Lost only if another process claimed the job in between
+        if not self.store.replace(job, running):
+            return
+        logs.set_request_id(job_id)
+        trace = tracer.begin(job_id, f"job {job['task']}")
+        with self._lock:
+            self._running += 1
+        try:
+            status, result = execute(job["task"], job["request"])
+        finally:
+            with self._lock:
+                self._running -= 1
+            tracer.end(trace)
+        self._finish(running, status, result)
+
+    def _finish(self, job, status, result):
+        state = SUCCEEDED if status < 400 else FAILED
+        self.store.put(dict(job, state=state, finished_at=time.time(), status=status, result=result))
+        metrics.inc("jobs_total", {"task": job["task"], "outcome": state})
+        with self._finished:
+            self._finished.notify_all()
+
+    def _adopt(self, job):
+        """Take over a job whose process stopped: queue it here, or fail it once it has used its runs."""
+        if job["state"] == RUNNING and job["attempts"] >= self.config.MAX_ATTEMPTS:
+            error = RuntimeError("The worker running the job stopped before it finished")
+            result, status = (code_error if job["task"] == "code" else chat_error)(error)
+            failed = dict(job, state=FAILED, finished_at=time.time(), status=status, result=result)
+            if self.store.replace(job, failed):
+                logger.warning("Job %s failed: its worker stopped during all %d runs", job["id"], job["attempts"])
+                metrics.inc("jobs_total", {"task": job["task"], "outcome": FAILED})
+            return
+        adopted = dict(job, state=QUEUED, owner=self._owner)
+        if self.store.replace(job, adopted):
+            logger.info("Recovered job %s from a stopped worker", job["id"])
+            metrics.inc("jobs_total", {"task": job["task"], "outcome": "recovered"})
+            self._queue.put(job["id"])
+
+    def recover(self):
+        """Claim every unfinished job whose process has stopped; returns how many were found."""
+        self._start()
+        orphans = [job for job in self.store.all() if not finished(job) and not self._alive(job["owner"])]
+        for job in orphans:
+            self._adopt(job)
+        return len(orphans)
+
+    def _recover_forever(self):
+        while True:
+            try:
+                self.recover()
+            except Exception as e:
+                logger.warning("Job recovery failed: %s", e)
+            time.sleep(self.config.RECOVERY_INTERVAL)
+
+    def _poll(self, job_id):
+        job = self.store.get(job_id)
+        if job is None:
+            raise JobNotFound(f"Unknown or expired job: {job_id}")
+        if not finished(job) and not self._alive(job["owner"]):
+            self._adopt(job)
+        return job
+
+    def get(self, job_id, wait=0):
+        """The job's record, waiting up to `wait` seconds (at most MAX_WAIT) for it to finish."""
+        self._start()
+        wait_until = time.monotonic() + min(max(wait, 0), self.config.MAX_WAIT)
+        while True:
+            job = self._poll(job_id)
+            left = wait_until - time.monotonic()
+            if finished(job) or left <= 0:
+                return job
+            # Woken at once by a job finishing here; one finishing in another process is seen on the next poll
+            with self._finished:
+                self._finished.wait(min(left, self.config.POLL_INTERVAL))
+
+    async def aget(self, job_id, wait=0):
+        """Async counterpart of get(); shared-store reads run on a worker thread."""
+        self._start()
+        wait_until = time.monotonic() + min(max(wait, 0), self.config.MAX_WAIT)
+        while True:
+            job = await asyncio.to_thread(self._poll, job_id) if self.store.shared() else self._poll(job_id)
+            left = wait_until - time.monotonic()
+            if finished(job) or left <= 0:
+                return job
+            await asyncio.sleep(min(left, self.config.POLL_INTERVAL))
+
+    def stats(self):
+        return {
+            "workers": self.config.WORKERS,
+            "queued": self._queue.qsize() if self._pid == os.getpid() else 0,
+            "running": self._running if self._pid == os.getpid() else 0,
+            "queue_size": self.config.QUEUE_SIZE,
+            "shared": self.store.shared(),
+        }
+
+
+def parse_wait(value):
+    """Seconds from a ?wait= query parameter; 0 when missing or not a number."""
+    try:
+        seconds = float(value) if value is not None else 0
+    except ValueError:
+        return 0
+    return seconds if math.isfinite(seconds) and seconds > 0 else 0
+
+
+job_pool = JobPool()
+
+metrics.register_collector(
+    "jobs_in_process", "gauge", "Jobs queued for or running on this worker process's job threads",
+    lambda: [({"state": state}, job_pool.stats()[state]) for state in (QUEUED, RUNNING)]
+)
@@ -0,0 +1,134 @@
+import math
+import os
+import threading
+import time
+
+
+class LatencySketch:
+    """Log-bucketed latency histogram: O(1) inserts, quantiles within ~5% relative error."""
+
+    GAMMA = 1.1
+    MIN_SECONDS = 0.001
+
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+
+    def add(self, seconds):
+        index = int(math.log(max(seconds, self.MIN_SECONDS) / self.MIN_SECONDS, self.GAMMA))
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+        self.count += 1
+
+    @classmethod
+    def quantile(cls, sketches, q):
+        counts = {}
+        for sketch in sketches:
+            for index, count in list(sketch.buckets.items()):
+                counts[index] = counts.get(index, 0) + count
+        total = sum(counts.values())
+        if not total:
+            return None
+        rank = q * (total - 1)
+        seen = 0
+        for index in sorted(counts):
+            seen += counts[index]
+            if seen > rank:
+                # Midpoint of the bucket
+                return cls.MIN_SECONDS * cls.GAMMA ** (index + 0.5)
+        return None
+
+
+class ProviderProfile:
+    """Rolling latency and error profile of one provider."""
+
+    def __init__(self, alpha, window):
+        self.alpha = alpha
+        self.window = window
+        self.ewma_latency = None
+        self.ewma_error_rate = 0.0
+        self.successes = 0
+        self.errors = 0
+        self.current = LatencySketch()
+        self.previous = LatencySketch()
+        self.rotated_at = time.monotonic()
+
+    def _rotate(self, now):
+        # Keep two windows so quantiles always cover between one and two windows of calls
+        if now - self.rotated_at >= self.window:
+            self.previous, self.current = self.current, LatencySketch()
+            self.rotated_at = now
+
+    def record(self, seconds, now):
+        self._rotate(now)
+        self.current.add(seconds)
+        self.successes += 1
+        if self.ewma_latency is None:
+            self.ewma_latency = seconds
+        else:
+            self.ewma_latency += self.alpha * (seconds - self.ewma_latency)
+        self.ewma_error_rate *= 1 - self.alpha
+
+    def record_error(self, now):
+        self._rotate(now)
+        self.errors += 1
+        self.ewma_error_rate += self.alpha * (1 - self.ewma_error_rate)
+
+    def count(self):
+        return self.current.count + self.previous.count
+
+    def quantile(self, q):
+        return LatencySketch.quantile((self.previous, self.current), q)
+
+    def snapshot(self):
+        return {
+            "ewma_latency": self.ewma_latency,
+            "ewma_error_rate": self.ewma_error_rate,
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+            "p99": self.quantile(0.99),
+            "samples": self.count(),
+            "successes": self.successes,
+            "errors": self.errors,
+        }
+
+
+class LatencyTracker:
+    """Latency and error profiles per provider, fed by every upstream call."""
+
+    def __init__(self, alpha=float(os.getenv("LATENCY_EWMA_ALPHA", "0.2")),
+                 window=float(os.getenv("LATENCY_WINDOW_SECONDS", "300"))):
+        self.alpha = alpha
+        self.window = window
+        self._profiles = {}
+        self._lock = threading.Lock()
+
+    def profile(self, provider):
+        profile = self._profiles.get(provider)
+        if profile is None:
+            with self._lock:
+                profile = self._profiles.setdefault(provider, ProviderProfile(self.alpha, self.window))
+        return profile
+
+    def record(self, provider, seconds):
+        profile = self.profile(provider)
+        with self._lock:
+            profile.record(seconds, time.monotonic())
+
+    def record_error(self, provider):
+        profile = self.profile(provider)
+        with self._lock:
+            profile.record_error(time.monotonic())
+
+    def count(self, provider):
+        return self.profile(provider).count()
+
+    def percentile(self, provider, q):
+        with self._lock:
+            return self.profile(provider).quantile(q)
+
+    def snapshot(self):
+        with self._lock:
+            return {provider: profile.snapshot() for provider, profile in self._profiles.items()}
+
+
+latency = LatencyTracker()
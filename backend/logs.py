@@ -0,0 +1,223 @@
+import atexit
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import re
+import sys
+import threading
+import time
+import traceback
+import uuid
+from datetime import datetime, timezone
+
+from metrics import metrics
+
+
+class LogConfig:
+    LEVEL = os.getenv("LOG_LEVEL", "INFO").strip().upper()
+    # "json" for one JSON object per line, "text" for plain lines while developing
+    FORMAT = os.getenv("LOG_FORMAT", "json").strip().lower()
+    # Records waiting for the writer thread; when it is full new records are dropped, never waited on
+    QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+    # Identical records logged per window; the rest of the window's repeats are only counted
+    SAMPLE_BURST = int(os.getenv("LOG_SAMPLE_BURST", "5"))
+    SAMPLE_WINDOW = float(os.getenv("LOG_SAMPLE_WINDOW", "60"))
+    # Distinct records tracked for sampling before stale ones are dropped
+    SAMPLE_MAX_KEYS = 1024
+    REQUEST_ID_HEADER = "X-Request-ID"
+
+
+# ID of the request being served; copied into its tasks and background-loop calls
+_request_id = contextvars.ContextVar("request_id", default=None)
+
+# Client-supplied IDs are echoed back in logs and headers, so only plain tokens are accepted
+_VALID_REQUEST_ID = re.compile(r"^[A-Za-z0-9._:-]{1,128}$")
+
+# Attributes every LogRecord has; anything else was passed in `extra` and is logged as a field
+_RECORD_FIELDS = set(vars(logging.makeLogRecord({}))) | {"message", "asctime", "request_id", "suppressed"}
+
+
+def begin_request(headers):
+    """Set the current request's ID from its X-Request-ID header, or a new one; returns the ID."""
+    value = headers.get(LogConfig.REQUEST_ID_HEADER)
+    if not value or not _VALID_REQUEST_ID.match(value):
+        value = uuid.uuid4().hex
+    _request_id.set(value)
+    return value
+
+
+def set_request_id(value):
+    """Log under a known ID, such as the ID of the job being run."""
+    _request_id.set(value)
+
+
+def request_id():
+    return _request_id.get()
+
+
+class RequestIdFilter(logging.Filter):
+    """Stamps each record with the request ID of the thread or task that logged it."""
+
+    def filter(self, record):
+        record.request_id = _request_id.get()
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """Lets SAMPLE_BURST identical records through per window and counts the rest.
+
+    Records are identical when they come from the same logger, at the same
+    level, with the same message and exception type. The first record let
+    through in a new window carries how many repeats the previous window dropped.
+    """
+
+    def __init__(self, config=LogConfig):
+        super().__init__()
+        self.config = config
+        self._windows = {}
+        self._lock = threading.Lock()
+
+    def _key(self, record):
+        error = record.exc_info[0].__name__ if record.exc_info and record.exc_info[0] else None
+        return record.name, record.levelno, record.getMessage(), error
+
+    def _prune(self, now):
+        for key, window in list(self._windows.items()):
+            if now - window[0] >= self.config.SAMPLE_WINDOW:
+                del self._windows[key]
+        if len(self._windows) >= self.config.SAMPLE_MAX_KEYS:
+            self._windows.clear()
+
+    def filter(self, record):
+        if self.config.SAMPLE_BURST <= 0:
+            return True
+        key = self._key(record)
+        now = time.monotonic()
+        with self._lock:
+            window = self._windows.get(key)
+            if window is None:
+                if len(self._windows) >= self.config.SAMPLE_MAX_KEYS:
+                    self._prune(now)
+                # [window start, records seen, repeats dropped in the previous window]
+                window = self._windows[key] = [now, 0, 0]
+            elif now - window[0] >= self.config.SAMPLE_WINDOW:
+                window[:] = [now, 0, max(0, window[1] - self.config.SAMPLE_BURST)]
+            window[1] += 1
+            allowed = window[1] <= self.config.SAMPLE_BURST
+            if allowed:
+                record.suppressed = window[2]
+                window[2] = 0
+        if not allowed:
+            metrics.inc("log_records_suppressed_total", {"level": record.levelname.lower()})
+        return allowed
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record: time, level, logger, message, request ID and any `extra` fields."""
+
+    def format(self, record):
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname.lower(),
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if getattr(record, "request_id", None):
+            entry["request_id"] = record.request_id
+        for name, value in vars(record).items():
+            if name not in _RECORD_FIELDS:
+                entry[name] = value
+        if getattr(record, "suppressed", 0):
+            entry["suppressed_repeats"] = record.suppressed
+        if record.exc_info:
+            # Formatted here, on the writer thread, not by the request that logged it
+            entry["exception"] = "".join(traceback.format_exception(*record.exc_info)).rstrip()
+        return json.dumps(entry, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)s %(name)s [%(request_id)s] %(message)s")
+
+    def format(self, record):
+        if not hasattr(record, "request_id"):
+            record.request_id = None
+        text = super().format(record)
+        if getattr(record, "suppressed", 0):
+            text += f" (and {record.suppressed} identical records suppressed)"
+        return text
+
+
+class AsyncQueueHandler(logging.handlers.QueueHandler):
+    """Hands records to a writer thread without ever blocking the logging thread.
+
+    Each process starts its own writer thread on first use, as threads do not
+    survive a fork. Records that find the queue full are dropped and counted.
+    """
+
+    def __init__(self, target, config=LogConfig):
+        super().__init__(queue.Queue(config.QUEUE_SIZE))
+        self.target = target
+        self.config = config
+        self.listener = None
+        self._pid = None
+        self._start_lock = threading.Lock()
+
+    def _start(self):
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            # A fresh queue, since the parent's writer may have held its lock at the fork
+            self.queue = queue.Queue(self.config.QUEUE_SIZE)
+            self.listener = logging.handlers.QueueListener(self.queue, self.target, respect_handler_level=True)
+            self.listener.start()
+            self._pid = os.getpid()
+
+    def prepare(self, record):
+        # Unlike the stock handler, the message and traceback are left for the writer thread to format
+        return record
+
+    def enqueue(self, record):
+        if self._pid != os.getpid():
+            self._start()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            metrics.inc("log_records_dropped_total", {"level": record.levelname.lower()})
+
+    def stop(self):
+        """Write out the records still queued."""
+        if self.listener is not None and self._pid == os.getpid():
+            self.listener.stop()
+            self._pid = None
+
+
+_handler = None
+
+
+def configure(config=LogConfig):
+    """Send every log record through the sampling filter and the writer thread, as JSON lines on stdout."""
+    global _handler
+    if _handler is not None:
+        return _handler
+    target = logging.StreamHandler(sys.stdout)
+    target.setFormatter(TextFormatter() if config.FORMAT == "text" else JsonFormatter())
+    _handler = AsyncQueueHandler(target, config)
+    _handler.addFilter(RequestIdFilter())
+    _handler.addFilter(SamplingFilter(config))
+    root = logging.getLogger()
+    root.addHandler(_handler)
+    root.setLevel(config.LEVEL)
+    # httpx logs every upstream request at INFO
+    for name in ("httpx", "httpcore"):
+        logging.getLogger(name).setLevel(logging.WARNING)
+    atexit.register(shutdown)
+    return _handler
+
+
+def shutdown():
+    if _handler is not None:
+        _handler.stop()
@@ -0,0 +1,176 @@
+import logging
+import threading
+import weakref
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds, in seconds, of the latency histogram buckets
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0)
+
+# name -> (type, help)
+METRICS = {
+    "http_requests_total": ("counter", "HTTP requests by route, method and status"),
+    "http_request_duration_seconds": ("histogram", "Time to produce an HTTP response, by route"),
+    "http_requests_in_flight": ("gauge", "HTTP requests being handled, by route"),
+    "provider_requests_total": ("counter", "Upstream provider calls by provider, model and outcome"),
+    "provider_request_duration_seconds": ("histogram", "Upstream provider call latency by provider and model"),
+    "provider_ttfb_seconds": ("histogram", "Time from sending an upstream request to its response headers"),
+    "provider_requests_in_flight": ("gauge", "Upstream provider calls in flight"),
+    "provider_path_total": ("counter", "Upstream calls served through the SDK or the direct HTTP fallback"),
+    "provider_errors_total": ("counter", "Upstream call errors by provider and error class"),
+    "provider_fallbacks_total": ("counter", "Moves from one provider to the next in a fallback chain"),
+    "provider_tokens_total": ("counter", "Tokens sent to (in) and received from (out) providers"),
+    "provider_retries_total": ("counter", "Retried provider attempts by provider and the error that caused them"),
+    "provider_retries_denied_total": ("counter", "Retryable errors not retried: retry budget spent or Retry-After too long"),
+    "provider_admission_wait_seconds": ("histogram", "Time requests waited for a provider concurrency slot"),
+    "provider_admission_rejections_total": ("counter", "Requests refused a provider slot: spilled to the next provider, queue full or timed out"),
+    "log_records_suppressed_total": ("counter", "Log records left out as repeats of an identical record, by level"),
+    "log_records_dropped_total": ("counter", "Log records dropped because the log queue was full, by level"),
+    "model_catalog_refreshes_total": ("counter", "Model-list refreshes by provider and outcome: changed, unchanged, empty or error"),
+    "code_validations_total": ("counter", "Generated code checked by the language's validator, by provider, model, language and outcome"),
+    "jobs_total": ("counter", "Async jobs by task and outcome: queued, rejected, recovered, succeeded or failed"),
+}
+
+
+class _Shard:
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+
+    def fold(self, other):
+        """Add another shard's counts to this one."""
+        for key, value in list(other.counters.items()):
+            self.counters[key] = self.counters.get(key, 0) + value
+        for key, values in list(other.histograms.items()):
+            merged = self.histograms.setdefault(key, [0] * len(values))
+            for index, value in enumerate(list(values)):
+                merged[index] += value
+
+
+class _Owner:
+    # Held only by its thread's thread-local storage, so it is collected when the thread exits
+    __slots__ = ("shard", "__weakref__")
+
+    def __init__(self, shard):
+        self.shard = shard
+
+
+class Metrics:
+    """Counters, gauges and histograms recorded into per-thread shards.
+
+    Recording only touches the calling thread's shard, so the hot path takes no
+    lock; a scrape merges every shard. When a thread exits, its shard is folded
+    into a single retired shard, so short-lived threads do not pile up shards.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+        self._shards = []
+        self._retired = _Shard()
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def _shard(self):
+        owner = getattr(self._local, "owner", None)
+        if owner is None:
+            owner = self._local.owner = _Owner(_Shard())
+            with self._lock:
+                self._shards.append(owner.shard)
+            weakref.finalize(owner, self._retire, owner.shard)
+        return owner.shard
+
+    def _retire(self, shard):
+        with self._lock:
+            self._retired.fold(shard)
+            self._shards.remove(shard)
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, labels, value=1):
+        counters = self._shard().counters
+        key = self._key(name, labels)
+        counters[key] = counters.get(key, 0) + value
+
+    def observe(self, name, labels, seconds):
+        histograms = self._shard().histograms
+        key = self._key(name, labels)
+        histogram = histograms.get(key)
+        if histogram is None:
+            # One count per bucket, then the +Inf count and the sum
+            histogram = histograms[key] = [0] * (len(LATENCY_BUCKETS) + 1) + [0.0]
+        for index, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                histogram[index] += 1
+                break
+        else:
+            histogram[len(LATENCY_BUCKETS)] += 1
+        histogram[-1] += seconds
+
+    def register_collector(self, name, kind, help_text, collect):
+        """Add a series computed at scrape time; collect() returns [(labels, value), ...]."""
+        self._collectors.append((name, kind, help_text, collect))
+
+    def _merged(self):
+        merged = _Shard()
+        with self._lock:
+            # Under the lock, so a shard retiring meanwhile is counted exactly once
+            merged.fold(self._retired)
+            shards = list(self._shards)
+        for shard in shards:
+            merged.fold(shard)
+        return merged.counters, merged.histograms
+
+    def render(self):
+        """Render every series in the Prometheus text format."""
+        counters, histograms = self._merged()
+        lines = []
+        for name, (kind, help_text) in METRICS.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            if kind == "histogram":
+                for (series, labels), values in sorted(histograms.items()):
+                    if series != name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(LATENCY_BUCKETS, values):
+                        cumulative += count
+                        lines.append(f"{name}_bucket{_labels(labels, le=str(bound))} {cumulative}")
+                    cumulative += values[len(LATENCY_BUCKETS)]
+                    lines.append(f"{name}_bucket{_labels(labels, le='+Inf')} {cumulative}")
+                    lines.append(f"{name}_sum{_labels(labels)} {values[-1]}")
+                    lines.append(f"{name}_count{_labels(labels)} {cumulative}")
+            else:
+                for (series, labels), value in sorted(counters.items()):
+                    if series == name:
+                        lines.append(f"{name}{_labels(labels)} {value}")
+        for name, kind, help_text, collect in self._collectors:
+            try:
+                samples = collect()
+            except Exception as e:
+                logger.warning("Could not collect %s: %s", name, e)
+                continue
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                lines.append(f"{name}{_labels(tuple(sorted(labels.items())))} {value}")
+        return "\n".join(lines) + "\n"
+
+
+def _labels(labels, **extra):
+    pairs = list(labels) + list(extra.items())
+    if not pairs:
+        return ""
+    escaped = (f'{name}="{_escape(value)}"' for name, value in pairs)
+    return "{" + ",".join(escaped) + "}"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+# Content type of the Prometheus text exposition format
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+metrics = Metrics()
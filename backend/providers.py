@@ -0,0 +1,861 @@
+import asyncio
+import contextlib
+import json
+import os
+import logging
+import time
+
+from dotenv import load_dotenv
+
+# Load environment variables before the client registry reads its settings
+load_dotenv()
+
+from admission import Saturated, admission
+import deadline
+from catalog import ModelCatalog
+from clients import ClientConfig, get_async_clients, get_clients
+from deadline import DeadlineExceeded
+from health import OPEN, breakers, is_timeout
+from latency import latency
+from metrics import metrics
+from retries import ProviderError, from_response, from_sdk, retry_policy
+from routing import router
+from tracing import span
+
+logger = logging.getLogger(__name__)
+
+# Get API keys
+anthropic_api_key = os.getenv("ANTHROPIC_API_KEY")
+openai_api_key = os.getenv("OPENAI_API_KEY")
+deepseek_api_key = os.getenv("DEEPSEEK_API_KEY")
+
+# Available OpenAI models
+OPENAI_MODELS = {
+    "gpt-4": "GPT-4",
+    "gpt-4-turbo": "GPT-4 Turbo",
+    "gpt-3.5-turbo": "GPT-3.5 Turbo"
+}
+
+# Available Claude models
+CLAUDE_MODELS = {
+    "claude-3-sonnet-20240229": "Claude 3 Sonnet",
+    "claude-3-5-sonnet-20240620": "Claude 3.5 Sonnet"
+}
+
+# Available DeepSeek models
+DEEPSEEK_MODELS = {
+    "deepseek-chat": "DeepSeek Chat",
+    "deepseek-coder": "DeepSeek Coder",
+    "deepseek-v3": "DeepSeek v3"
+}
+
+# Default Claude model to use
+DEFAULT_CLAUDE_MODEL = "claude-3-5-sonnet-20240620"
+# Default DeepSeek model to use
+DEFAULT_DEEPSEEK_MODEL = "deepseek-v3"
+
+# Provider order used by /models, /verify-key and the model="auto" fallback chain. These tables
+# seed the model catalog, which keeps them current from each provider's model list
+PROVIDER_MODELS = {
+    "anthropic": CLAUDE_MODELS,
+    "openai": OPENAI_MODELS,
+    "deepseek": DEEPSEEK_MODELS,
+}
+AUTO_CHAIN = ["anthropic", "deepseek", "openai"]
+
+PROVIDER_NAMES = {
+    "anthropic": "Claude",
+    "openai": "OpenAI",
+    "deepseek": "DeepSeek",
+}
+
+CODE_SYSTEM_PROMPT = "You are a code-only assistant. You must only return code without explanations or markdown formatting."
+CLAUDE_CODE_SYSTEM_PROMPT = CODE_SYSTEM_PROMPT + " Do not include any text before or after the code."
+CHAT_SYSTEM_PROMPT = "You are a helpful and friendly AI assistant. You should engage in natural conversation, be polite, and provide helpful responses. You can help with coding questions but should also be able to have general conversations."
+
+# (system prompt, max_tokens, temperature) per task and provider; None leaves the provider default
+TASK_PARAMS = {
+    "code": {
+        "anthropic": (CLAUDE_CODE_SYSTEM_PROMPT, 2000, None),
+        "openai": (CODE_SYSTEM_PROMPT, 2000, None),
+        "deepseek": (CODE_SYSTEM_PROMPT, 2000, 0.2),
+    },
+    "chat": {
+        "anthropic": (CHAT_SYSTEM_PROMPT, 2000, None),
+        "openai": (None, 1000, None),
+        "deepseek": (CHAT_SYSTEM_PROMPT, 2000, 0.7),
+    },
+}
+
+
+class Completion:
+    def __init__(self, text, provider, model, usage=None):
+        self.text = text
+        self.provider = provider
+        self.model = model
+        self.usage = usage or {}
+        # Extra fields reported alongside the model in the endpoint response
+        self.meta = {}
+
+    def copy(self):
+        completion = Completion(self.text, self.provider, self.model, dict(self.usage))
+        completion.meta = dict(self.meta)
+        return completion
+
+
+def api_key(provider):
+    return {
+        "anthropic": anthropic_api_key,
+        "openai": openai_api_key,
+        "deepseek": deepseek_api_key,
+    }[provider]
+
+
+def provider_available(provider):
+    # Providers with an open circuit are skipped without waiting on them
+    return bool(api_key(provider)) and breakers[provider].available()
+
+
+def toggle_simulated_down(provider):
+    """Flip a manual "down" override on the provider's circuit breaker; returns True if now down."""
+    breaker = breakers[provider]
+    if breaker.forced == OPEN:
+        breaker.force(None)
+        return False
+    breaker.force(OPEN)
+    return True
+
+
+def available_models():
+    models = []
+    for provider in PROVIDER_MODELS:
+        if provider_available(provider):
+            for model_id, model_name in catalog.models(provider).items():
+                models.append({
+                    "id": model_id,
+                    "name": model_name,
+                    "provider": provider
+                })
+
+    # If no models available, add mock
+    if not models:
+        models.append({
+            "id": "mock",
+            "name": "Mock Model",
+            "provider": "mock"
+        })
+    return models
+
+
+def models_view(name, build):
+    """Serialized JSON of build(available_models()) and its ETag.
+
+    Rebuilt only when the catalog changes or a provider comes or goes.
+    """
+    available = tuple(provider for provider in PROVIDER_MODELS if provider_available(provider))
+    return catalog.render(name, available, lambda: build(available_models()))
+
+
+def provider_for_model(model):
+    return catalog.provider_for(model)
+
+
+def default_model(provider):
+    # The configured default while the provider still lists it, else its first listed model
+    models = catalog.models(provider)
+    preferred = {"anthropic": DEFAULT_CLAUDE_MODEL, "deepseek": DEFAULT_DEEPSEEK_MODEL}.get(provider)
+    if preferred in models:
+        return preferred
+    return next(iter(models), preferred or "gpt-3.5-turbo")
+
+
+def resolve_route(requested_model, language=None):
+    """Return the (provider, model) attempts for a requested model, in order, and the routing decision.
+
+    A code request's language lets the router favour models whose code in it passes validation.
+    """
+    if requested_model == 'auto':
+        candidates = [provider for provider in AUTO_CHAIN if provider_available(provider)]
+        models = {provider: default_model(provider) for provider in candidates}
+        ordered, decision = router.rank(candidates, models, language)
+        return [(provider, default_model(provider)) for provider in ordered], decision
+
+    provider = provider_for_model(requested_model)
+    if provider and provider_available(provider):
+        return [(provider, requested_model)], None
+    return [], None
+
+
+def build_code_prompt(prompt, language):
+    # Construct a prompt that ensures only code is returned
+    if language:
+        return f"Generate ONLY code in {language} for the following task: {prompt}. Return ONLY the code without any explanations, comments, or markdown formatting."
+    return f"Generate ONLY code for the following task: {prompt}. Return ONLY the code without any explanations, comments, or markdown formatting."
+
+
+def strip_code_fences(text):
+    # Remove a markdown code block around the code, and any explanation after its closing fence
+    text = text.strip()
+    if not text.startswith("```"):
+        return text
+    first_line_end = text.find("\n")
+    if first_line_end < 0:
+        # A single line: ```code```
+        return text[3:-3].strip() if text.endswith("```") else text
+    # The opening line may carry a language; the closing fence is the last one in the text
+    body = text[first_line_end + 1:]
+    closing = body.rfind("```")
+    # An answer cut off before its closing fence still loses the opening one
+    return (body[:closing] if closing >= 0 else body).strip()
+
+
+def _overloaded(error):
+    # Our own admission queue was full, or the provider was still overloaded after retries
+    return isinstance(error, Saturated) or (
+        isinstance(error, ProviderError) and error.status_code in (429, 503, 529)
+    )
+
+
+def _error_status(error):
+    if isinstance(error, (Saturated, DeadlineExceeded)):
+        return error.status_code
+    return 503 if _overloaded(error) else 500
+
+
+def chat_error(error):
+    """Return the (body, status) pair the chat endpoint sends for an unexpected error."""
+    error_msg = str(error)
+
+    # More user-friendly error message
+    user_error_msg = "I encountered an error connecting to the AI service. Please check your API keys and try again."
+
+    # Return appropriate error code
+    if _overloaded(error):
+        status_code = _error_status(error)
+        user_error_msg = "The AI service is busy. Please try again shortly."
+    elif isinstance(error, DeadlineExceeded):
+        status_code = error.status_code
+        user_error_msg = "The AI service took too long to respond. Please try again."
+    elif "invalid" in error_msg.lower() and "key" in error_msg.lower():
+        status_code = 401  # Unauthorized for API key issues
+        user_error_msg = "Invalid API key. Please check your API key configuration."
+    else:
+        status_code = 500  # Internal server error for other issues
+
+    return {
+        "response": user_error_msg,
+        "error": error_msg,
+        "model": "error"
+    }, status_code
+
+
+def code_error(error):
+    error_msg = str(error)
+    return {
+        "code": "# Error: " + error_msg,
+        "error": error_msg,
+        "model": "error"
+    }, _error_status(error)
+
+
+def _request(provider, model, task, messages, temperature=None):
+    """Build the request body shared by a provider's SDK and direct HTTP paths.
+
+    temperature overrides the task's own, e.g. to get varied code candidates.
+    """
+    system, max_tokens, default_temperature = TASK_PARAMS[task][provider]
+    if temperature is None:
+        temperature = default_temperature
+    if provider == "anthropic":
+        payload = {"model": model, "max_tokens": max_tokens, "messages": messages}
+        if system:
+            payload["system"] = system
+    else:
+        payload = {"model": model, "messages": messages, "max_tokens": max_tokens}
+        if system:
+            payload["messages"] = [{"role": "system", "content": system}] + messages
+    if temperature is not None:
+        payload["temperature"] = temperature
+    return payload
+
+
+def _headers(provider):
+    if provider == "anthropic":
+        return {
+            "Content-Type": "application/json",
+            "X-Api-Key": anthropic_api_key,
+            "anthropic-version": "2023-06-01"
+        }
+    return {
+        "Content-Type": "application/json",
+        "Authorization": f"Bearer {api_key(provider)}"
+    }
+
+
+catalog = ModelCatalog(PROVIDER_MODELS, api_key, _headers)
+
+
+DIRECT_PATHS = {
+    "anthropic": "/v1/messages",
+    "openai": "/v1/chat/completions",
+    "deepseek": "/v1/chat/completions",
+}
+
+
+def _parse_direct(provider, model, api_response):
+    if api_response.status_code != 200:
+        raise from_response(PROVIDER_NAMES[provider], provider, api_response)
+    response_json = api_response.json()
+    usage = response_json.get("usage") or {}
+    if provider == "anthropic":
+        text = response_json.get("content", [{"text": ""}])[0]["text"]
+        return Completion(text.strip(), provider, model, {
+            "input_tokens": usage.get("input_tokens"),
+            "output_tokens": usage.get("output_tokens"),
+        })
+    text = response_json.get("choices", [{}])[0].get("message", {}).get("content", "")
+    return Completion((text or "").strip(), provider, model, {
+        "input_tokens": usage.get("prompt_tokens"),
+        "output_tokens": usage.get("completion_tokens"),
+    })
+
+
+def _parse_anthropic_sdk(model, response):
+    if hasattr(response, 'content') and isinstance(response.content, list):
+        text = response.content[0].text
+    else:
+        text = str(response.content)
+    usage = getattr(response, "usage", None)
+    return Completion(text.strip(), "anthropic", model, {
+        "input_tokens": getattr(usage, "input_tokens", None),
+        "output_tokens": getattr(usage, "output_tokens", None),
+    })
+
+
+def _parse_openai_sdk(provider, model, response):
+    usage = getattr(response, "usage", None)
+    return Completion((response.choices[0].message.content or "").strip(), provider, model, {
+        "input_tokens": getattr(usage, "prompt_tokens", None),
+        "output_tokens": getattr(usage, "completion_tokens", None),
+    })
+
+
+def _log_error(message, error, provider):
+    # Saturation and deadlines are expected under load, so they are logged without a traceback
+    expected = isinstance(error, (Saturated, DeadlineExceeded))
+    logger.warning("%s: %s", message, error, exc_info=None if expected else error, extra={"provider": provider})
+
+
+def _sdk_failed(provider, error):
+    """Raise an SDK error the provider API returned; log any other so the direct path is tried."""
+    api_error = from_sdk(provider, error)
+    if api_error is not None:
+        # The direct path would reach the same API, so the retry policy decides instead
+        raise api_error from error
+    _log_error(f"Error with {PROVIDER_NAMES[provider]} client", error, provider)
+
+
+def _complete_sdk(provider, model, task, messages, payload):
+    clients = get_clients()
+    if provider == "anthropic":
+        response = clients.anthropic(anthropic_api_key).messages.create(**payload, timeout=ClientConfig.attempt_timeout())
+        return _parse_anthropic_sdk(model, response)
+    if provider == "openai":
+        response = clients.openai(openai_api_key).chat.completions.create(**payload, timeout=ClientConfig.attempt_timeout())
+        return _parse_openai_sdk(provider, model, response)
+
+    # The DeepSeek SDK only takes a single prompt
+    client = clients.deepseek(deepseek_api_key)
+    if client is None or len(messages) != 1:
+        return None
+    system, max_tokens, temperature = TASK_PARAMS[task][provider]
+    response = client.generate(
+        prompt=messages[0]["content"],
+        model=model,
+        max_tokens=max_tokens,
+        temperature=temperature,
+        system_prompt=system
+    )
+    return Completion(response.text.strip(), provider, model)
+
+
+# 4xx statuses that still point at the provider rather than at the request
+PROVIDER_FAULT_4XX = {408, 429}
+
+
+def _outcome(error):
+    # Running out of the request's own budget says nothing about the provider's health
+    if isinstance(error, DeadlineExceeded) or deadline.expired():
+        return None
+    # Neither does a request the provider rejected, e.g. a bad key (401) or an unknown model (404)
+    status_code = error.status_code if isinstance(error, ProviderError) else None
+    if status_code is not None and 400 <= status_code < 500 and status_code not in PROVIDER_FAULT_4XX:
+        return None
+    return "timeout" if is_timeout(error) or status_code == 408 else "error"
+
+
+def _begin_call(provider):
+    metrics.inc("provider_requests_in_flight", {"provider": provider})
+    return time.monotonic()
+
+
+def _finish_call(provider, model, started, outcome, error=None, usage=None):
+    # outcome is None when the call was cancelled, e.g. a hedging loser or a closed stream
+    metrics.inc("provider_requests_in_flight", {"provider": provider}, -1)
+    metrics.inc("provider_requests_total", {"provider": provider, "model": model, "outcome": outcome or "cancelled"})
+    if outcome is not None:
+        metrics.observe("provider_request_duration_seconds", {"provider": provider, "model": model},
+                        time.monotonic() - started)
+    if error is not None:
+        metrics.inc("provider_errors_total", {"provider": provider, "error": type(error).__name__})
+    for direction, field in (("in", "input_tokens"), ("out", "output_tokens")):
+        tokens = (usage or {}).get(field)
+        if tokens:
+            metrics.inc("provider_tokens_total", {"provider": provider, "model": model, "direction": direction}, tokens)
+
+
+def _record_path(provider, path):
+    metrics.inc("provider_path_total", {"provider": provider, "path": path})
+
+
+def _record_fallback(failed, provider):
+    if failed is not None:
+        metrics.inc("provider_fallbacks_total", {"from": failed, "to": provider})
+
+
+def complete(provider, model, task, messages):
+    """Run one provider call, trying the SDK first and the direct HTTP API second."""
+    breaker = breakers[provider]
+    probe = breaker.acquire()
+    outcome = error = completion = None
+    started = _begin_call(provider)
+    try:
+        with span("call", provider=provider, model=model):
+            completion = retry_policy.run(provider, lambda: _complete(provider, model, task, messages))
+        outcome = "success"
+    except Exception as e:
+        outcome, error = _outcome(e), e
+        if outcome is not None:
+            latency.record_error(provider)
+        raise
+    finally:
+        breaker.release(probe, outcome)
+        _finish_call(provider, model, started, outcome, error, completion and completion.usage)
+    latency.record(provider, time.monotonic() - started)
+    return completion
+
+
+def _complete(provider, model, task, messages):
+    payload = _request(provider, model, task, messages)
+    try:
+        with span("sdk", provider=provider) as sdk:
+            completion = _complete_sdk(provider, model, task, messages, payload)
+            if completion is None:
+                sdk.skip()
+        if completion is not None:
+            _record_path(provider, "sdk")
+            return completion
+    except Exception as e:
+        _sdk_failed(provider, e)
+
+    # Fall back to direct API call if client doesn't work
+    _record_path(provider, "direct")
+    with span("direct", provider=provider):
+        api_response = get_clients().post(
+            provider,
+            DIRECT_PATHS[provider],
+            headers=_headers(provider),
+            json=payload,
+            timeout=ClientConfig.attempt_timeout()
+        )
+        return _parse_direct(provider, model, api_response)
+
+
+def _stream_payload(provider, model, task, messages):
+    payload = _request(provider, model, task, messages)
+    payload["stream"] = True
+    if provider != "anthropic":
+        # Ask OpenAI-compatible APIs to report usage in the last chunk
+        payload["stream_options"] = {"include_usage": True}
+    return payload
+
+
+def _apply_stream_event(provider, event, completion):
+    """Return the text carried by one streamed event, recording any usage it reports."""
+    if provider == "anthropic":
+        kind = event.get("type")
+        if kind == "content_block_delta":
+            return (event.get("delta") or {}).get("text") or ""
+        if kind == "message_start":
+            usage = (event.get("message") or {}).get("usage") or {}
+            completion.usage["input_tokens"] = usage.get("input_tokens")
+        elif kind == "message_delta":
+            usage = event.get("usage") or {}
+            completion.usage["output_tokens"] = usage.get("output_tokens")
+        elif kind == "error":
+            raise Exception(f"Claude stream error: {event.get('error')}")
+        return ""
+
+    usage = event.get("usage")
+    if usage:
+        completion.usage["input_tokens"] = usage.get("prompt_tokens")
+        completion.usage["output_tokens"] = usage.get("completion_tokens")
+    choices = event.get("choices") or []
+    if choices:
+        return (choices[0].get("delta") or {}).get("content") or ""
+    return ""
+
+
+def _parse_sse_line(line):
+    if not line.startswith("data:"):
+        return None
+    data = line[5:].strip()
+    if not data or data == "[DONE]":
+        return None
+    return json.loads(data)
+
+
+def _sdk_events(provider, payload):
+    clients = get_clients()
+    if provider == "anthropic":
+        events = clients.anthropic(anthropic_api_key).messages.create(**payload, timeout=ClientConfig.attempt_timeout())
+    elif provider == "openai":
+        events = clients.openai(openai_api_key).chat.completions.create(**payload, timeout=ClientConfig.attempt_timeout())
+    else:
+        # The DeepSeek SDK cannot stream; its OpenAI-compatible API is called directly
+        return None
+    return (event.model_dump() for event in events)
+
+
+def _direct_events(provider, payload):
+    with get_clients().http(provider).stream(
+        "POST",
+        DIRECT_PATHS[provider],
+        headers=_headers(provider),
+        json=payload,
+        timeout=ClientConfig.attempt_timeout()
+    ) as api_response:
+        if api_response.status_code != 200:
+            api_response.read()
+            raise from_response(PROVIDER_NAMES[provider], provider, api_response)
+        for line in api_response.iter_lines():
+            event = _parse_sse_line(line)
+            if event is not None:
+                yield event
+
+
+def stream(provider, model, task, messages, completion):
+    """Yield text deltas from one provider as they arrive, accumulating them into completion.
+
+    The direct HTTP API is only tried if the SDK fails before sending any text.
+    """
+    breaker = breakers[provider]
+    probe = breaker.acquire()
+    outcome = error = None
+    started = _begin_call(provider)
+    try:
+        with span("call", provider=provider, model=model):
+            retry_policy.record_call(provider)
+            attempt = 0
+            while True:
+                try:
+                    with span("attempt", provider=provider, attempt=attempt + 1):
+                        yield from _stream(provider, model, task, messages, completion)
+                    break
+                except Exception as e:
+                    # Only a stream that has not sent any text yet can be retried
+                    attempt += 1
+                    wait = None if completion.text else retry_policy.backoff(provider, e, attempt)
+                    if wait is None:
+                        raise
+                with span("backoff", provider=provider, seconds=round(wait, 3)):
+                    time.sleep(wait)
+        outcome = "success"
+    except Exception as e:
+        outcome, error = _outcome(e), e
+        if outcome is not None:
+            latency.record_error(provider)
+        raise
+    finally:
+        breaker.release(probe, outcome)
+        _finish_call(provider, model, started, outcome, error, completion.usage)
+    # The whole stream, as for a plain call, so the router and hedge delays see one kind of latency
+    latency.record(provider, time.monotonic() - started)
+
+
+def _stream(provider, model, task, messages, completion):
+    payload = _stream_payload(provider, model, task, messages)
+    try:
+        with span("sdk", provider=provider) as sdk:
+            events = _sdk_events(provider, payload)
+            if events is None:
+                sdk.skip()
+            else:
+                for event in events:
+                    delta = _apply_stream_event(provider, event, completion)
+                    if delta:
+                        completion.text += delta
+                        yield delta
+        if events is not None:
+            _record_path(provider, "sdk")
+            return
+    except Exception as e:
+        if completion.text:
+            raise
+        _sdk_failed(provider, e)
+
+    _record_path(provider, "direct")
+    with span("direct", provider=provider):
+        for event in _direct_events(provider, payload):
+            delta = _apply_stream_event(provider, event, completion)
+            if delta:
+                completion.text += delta
+                yield delta
+
+
+def stream_chain(chain, task, messages):
+    """Yield ("token", text) events and a final ("done", completion) from the first provider that works.
+
+    Once a provider has streamed text the request is committed to it, so later
+    failures are raised instead of falling back.
+    """
+    last_error = failed = None
+    for index, (provider, model) in enumerate(chain):
+        _record_fallback(failed, provider)
+        completion = Completion("", provider, model)
+        try:
+            with admission.slot(provider, wait=_queues(chain, index)):
+                for delta in stream(provider, model, task, messages, completion):
+                    yield "token", delta
+            yield "done", completion
+            return
+        except Exception as e:
+            _stop_if_late(e)
+            _log_error(f"{PROVIDER_NAMES[provider]} API error", e, provider)
+            if completion.text:
+                raise
+            last_error, failed = e, provider
+    raise last_error
+
+
+async def _acomplete_sdk(provider, model, payload):
+    clients = get_async_clients()
+    if provider == "anthropic":
+        response = await clients.anthropic(anthropic_api_key).messages.create(**payload, timeout=ClientConfig.attempt_timeout())
+        return _parse_anthropic_sdk(model, response)
+    if provider == "openai":
+        response = await clients.openai(openai_api_key).chat.completions.create(**payload, timeout=ClientConfig.attempt_timeout())
+        return _parse_openai_sdk(provider, model, response)
+    # There is no async DeepSeek SDK; its OpenAI-compatible API is called directly
+    return None
+
+
+async def acomplete(provider, model, task, messages, temperature=None):
+    """Async counterpart of complete(); temperature overrides the task's own."""
+    breaker = breakers[provider]
+    probe = breaker.acquire()
+    outcome = error = completion = None
+    started = _begin_call(provider)
+    try:
+        with span("call", provider=provider, model=model):
+            completion = await retry_policy.arun(provider, lambda: _acomplete(provider, model, task, messages, temperature))
+        outcome = "success"
+    except Exception as e:
+        outcome, error = _outcome(e), e
+        if outcome is not None:
+            latency.record_error(provider)
+        raise
+    finally:
+        # A cancelled call (e.g. a hedging loser) leaves outcome None and is not counted
+        breaker.release(probe, outcome)
+        _finish_call(provider, model, started, outcome, error, completion and completion.usage)
+    latency.record(provider, time.monotonic() - started)
+    return completion
+
+
+async def _acomplete(provider, model, task, messages, temperature=None):
+    payload = _request(provider, model, task, messages, temperature)
+    try:
+        with span("sdk", provider=provider) as sdk:
+            completion = await _acomplete_sdk(provider, model, payload)
+            if completion is None:
+                sdk.skip()
+        if completion is not None:
+            _record_path(provider, "sdk")
+            return completion
+    except Exception as e:
+        _sdk_failed(provider, e)
+
+    _record_path(provider, "direct")
+    with span("direct", provider=provider):
+        api_response = await get_async_clients().post(
+            provider,
+            DIRECT_PATHS[provider],
+            headers=_headers(provider),
+            json=payload,
+            timeout=ClientConfig.attempt_timeout()
+        )
+        return _parse_direct(provider, model, api_response)
+
+
+def _stop_if_late(error):
+    # Once the request's deadline has passed there is no time to try the next provider
+    if isinstance(error, DeadlineExceeded):
+        raise error
+    if deadline.expired():
+        raise DeadlineExceeded() from error
+
+
+def _queues(chain, index):
+    # Only the last provider in a chain queues for a slot; a saturated one before it is skipped
+    return index == len(chain) - 1
+
+
+def complete_chain(chain, task, messages):
+    """Try each (provider, model) in chain in turn; None if the chain is empty."""
+    if not chain:
+        return None
+    last_error = failed = None
+    for index, (provider, model) in enumerate(chain):
+        _record_fallback(failed, provider)
+        try:
+            with admission.slot(provider, wait=_queues(chain, index)):
+                return complete(provider, model, task, messages)
+        except Exception as e:
+            _stop_if_late(e)
+            _log_error(f"{PROVIDER_NAMES[provider]} API error", e, provider)
+            last_error, failed = e, provider
+    raise last_error
+
+
+def concurrency_limit(limits, provider):
+    if limits is None:
+        return contextlib.nullcontext()
+    return limits[provider]
+
+
+async def acomplete_chain(chain, task, messages, limits=None):
+    """Async counterpart of complete_chain(); limits optionally bounds calls per provider."""
+    if not chain:
+        return None
+    last_error = failed = None
+    for index, (provider, model) in enumerate(chain):
+        _record_fallback(failed, provider)
+        try:
+            async with concurrency_limit(limits, provider), admission.aslot(provider, wait=_queues(chain, index)):
+                return await acomplete(provider, model, task, messages)
+        except Exception as e:
+            _stop_if_late(e)
+            _log_error(f"{PROVIDER_NAMES[provider]} API error", e, provider)
+            last_error, failed = e, provider
+    raise last_error
+
+
+async def _asdk_events(provider, payload):
+    clients = get_async_clients()
+    if provider == "anthropic":
+        events = await clients.anthropic(anthropic_api_key).messages.create(**payload, timeout=ClientConfig.attempt_timeout())
+    else:
+        events = await clients.openai(openai_api_key).chat.completions.create(**payload, timeout=ClientConfig.attempt_timeout())
+    async for event in events:
+        yield event.model_dump()
+
+
+async def _adirect_events(provider, payload):
+    async with get_async_clients().http(provider).stream(
+        "POST",
+        DIRECT_PATHS[provider],
+        headers=_headers(provider),
+        json=payload,
+        timeout=ClientConfig.attempt_timeout()
+    ) as api_response:
+        if api_response.status_code != 200:
+            await api_response.aread()
+            raise from_response(PROVIDER_NAMES[provider], provider, api_response)
+        async for line in api_response.aiter_lines():
+            event = _parse_sse_line(line)
+            if event is not None:
+                yield event
+
+
+async def astream(provider, model, task, messages, completion):
+    """Async counterpart of stream()."""
+    breaker = breakers[provider]
+    probe = breaker.acquire()
+    outcome = error = None
+    started = _begin_call(provider)
+    try:
+        with span("call", provider=provider, model=model):
+            retry_policy.record_call(provider)
+            attempt = 0
+            while True:
+                try:
+                    with span("attempt", provider=provider, attempt=attempt + 1):
+                        async for delta in _astream(provider, model, task, messages, completion):
+                            yield delta
+                    break
+                except Exception as e:
+                    attempt += 1
+                    wait = None if completion.text else retry_policy.backoff(provider, e, attempt)
+                    if wait is None:
+                        raise
+                with span("backoff", provider=provider, seconds=round(wait, 3)):
+                    await asyncio.sleep(wait)
+        outcome = "success"
+    except Exception as e:
+        outcome, error = _outcome(e), e
+        if outcome is not None:
+            latency.record_error(provider)
+        raise
+    finally:
+        breaker.release(probe, outcome)
+        _finish_call(provider, model, started, outcome, error, completion.usage)
+    # The whole stream, as for a plain call, so the router and hedge delays see one kind of latency
+    latency.record(provider, time.monotonic() - started)
+
+
+async def _astream(provider, model, task, messages, completion):
+    payload = _stream_payload(provider, model, task, messages)
+    if provider != "deepseek":
+        try:
+            with span("sdk", provider=provider):
+                async for event in _asdk_events(provider, payload):
+                    delta = _apply_stream_event(provider, event, completion)
+                    if delta:
+                        completion.text += delta
+                        yield delta
+            _record_path(provider, "sdk")
+            return
+        except Exception as e:
+            if completion.text:
+                raise
+            _sdk_failed(provider, e)
+
+    _record_path(provider, "direct")
+    with span("direct", provider=provider):
+        async for event in _adirect_events(provider, payload):
+            delta = _apply_stream_event(provider, event, completion)
+            if delta:
+                completion.text += delta
+                yield delta
+
+
+async def astream_chain(chain, task, messages):
+    """Async counterpart of stream_chain()."""
+    last_error = failed = None
+    for index, (provider, model) in enumerate(chain):
+        _record_fallback(failed, provider)
+        completion = Completion("", provider, model)
+        try:
+            async with admission.aslot(provider, wait=_queues(chain, index)):
+                async for delta in astream(provider, model, task, messages, completion):
+                    yield "token", delta
+            yield "done", completion
+            return
+        except Exception as e:
+            _stop_if_late(e)
+            _log_error(f"{PROVIDER_NAMES[provider]} API error", e, provider)
+            if completion.text:
+                raise
+            last_error, failed = e, provider
+    raise last_error
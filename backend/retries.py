@@ -0,0 +1,279 @@
+import asyncio
+import email.utils
+import logging
+import os
+import random
+import re
+import threading
+import time
+from datetime import datetime
+
+import httpx
+
+import deadline
+from metrics import metrics
+from tracing import span
+
+logger = logging.getLogger(__name__)
+
+
+def _provider_setting(name, provider, default):
+    # RETRY_MAX_ATTEMPTS_OPENAI overrides RETRY_MAX_ATTEMPTS for one provider
+    return os.getenv(f"{name}_{provider.upper()}", os.getenv(name, default))
+
+
+class RetryConfig:
+    ENABLED = os.getenv("RETRY_ENABLED", "true").strip().lower() in ("1", "true", "yes", "on")
+
+    @staticmethod
+    def max_attempts(provider):
+        """Attempts per provider call, the first one included."""
+        return int(_provider_setting("RETRY_MAX_ATTEMPTS", provider, "3"))
+
+    @staticmethod
+    def base_delay(provider):
+        return float(_provider_setting("RETRY_BASE_DELAY", provider, "0.5"))
+
+    @staticmethod
+    def max_delay(provider):
+        return float(_provider_setting("RETRY_MAX_DELAY", provider, "8"))
+
+    @staticmethod
+    def max_retry_after(provider):
+        """A provider asking for a longer wait than this is not retried, so the chain moves on."""
+        return float(_provider_setting("RETRY_MAX_RETRY_AFTER", provider, "30"))
+
+    @staticmethod
+    def budget_ratio(provider):
+        """Retries allowed per call made, over time."""
+        return float(_provider_setting("RETRY_BUDGET_RATIO", provider, "0.2"))
+
+    @staticmethod
+    def budget_min_per_second(provider):
+        """Retries allowed per second regardless of traffic, so quiet periods can still retry."""
+        return float(_provider_setting("RETRY_BUDGET_MIN_PER_SECOND", provider, "1"))
+
+    @staticmethod
+    def budget_burst(provider):
+        return float(_provider_setting("RETRY_BUDGET_BURST", provider, "10"))
+
+
+# 529 is Anthropic's "overloaded"
+RETRYABLE_STATUSES = {408, 409, 425, 429, 500, 502, 503, 504, 529}
+
+
+class ProviderError(Exception):
+    """A failed provider call, from either the SDK or the direct HTTP path.
+
+    status_code is None when no response arrived (connection error or timeout);
+    retry_after is the wait the provider asked for, if any.
+    """
+
+    def __init__(self, message, provider, status_code=None, retry_after=None, timeout=False):
+        super().__init__(message)
+        self.provider = provider
+        self.status_code = status_code
+        self.retry_after = retry_after
+        self.timeout = timeout
+
+
+_DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+_DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+
+def _parse_duration(value):
+    # OpenAI reset headers look like "1s", "6m0s" or "20ms"
+    parts = _DURATION_PART.findall(value)
+    if not parts or "".join(number + unit for number, unit in parts) != value.strip():
+        return None
+    return sum(float(number) * _DURATION_UNITS[unit] for number, unit in parts)
+
+
+def _parse_timestamp(value):
+    # Anthropic reset headers are RFC 3339 timestamps
+    try:
+        return datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp() - time.time()
+    except ValueError:
+        return None
+
+
+def retry_after(headers, status_code=None):
+    """Seconds the provider asked us to wait before retrying, or None."""
+    if headers is None:
+        return None
+    value = headers.get("retry-after-ms")
+    if value:
+        try:
+            return max(0.0, float(value) / 1000)
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if value:
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            # Retry-After may also be an HTTP date
+            return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            pass
+    if status_code == 429:
+        # Without Retry-After, wait for the soonest rate-limit window to reset
+        waits = []
+        for name in ("x-ratelimit-reset-requests", "x-ratelimit-reset-tokens"):
+            if headers.get(name):
+                waits.append(_parse_duration(headers[name]))
+        for name in ("anthropic-ratelimit-requests-reset", "anthropic-ratelimit-tokens-reset"):
+            if headers.get(name):
+                waits.append(_parse_timestamp(headers[name]))
+        waits = [max(0.0, wait) for wait in waits if wait is not None]
+        if waits:
+            return min(waits)
+    return None
+
+
+def from_response(provider_name, provider, response):
+    """ProviderError for a non-200 direct HTTP response."""
+    return ProviderError(
+        f"{provider_name} API call failed: {response.status_code} - {response.text}",
+        provider, response.status_code, retry_after(response.headers, response.status_code)
+    )
+
+
+def from_sdk(provider, error):
+    """ProviderError for an SDK error that came from the provider API, or None for any other error."""
+    status_code = getattr(error, "status_code", None)
+    if isinstance(status_code, int):
+        response = getattr(error, "response", None)
+        headers = response.headers if response is not None else None
+        return ProviderError(str(error), provider, status_code, retry_after(headers, status_code))
+    # APIConnectionError and its APITimeoutError subclass, in both SDKs
+    if type(error).__name__ in ("APIConnectionError", "APITimeoutError"):
+        return ProviderError(str(error), provider, timeout="Timeout" in type(error).__name__)
+    return None
+
+
+def retryable(error):
+    if isinstance(error, ProviderError):
+        return error.status_code is None or error.status_code in RETRYABLE_STATUSES
+    return isinstance(error, (httpx.TimeoutException, httpx.NetworkError, httpx.RemoteProtocolError))
+
+
+def _reason(error):
+    if isinstance(error, ProviderError) and error.status_code is not None:
+        return str(error.status_code)
+    return type(error).__name__
+
+
+class RetryBudget:
+    """Token bucket that caps retries at a fraction of calls, so retries cannot amplify an overload.
+
+    Every call deposits `ratio` tokens and time adds `min_per_second`; a retry spends one.
+    """
+
+    def __init__(self, ratio, min_per_second, burst):
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.min_per_second)
+        self.updated = now
+
+    def deposit(self):
+        with self._lock:
+            self._refill(time.monotonic())
+            self.tokens = min(self.burst, self.tokens + self.ratio)
+
+    def withdraw(self):
+        with self._lock:
+            self._refill(time.monotonic())
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+class RetryPolicy:
+    """Which provider errors are retried, and after how long.
+
+    Retryable errors wait with exponential backoff and full jitter, or for as long
+    as the provider asked via Retry-After or its rate-limit reset headers.
+    """
+
+    def __init__(self, providers, config=RetryConfig):
+        self.config = config
+        self.budgets = {
+            provider: RetryBudget(config.budget_ratio(provider), config.budget_min_per_second(provider),
+                                  config.budget_burst(provider))
+            for provider in providers
+        }
+
+    def record_call(self, provider):
+        self.budgets[provider].deposit()
+
+    def backoff(self, provider, error, attempt):
+        """Seconds to wait before retry number `attempt` (from 1), or None to give up."""
+        if not self.config.ENABLED or attempt >= self.config.max_attempts(provider) or not retryable(error):
+            return None
+        wait = getattr(error, "retry_after", None)
+        if wait is not None and wait > self.config.max_retry_after(provider):
+            metrics.inc("provider_retries_denied_total", {"provider": provider, "reason": "retry_after"})
+            return None
+        if wait is None:
+            ceiling = min(self.config.max_delay(provider), self.config.base_delay(provider) * 2 ** (attempt - 1))
+            wait = random.uniform(0, ceiling)
+        else:
+            # A little jitter keeps clients told the same reset time from retrying in lockstep
+            wait += random.uniform(0, min(1.0, wait * 0.1))
+        left = deadline.remaining()
+        if left is not None and wait >= left:
+            # Sleeping would use up the request's deadline; give the chain what is left instead
+            metrics.inc("provider_retries_denied_total", {"provider": provider, "reason": "deadline"})
+            return None
+        if not self.budgets[provider].withdraw():
+            metrics.inc("provider_retries_denied_total", {"provider": provider, "reason": "budget"})
+            return None
+        metrics.inc("provider_retries_total", {"provider": provider, "reason": _reason(error)})
+        logger.info("Retrying %s after: %s", provider, error,
+                    extra={"provider": provider, "attempt": attempt, "wait": round(wait, 3)})
+        return wait
+
+    def run(self, provider, call):
+        """Call call() until it succeeds or the policy gives up."""
+        self.record_call(provider)
+        attempt = 0
+        while True:
+            try:
+                with span("attempt", provider=provider, attempt=attempt + 1):
+                    return call()
+            except Exception as e:
+                attempt += 1
+                wait = self.backoff(provider, e, attempt)
+                if wait is None:
+                    raise
+            with span("backoff", provider=provider, seconds=round(wait, 3)):
+                time.sleep(wait)
+
+    async def arun(self, provider, call):
+        """Async counterpart of run(); call returns an awaitable."""
+        self.record_call(provider)
+        attempt = 0
+        while True:
+            try:
+                with span("attempt", provider=provider, attempt=attempt + 1):
+                    return await call()
+            except Exception as e:
+                attempt += 1
+                wait = self.backoff(provider, e, attempt)
+                if wait is None:
+                    raise
+            with span("backoff", provider=provider, seconds=round(wait, 3)):
+                await asyncio.sleep(wait)
+
+
+retry_policy = RetryPolicy(("anthropic", "openai", "deepseek"))
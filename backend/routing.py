@@ -0,0 +1,98 @@
+import os
+
+from latency import latency
+from validation import normalize_language, validation_stats
+
+
+def _parse_weights(value, default):
+    # "anthropic=3,openai=2,deepseek=1"
+    if not value:
+        return default
+    weights = dict(default)
+    for part in value.split(","):
+        name, _, weight = part.partition("=")
+        if weight:
+            weights[name.strip()] = float(weight)
+    return weights
+
+
+class RouterConfig:
+    # "latency" orders model="auto" by live performance; "static" keeps the fixed chain order
+    STRATEGY = os.getenv("ROUTING_STRATEGY", "latency")
+    # Samples needed before a provider's measured latency replaces the prior
+    MIN_SAMPLES = int(os.getenv("ROUTING_MIN_SAMPLES", "10"))
+    PRIOR_LATENCY = float(os.getenv("ROUTING_PRIOR_LATENCY", "5.0"))
+    # Score = latency * (1 + ERROR_PENALTY * error rate + INVALID_PENALTY * invalid code rate)
+    #         + COST_WEIGHT * cost + PREFERENCE_WEIGHT * chain position
+    ERROR_PENALTY = float(os.getenv("ROUTING_ERROR_PENALTY", "4.0"))
+    # Code that fails validation costs the user a retry, much like an error
+    INVALID_PENALTY = float(os.getenv("ROUTING_INVALID_PENALTY", "4.0"))
+    COST_WEIGHT = float(os.getenv("ROUTING_COST_WEIGHT", "0.0"))
+    PREFERENCE_WEIGHT = float(os.getenv("ROUTING_PREFERENCE_WEIGHT", "0.25"))
+    # Relative cost of each provider, used with COST_WEIGHT
+    COSTS = _parse_weights(os.getenv("ROUTING_COSTS"), {"anthropic": 3.0, "openai": 2.0, "deepseek": 1.0})
+
+
+class Router:
+    """Orders the providers of an auto request by their live latency and error profile."""
+
+    def __init__(self, config=RouterConfig):
+        self.config = config
+
+    def score(self, provider, position, model=None, language=None):
+        profile = latency.profile(provider)
+        measured = profile.count() >= self.config.MIN_SAMPLES and profile.ewma_latency is not None
+        expected = profile.ewma_latency if measured else self.config.PRIOR_LATENCY
+        error_rate = profile.ewma_error_rate
+        # How often the model's code in this language failed validation, once there are enough checks
+        invalid_rate = validation_stats.invalid_rate(model, language) if model and language else None
+        score = (
+            expected * (1 + self.config.ERROR_PENALTY * error_rate + self.config.INVALID_PENALTY * (invalid_rate or 0.0))
+            + self.config.COST_WEIGHT * self.config.COSTS.get(provider, 0.0)
+            + self.config.PREFERENCE_WEIGHT * position
+        )
+        entry = {
+            "score": round(score, 4),
+            "expected_latency": round(expected, 4),
+            "error_rate": round(error_rate, 4),
+            "measured": measured,
+        }
+        if invalid_rate is not None:
+            entry["invalid_rate"] = round(invalid_rate, 4)
+        return entry
+
+    def rank(self, candidates, models=None, language=None):
+        """Return (ordered candidates, decision) for providers listed in preference order.
+
+        models maps each provider to the model it would be called with; together
+        with a code request's language it lets validation stats count.
+        """
+        if self.config.STRATEGY != "latency" or len(candidates) < 2:
+            return list(candidates), {"strategy": "static", "order": list(candidates)}
+        language = normalize_language(language) if language else None
+        models = models or {}
+        scores = {
+            provider: self.score(provider, position, models.get(provider), language)
+            for position, provider in enumerate(candidates)
+        }
+        ordered = sorted(candidates, key=lambda provider: scores[provider]["score"])
+        return ordered, {"strategy": "latency", "order": ordered, "scores": scores}
+
+    def snapshot(self, candidates):
+        ordered, decision = self.rank(candidates)
+        return {
+            "strategy": self.config.STRATEGY,
+            "weights": {
+                "error_penalty": self.config.ERROR_PENALTY,
+                "invalid_penalty": self.config.INVALID_PENALTY,
+                "cost_weight": self.config.COST_WEIGHT,
+                "preference_weight": self.config.PREFERENCE_WEIGHT,
+                "costs": self.config.COSTS,
+            },
+            "decision": decision,
+            "profiles": latency.snapshot(),
+            "validation": validation_stats.snapshot(),
+        }
+
+
+router = Router()
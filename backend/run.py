@@ -1,4 +1,83 @@
-from app import app
+import argparse
+import os
+
+
+def _serve_production(args):
+    from gunicorn.app.base import BaseApplication
+
+    preload = not args.no_preload
+
+    def post_fork(server, worker):
+        if preload:
+            from warmup import warmup
+            # Connections cannot be shared across a fork, so each worker opens its own
+            warmup.deferred = False
+            warmup.start()
+
+    class ProductionServer(BaseApplication):
+        def load_config(self):
+            self.cfg.set("bind", f"{args.host}:{args.port}")
+            self.cfg.set("workers", args.workers)
+            self.cfg.set("worker_class", "gthread")
+            self.cfg.set("threads", args.threads)
+            # Recycle workers to bound memory growth; the jitter keeps them from restarting together
+            self.cfg.set("max_requests", args.max_requests)
+            self.cfg.set("max_requests_jitter", max(1, args.max_requests // 10) if args.max_requests else 0)
+            # SIGTERM and SIGHUP let in-flight requests (including long streams) finish for this long
+            self.cfg.set("graceful_timeout", args.graceful_timeout)
+            self.cfg.set("timeout", args.timeout)
+            self.cfg.set("keepalive", 5)
+            self.cfg.set("preload_app", preload)
+            self.cfg.set("post_fork", post_fork)
+
+        def load(self):
+            if not preload:
+                from app import app
+                return app
+            from warmup import warmup
+            warmup.deferred = True
+            from app import app
+            warmup.preload()
+            return app
+
+    ProductionServer().run()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Start the backend API server")
+    parser.add_argument(
+        "--mode",
+        choices=["flask", "async", "production"],
+        default=os.getenv("SERVER_MODE", "flask"),
+        help="flask: development server (default); async: ASGI server on an event loop; "
+             "production: pre-forked worker processes with a thread pool each",
+    )
+    parser.add_argument("--host", default=os.getenv("HOST", "127.0.0.1"))
+    parser.add_argument("--port", type=int, default=int(os.getenv("PORT", "8000")))
+
+    production = parser.add_argument_group("production mode")
+    production.add_argument("--workers", type=int, default=int(os.getenv("WEB_CONCURRENCY", str(os.cpu_count() or 1))))
+    production.add_argument("--threads", type=int, default=int(os.getenv("SERVER_THREADS", "8")),
+                            help="Requests handled concurrently by each worker")
+    production.add_argument("--max-requests", type=int, default=int(os.getenv("SERVER_MAX_REQUESTS", "1000")),
+                            help="Restart a worker after this many requests (0 disables)")
+    production.add_argument("--graceful-timeout", type=int, default=int(os.getenv("SERVER_GRACEFUL_TIMEOUT", "30")),
+                            help="Seconds in-flight requests get to finish on shutdown or reload")
+    production.add_argument("--timeout", type=int, default=int(os.getenv("SERVER_TIMEOUT", "120")),
+                            help="Seconds before a silent worker is killed and replaced")
+    production.add_argument("--no-preload", action="store_true", default=os.getenv("SERVER_PRELOAD", "true").lower() in ("0", "false", "no", "off"),
+                            help="Import the app in each worker instead of once in the master (lets SIGHUP reload code)")
+    args = parser.parse_args()
+
+    if args.mode == "production":
+        _serve_production(args)
+    elif args.mode == "async":
+        import uvicorn
+        uvicorn.run("asgi:app", host=args.host, port=args.port)
+    else:
+        from app import app
+        app.run(host=args.host, port=args.port, debug=True)
+
 
 if __name__ == "__main__":
-    app.run(host="127.0.0.1", port=8000, debug=True)
\ No newline at end of file
+    main()
@@ -10,5 +10,22 @@ class SecurityConfig:
     ACCESS_TOKEN_EXPIRE_MINUTES = 30
     REFRESH_TOKEN_EXPIRE_DAYS = 7
     ALLOWED_HOSTS = ["localhost", "127.0.0.1"]
-    RATE_LIMIT_REQUESTS = 100
-    RATE_LIMIT_PERIOD = 3600  # 1 hour
\ No newline at end of file
+    RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "true").strip().lower() in ("1", "true", "yes", "on")
+    RATE_LIMIT_REQUESTS = int(os.getenv("RATE_LIMIT_REQUESTS", "100"))
+    RATE_LIMIT_PERIOD = int(os.getenv("RATE_LIMIT_PERIOD", "3600"))  # 1 hour
+    # Routes that call a provider, each with its own (requests, period) budget per client
+    RATE_LIMIT_ROUTES = {
+        "/chat": (RATE_LIMIT_REQUESTS, RATE_LIMIT_PERIOD),
+        "/chat/stream": (RATE_LIMIT_REQUESTS, RATE_LIMIT_PERIOD),
+        "/code-generate": (RATE_LIMIT_REQUESTS, RATE_LIMIT_PERIOD),
+        "/code-generate/stream": (RATE_LIMIT_REQUESTS, RATE_LIMIT_PERIOD),
+        "/code-generate/batch": (RATE_LIMIT_REQUESTS, RATE_LIMIT_PERIOD),
+        "/jobs": (RATE_LIMIT_REQUESTS, RATE_LIMIT_PERIOD),
+    }
+    # Routes charged one token per item in the body instead of one per request
+    RATE_LIMIT_ITEM_ROUTES = {"/code-generate/batch"}
+    # "memory" keeps counters per process; "sqlite" shares them between workers on one host
+    RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "memory")
+    RATE_LIMIT_DB_PATH = os.getenv("RATE_LIMIT_DB_PATH", "rate_limits.db")
+    # Only trust X-Forwarded-For when running behind a known proxy
+    TRUST_PROXY_HEADERS = os.getenv("TRUST_PROXY_HEADERS", "false").strip().lower() in ("1", "true", "yes", "on")
@@ -0,0 +1,178 @@
+import asyncio
+import hashlib
+import math
+import os
+import sqlite3
+import threading
+import time
+
+from security.config import SecurityConfig
+
+
+def _refill(tokens, updated, capacity, rate, now):
+    return min(capacity, tokens + max(0.0, now - updated) * rate)
+
+
+def _outcome(allowed, levels, cost, rate):
+    # (allowed, remaining, retry_after) over all the buckets a request draws from
+    retry_after = 0 if allowed else math.ceil(max(cost - tokens for tokens in levels) / rate)
+    return allowed, int(min(levels)), retry_after
+
+
+class MemoryBackend:
+    """Token buckets held in this process: one (tokens, updated) pair per client and route."""
+
+    # Whether take() waits on I/O, so the ASGI app has to run it off the event loop
+    blocking = False
+
+    def __init__(self):
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self._last_sweep = time.monotonic()
+
+    def take(self, keys, capacity, period, now, cost=1):
+        """Take `cost` tokens from every bucket in keys, or from none of them if any is short.
+
+        Returns (allowed, remaining, retry_after).
+        """
+        rate = capacity / period
+        with self._lock:
+            levels = [_refill(*self._buckets.get(key, (capacity, now)), capacity, rate, now) for key in keys]
+            allowed = all(tokens >= cost for tokens in levels)
+            if allowed:
+                levels = [tokens - cost for tokens in levels]
+            for key, tokens in zip(keys, levels):
+                self._buckets[key] = (tokens, now)
+            self._sweep(now, period)
+        return _outcome(allowed, levels, cost, rate)
+
+    def _sweep(self, now, period):
+        # A bucket idle for a whole period has refilled, so it can simply be forgotten
+        if now - self._last_sweep < period:
+            return
+        self._last_sweep = now
+        for key in [key for key, (_, updated) in self._buckets.items() if now - updated >= period]:
+            del self._buckets[key]
+
+
+class SQLiteBackend:
+    """Token buckets in a local SQLite file, shared by every worker process on the host."""
+
+    blocking = True
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._last_sweep = 0.0
+        conn = self._conn()
+        conn.execute("CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)")
+
+    def _conn(self):
+        # A connection opened before a fork must not be used by the forked worker
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def take(self, keys, capacity, period, now, cost=1):
+        rate = capacity / period
+        # Wall-clock time, since monotonic clocks are not comparable across processes
+        now = time.time()
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            levels = []
+            for key in keys:
+                row = conn.execute("SELECT tokens, updated FROM buckets WHERE key = ?", (key,)).fetchone()
+                levels.append(_refill(*(row or (capacity, now)), capacity, rate, now))
+            allowed = all(tokens >= cost for tokens in levels)
+            if allowed:
+                levels = [tokens - cost for tokens in levels]
+            conn.executemany(
+                "INSERT OR REPLACE INTO buckets (key, tokens, updated) VALUES (?, ?, ?)",
+                [(key, tokens, now) for key, tokens in zip(keys, levels)]
+            )
+            if now - self._last_sweep >= period:
+                self._last_sweep = now
+                conn.execute("DELETE FROM buckets WHERE updated < ?", (now - period,))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return _outcome(allowed, levels, cost, rate)
+
+
+class RateLimiter:
+    """Per-route token buckets for each API key and each client IP."""
+
+    def __init__(self, config=SecurityConfig, backend=None):
+        self.config = config
+        self.backend = backend or self._backend(config)
+
+    @staticmethod
+    def _backend(config):
+        if config.RATE_LIMIT_BACKEND == "sqlite":
+            return SQLiteBackend(config.RATE_LIMIT_DB_PATH)
+        return MemoryBackend()
+
+    def _limit(self, method, path):
+        if not self.config.RATE_LIMIT_ENABLED or method == "OPTIONS":
+            return None
+        return self.config.RATE_LIMIT_ROUTES.get(path)
+
+    def check(self, method, path, client_ip, api_key=None, cost=None):
+        """Return (allowed, headers) for a request; headers carry Retry-After when rejected.
+
+        cost is the number of tokens to take, one by default. Routes in
+        RATE_LIMIT_ITEM_ROUTES are let through without one: their handler calls
+        again with the number of items, before any of them is dispatched.
+        """
+        limit = self._limit(method, path)
+        if limit is None or (cost is None and path in self.config.RATE_LIMIT_ITEM_ROUTES):
+            return True, {}
+        capacity, period = limit
+        identities = [f"ip:{client_ip}"]
+        if api_key:
+            # Never keep raw API keys in the counter store
+            identities.append("key:" + hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:32])
+
+        # Every bucket is checked before any is drawn from, so a rejection costs none of them a token
+        allowed, remaining, retry_after = self.backend.take(
+            [f"{path}|{identity}" for identity in identities], capacity, period, time.monotonic(),
+            1 if cost is None else cost
+        )
+        if not allowed:
+            return False, {
+                "Retry-After": str(retry_after),
+                "X-RateLimit-Limit": str(capacity),
+                "X-RateLimit-Remaining": "0",
+            }
+        return True, {"X-RateLimit-Limit": str(capacity), "X-RateLimit-Remaining": str(remaining)}
+
+    async def acheck(self, method, path, client_ip, api_key=None, cost=None):
+        """check() for the event loop: a backend that does I/O runs on a worker thread."""
+        if self.backend.blocking and self._limit(method, path) is not None:
+            return await asyncio.to_thread(self.check, method, path, client_ip, api_key, cost)
+        return self.check(method, path, client_ip, api_key, cost)
+
+
+RATE_LIMITED_BODY = {"error": "Rate limit exceeded. Please try again later."}
+
+
+def client_identity(headers, remote_addr):
+    """Return the (client_ip, api_key) a request is rate limited by."""
+    client_ip = remote_addr
+    if SecurityConfig.TRUST_PROXY_HEADERS and headers.get("X-Forwarded-For"):
+        client_ip = headers["X-Forwarded-For"].split(",")[0].strip()
+    api_key = headers.get("X-API-Key")
+    authorization = headers.get("Authorization") or ""
+    if not api_key and authorization.lower().startswith("bearer "):
+        api_key = authorization[7:].strip()
+    return client_ip, api_key
+
+
+rate_limiter = RateLimiter()
@@ -0,0 +1,205 @@
+import asyncio
+import json
+import os
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+from shared_store import shared_store
+
+
+class SessionConfig:
+    # Sessions kept in memory without a shared store; the least recently used are evicted beyond this
+    MAX_SESSIONS = int(os.getenv("SESSION_MAX_SESSIONS", "10000"))
+    # Seconds an idle session is kept
+    TTL = float(os.getenv("SESSION_TTL", "86400"))
+    # Estimated tokens of history (summary, earlier turns and the new message) sent per request
+    TOKEN_BUDGET = int(os.getenv("SESSION_TOKEN_BUDGET", "4000"))
+    # Dropped turns are folded into a short running summary of at most this many tokens; 0 drops them
+    SUMMARY_TOKENS = int(os.getenv("SESSION_SUMMARY_TOKENS", "400"))
+    # Characters of each dropped turn kept in the summary
+    SUMMARY_CHARS_PER_TURN = int(os.getenv("SESSION_SUMMARY_CHARS_PER_TURN", "200"))
+    # Keep sessions in the shared store, so any worker can continue them and they survive restarts
+    SHARED = os.getenv("SESSION_SHARED", "true").strip().lower() in ("1", "true", "yes", "on")
+
+
+class SessionNotFound(Exception):
+    pass
+
+
+def estimate_tokens(text):
+    # About four characters per token for English text and code; cheap enough to run on every turn
+    return max(1, (len(text) + 3) // 4)
+
+
+def _shorten(text, limit):
+    text = " ".join(text.split())
+    return text if len(text) <= limit else text[:limit - 1] + "…"
+
+
+class Session:
+    """One conversation: a running summary of dropped turns plus the recent turns verbatim.
+
+    Each entry carries its token estimate, so trimming never re-estimates old turns.
+    """
+
+    def __init__(self, session_id, turns=None, summary=None, created=None):
+        self.id = session_id
+        # [role, content, tokens]
+        self.turns = turns or []
+        # [line, tokens]
+        self.summary = summary or []
+        self.created = created or time.time()
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data["id"], data["turns"], data["summary"], data["created"])
+
+    def to_dict(self):
+        return {"id": self.id, "turns": self.turns, "summary": self.summary, "created": self.created}
+
+    def tokens(self):
+        return sum(turn[2] for turn in self.turns) + sum(line[1] for line in self.summary)
+
+    def add(self, role, content):
+        self.turns.append([role, content, estimate_tokens(content)])
+
+    def _fold(self, turn, config):
+        if config.SUMMARY_TOKENS <= 0:
+            return
+        role, content, _ = turn
+        line = f"{'User' if role == 'user' else 'Assistant'}: {_shorten(content, config.SUMMARY_CHARS_PER_TURN)}"
+        self.summary.append([line, estimate_tokens(line)])
+        while len(self.summary) > 1 and sum(tokens for _, tokens in self.summary) > config.SUMMARY_TOKENS:
+            self.summary.pop(0)
+
+    def trim(self, config=SessionConfig):
+        """Fold the oldest turns into the summary until the history fits the token budget.
+
+        Turns are dropped in user/assistant pairs so the history still starts with a
+        user message; the newest message is always kept.
+        """
+        while len(self.turns) > 1 and self.tokens() > config.TOKEN_BUDGET:
+            self._fold(self.turns.pop(0), config)
+            if len(self.turns) > 1 and self.turns[0][0] != "user":
+                self._fold(self.turns.pop(0), config)
+        # A summary that alone overflows the budget is cut from its oldest end
+        while self.summary and self.tokens() > config.TOKEN_BUDGET:
+            self.summary.pop(0)
+
+    def messages(self):
+        """The provider message list: the summary is prepended to the first kept user turn."""
+        messages = [{"role": role, "content": content} for role, content, _ in self.turns]
+        if self.summary and messages:
+            summary = "\n".join(line for line, _ in self.summary)
+            messages[0]["content"] = (
+                f"Summary of the earlier conversation:\n{summary}\n\n{messages[0]['content']}"
+            )
+        return messages
+
+    def snapshot(self):
+        return {
+            "session_id": self.id,
+            "turns": len(self.turns),
+            "summarized_turns": len(self.summary),
+            "estimated_tokens": self.tokens(),
+            "created": self.created,
+        }
+
+
+class SessionStore:
+    """Sessions with an idle TTL, kept in the cross-worker shared store when there is one.
+
+    Any worker may serve a session's next turn, so the shared store is the only
+    copy when enabled; otherwise sessions live in a size-bounded in-process LRU.
+    Sessions are handed out as copies, so a failed request leaves the stored history untouched.
+    """
+
+    NAMESPACE = "sessions"
+
+    def __init__(self, max_sessions=SessionConfig.MAX_SESSIONS, ttl=SessionConfig.TTL,
+                 store=shared_store if SessionConfig.SHARED else None):
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+        self._shared = store
+
+    def create(self):
+        return Session(secrets.token_urlsafe(16))
+
+    def shared(self):
+        return self._shared is not None
+
+    def get(self, session_id):
+        if self._shared is not None:
+            row = self._shared.get(self.NAMESPACE, session_id)
+            if row is not None:
+                return Session.from_dict(row[0])
+            raise SessionNotFound(f"Unknown or expired session: {session_id}")
+
+        now = time.time()
+        with self._lock:
+            entry = self._sessions.get(session_id)
+            if entry is not None:
+                updated, data = entry
+                if now - updated < self.ttl:
+                    self._sessions.move_to_end(session_id)
+                    return Session.from_dict(json.loads(data))
+                del self._sessions[session_id]
+        raise SessionNotFound(f"Unknown or expired session: {session_id}")
+
+    def save(self, session):
+        now = time.time()
+        if self._shared is not None:
+            self._shared.set(self.NAMESPACE, session.id, session.to_dict(), now + self.ttl)
+            return
+        # Stored serialized: compact, and every reader gets its own copy
+        with self._lock:
+            self._sessions[session.id] = (now, json.dumps(session.to_dict()))
+            self._sessions.move_to_end(session.id)
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+
+    async def aget(self, session_id):
+        """get() for the event loop: a shared-store read runs on a worker thread."""
+        if self._shared is not None:
+            return await asyncio.to_thread(self.get, session_id)
+        return self.get(session_id)
+
+    async def asave(self, session):
+        if self._shared is not None:
+            return await asyncio.to_thread(self.save, session)
+        return self.save(session)
+
+    async def adelete(self, session_id):
+        if self._shared is not None:
+            return await asyncio.to_thread(self.delete, session_id)
+        return self.delete(session_id)
+
+    def delete(self, session_id):
+        if self._shared is not None:
+            return self._shared.delete(self.NAMESPACE, session_id)
+        with self._lock:
+            return self._sessions.pop(session_id, None) is not None
+
+    def count(self):
+        with self._lock:
+            return len(self._sessions)
+
+
+session_store = SessionStore()
+
+
+def open_session(data):
+    """The session a chat request continues or starts, or None if it does not use one.
+
+    Sending "session_id" continues a session; "session": true starts a new one.
+    """
+    session_id = data.get('session_id')
+    if session_id:
+        return session_store.get(str(session_id))
+    if data.get('session') is True:
+        return session_store.create()
+    return None
@@ -0,0 +1,287 @@
+import json
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class StoreConfig:
+    # SQLite file shared by every worker process on the host; empty disables the shared store
+    PATH = os.getenv("SHARED_STORE_PATH", "shared_state.db")
+    # Entries are evicted, soonest to expire first, once their values exceed this many bytes
+    MAX_BYTES = int(os.getenv("SHARED_STORE_MAX_BYTES", str(256 * 1024 * 1024)))
+    # Bytes of the file each connection maps into memory, so reads skip the read() syscalls
+    MMAP_BYTES = int(os.getenv("SHARED_STORE_MMAP_BYTES", str(256 * 1024 * 1024)))
+    # Seconds between eviction and compaction passes
+    MAINTENANCE_INTERVAL = float(os.getenv("SHARED_STORE_MAINTENANCE_INTERVAL", "60"))
+    # Seconds a process buffers counter increments before writing them
+    COUNTER_FLUSH_INTERVAL = float(os.getenv("SHARED_STORE_COUNTER_FLUSH_INTERVAL", "1"))
+    # Background writes a process may have queued before further ones are dropped
+    WRITE_QUEUE_SIZE = int(os.getenv("SHARED_STORE_WRITE_QUEUE_SIZE", "1000"))
+
+
+class SharedStore:
+    """Key/value entries with expiry plus counters, in a WAL-mode SQLite file.
+
+    Every thread of every process has its own connection. WAL readers never
+    block each other or the writer, so reads take no lock at all; writes are
+    single autocommit statements serialized by SQLite itself.
+    """
+
+    def __init__(self, path, config=StoreConfig):
+        self.path = path
+        self.config = config
+        self._local = threading.local()
+        self._counters = {}
+        self._counters_lock = threading.Lock()
+        self._flushed_at = time.monotonic()
+        self._maintainer_pid = None
+        self._maintainer_lock = threading.Lock()
+        self._writes = None
+        self._writer_pid = None
+        self._setup()
+
+    def _conn(self):
+        # A connection opened before a fork must not be used by the forked worker
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(f"PRAGMA mmap_size={int(self.config.MMAP_BYTES)}")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _setup(self):
+        conn = self._conn()
+        # Must be set before the first table exists for incremental compaction to be possible
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS entries (namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL,"
+            " expires_at REAL NOT NULL, size INTEGER NOT NULL, PRIMARY KEY (namespace, key))"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS entries_expires_at ON entries (expires_at)")
+        conn.execute("CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+        conn.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value REAL NOT NULL)")
+
+    def get(self, namespace, key):
+        """Return (value, expires_at), or None if the entry is missing or expired."""
+        row = self._conn().execute(
+            "SELECT value, expires_at FROM entries WHERE namespace = ? AND key = ? AND expires_at > ?",
+            (namespace, key, time.time())
+        ).fetchone()
+        return (json.loads(row[0]), row[1]) if row else None
+
+    def set(self, namespace, key, value, expires_at):
+        data = json.dumps(value)
+        self._conn().execute(
+            "INSERT OR REPLACE INTO entries (namespace, key, value, expires_at, size) VALUES (?, ?, ?, ?, ?)",
+            (namespace, key, data, expires_at, len(data))
+        )
+        self._start_maintainer()
+
+    def set_later(self, namespace, key, value, expires_at):
+        """Queue set() for this process's writer thread, for writes no caller waits on.
+
+        Returns False, without writing, if WRITE_QUEUE_SIZE writes are already queued.
+        """
+        self._start_writer()
+        try:
+            self._writes.put_nowait((namespace, key, value, expires_at))
+        except queue.Full:
+            return False
+        return True
+
+    def add(self, namespace, key, value, expires_at):
+        """Store the entry only if there is no live one; returns whether it was stored."""
+        data = json.dumps(value)
+        cursor = self._conn().execute(
+            "INSERT INTO entries (namespace, key, value, expires_at, size) VALUES (?, ?, ?, ?, ?)"
+            " ON CONFLICT (namespace, key) DO UPDATE SET value = excluded.value,"
+            " expires_at = excluded.expires_at, size = excluded.size WHERE entries.expires_at <= ?",
+            (namespace, key, data, expires_at, len(data), time.time())
+        )
+        self._start_maintainer()
+        return cursor.rowcount > 0
+
+    def swap(self, namespace, key, expected, value, expires_at):
+        """Replace the entry only if it still holds `expected`; returns whether it was replaced.
+
+        `expected` is a value returned by get(), so a process can claim an entry
+        without another process changing it in between.
+        """
+        data = json.dumps(value)
+        cursor = self._conn().execute(
+            "UPDATE entries SET value = ?, expires_at = ?, size = ?"
+            " WHERE namespace = ? AND key = ? AND value = ? AND expires_at > ?",
+            (data, expires_at, len(data), namespace, key, json.dumps(expected), time.time())
+        )
+        return cursor.rowcount > 0
+
+    def delete(self, namespace, key):
+        cursor = self._conn().execute("DELETE FROM entries WHERE namespace = ? AND key = ?", (namespace, key))
+        return cursor.rowcount > 0
+
+    def scan(self, namespace):
+        """Every live (key, value, expires_at) in the namespace."""
+        rows = self._conn().execute(
+            "SELECT key, value, expires_at FROM entries WHERE namespace = ? AND expires_at > ?",
+            (namespace, time.time())
+        ).fetchall()
+        return [(key, json.loads(value), expires_at) for key, value, expires_at in rows]
+
+    def incr(self, name, amount=1):
+        """Add to a shared counter; increments are buffered and written about once a second.
+
+        Only the in-memory buffer is touched here: the writer thread does the write.
+        """
+        with self._counters_lock:
+            self._counters[name] = self._counters.get(name, 0) + amount
+        self._start_writer()
+
+    def flush_counters(self):
+        with self._counters_lock:
+            pending, self._counters = self._counters, {}
+            self._flushed_at = time.monotonic()
+        if not pending:
+            return
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.executemany(
+                "INSERT INTO counters (name, value) VALUES (?, ?)"
+                " ON CONFLICT (name) DO UPDATE SET value = value + excluded.value",
+                list(pending.items())
+            )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def counters(self, prefix=""):
+        self.flush_counters()
+        rows = self._conn().execute(
+            "SELECT name, value FROM counters WHERE name LIKE ?", (prefix + "%",)
+        ).fetchall()
+        return {name[len(prefix):]: value for name, value in rows}
+
+    def _start_maintainer(self):
+        # One maintenance thread per process; threads do not survive a fork
+        if self._maintainer_pid == os.getpid():
+            return
+        with self._maintainer_lock:
+            if self._maintainer_pid != os.getpid():
+                self._maintainer_pid = os.getpid()
+                threading.Thread(target=self._maintain_forever, name="shared-store", daemon=True).start()
+
+    def _start_writer(self):
+        # As with the maintainer, a forked worker needs its own thread, and its own queue
+        if self._writer_pid == os.getpid():
+            return
+        with self._maintainer_lock:
+            if self._writer_pid != os.getpid():
+                self._writes = queue.Queue(self.config.WRITE_QUEUE_SIZE)
+                self._writer_pid = os.getpid()
+                threading.Thread(
+                    target=self._write_forever, args=(self._writes,), name="shared-store-writer", daemon=True
+                ).start()
+
+    def _write_forever(self, writes):
+        while True:
+            try:
+                namespace, key, value, expires_at = writes.get(timeout=self.config.COUNTER_FLUSH_INTERVAL)
+            except queue.Empty:
+                pass
+            else:
+                try:
+                    self.set(namespace, key, value, expires_at)
+                except Exception as e:
+                    logger.warning("Could not write %s entry to the shared store: %s", namespace, e)
+            if time.monotonic() - self._flushed_at >= self.config.COUNTER_FLUSH_INTERVAL:
+                try:
+                    self.flush_counters()
+                except Exception as e:
+                    logger.warning("Could not write counters to the shared store: %s", e)
+
+    def _maintain_forever(self):
+        while True:
+            time.sleep(self.config.MAINTENANCE_INTERVAL)
+            try:
+                self.flush_counters()
+                self.maintain()
+            except Exception as e:
+                logger.warning("Shared store maintenance failed: %s", e)
+
+    def maintain(self, force=False):
+        """Drop expired entries, evict down to MAX_BYTES and compact the file.
+
+        Every process runs this on its own timer, but only one of them does the
+        work in each interval.
+        """
+        now = time.time()
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT value FROM meta WHERE name = 'maintained_at'").fetchone()
+            if not force and row and now - row[0] < self.config.MAINTENANCE_INTERVAL * 0.9:
+                conn.execute("COMMIT")
+                return False
+            conn.execute("INSERT OR REPLACE INTO meta (name, value) VALUES ('maintained_at', ?)", (now,))
+            conn.execute("DELETE FROM entries WHERE expires_at <= ?", (now,))
+            total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+            if total > self.config.MAX_BYTES:
+                self._evict(conn, total - self.config.MAX_BYTES)
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        # Return freed pages to the filesystem and fold the WAL back into the database
+        conn.execute("PRAGMA incremental_vacuum")
+        conn.execute("PRAGMA wal_checkpoint(PASSIVE)")
+        return True
+
+    @staticmethod
+    def _evict(conn, excess):
+        freed = 0
+        cutoff = None
+        for expires_at, size in conn.execute("SELECT expires_at, size FROM entries ORDER BY expires_at"):
+            freed += size
+            cutoff = expires_at
+            if freed >= excess:
+                break
+        if cutoff is not None:
+            conn.execute("DELETE FROM entries WHERE expires_at <= ?", (cutoff,))
+
+    def stats(self):
+        conn = self._conn()
+        entries, size = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+        return {
+            "path": self.path,
+            "entries": entries,
+            "bytes": size,
+            "max_bytes": self.config.MAX_BYTES,
+            # Summed over every worker process
+            "counters": self.counters(),
+        }
+
+
+def store_stats():
+    return shared_store.stats() if shared_store is not None else None
+
+
+def _open_store():
+    if not StoreConfig.PATH:
+        return None
+    try:
+        return SharedStore(StoreConfig.PATH)
+    except sqlite3.Error as e:
+        logger.warning("Could not open shared store %s, using per-process state: %s", StoreConfig.PATH, e)
+        return None
+
+
+shared_store = _open_store()
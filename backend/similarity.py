@@ -0,0 +1,256 @@
+import functools
+import heapq
+import os
+import random
+import re
+import threading
+import time
+from collections import OrderedDict
+
+from cache import CacheConfig
+from metrics import metrics
+from validation import normalize_language
+
+
+class SimilarConfig:
+    # Serve near-duplicate code prompts from the similarity index unless the request sends "similar": false
+    AUTO = os.getenv("SIMILAR_CACHE", "false").strip().lower() in ("1", "true", "yes", "on")
+    # Jaccard similarity of two prompts' terms needed to serve one's answer for the other
+    THRESHOLD = float(os.getenv("SIMILAR_CACHE_THRESHOLD", "0.8"))
+    # Answers indexed per worker process, least recently used evicted first; 0 turns the tier off
+    MAX_ENTRIES = int(os.getenv("SIMILAR_CACHE_MAX_ENTRIES", "2000"))
+    TTL = CacheConfig.TTL
+    # LSH bands and rows per band: the signature has BANDS * ROWS MinHash values
+    BANDS = int(os.getenv("SIMILAR_CACHE_BANDS", "8"))
+    ROWS = int(os.getenv("SIMILAR_CACHE_ROWS", "4"))
+    # Terms hashed per prompt; longer prompts keep the terms with the smallest hashes
+    MAX_TERMS = 64
+    # Newest entries kept per LSH bucket, so a lookup compares against at most BANDS * BUCKET_SIZE answers
+    BUCKET_SIZE = 32
+    # Words whose term and MinHash values are kept, so common words are only worked out once per process
+    TERM_CACHE_SIZE = 5000
+
+
+# Instruction words and filler that rephrasings add or drop without changing the task
+STOPWORDS = frozenset("""
+a an the to of for in on at by with from into as and or that which who this these those it its
+is are be me my i you your we our us can could would should will please just some any
+write create make generate give implement build code program script show need want using use
+""".split())
+
+# Words rephrasings use for the same thing
+SYNONYMS = {
+    "func": "function",
+    "fn": "function",
+    "def": "function",
+    "method": "function",
+    "str": "string",
+    "arr": "array",
+    "dict": "dictionary",
+    "hashmap": "dictionary",
+    "num": "number",
+    "nums": "number",
+    "int": "integer",
+}
+
+_WORD = re.compile(r"[a-z0-9_]+")
+_SUFFIXES = ("ing", "ed", "es", "s", "e")
+
+# Mersenne prime modulus of the MinHash permutations
+_PRIME = (1 << 61) - 1
+
+
+def _stem(word):
+    # Strips inflections so "reverses", "reversed", "reversing" and "reverse" share a term
+    for _ in range(2):
+        for suffix in _SUFFIXES:
+            if word.endswith(suffix) and len(word) - len(suffix) >= 3:
+                word = word[:-len(suffix)]
+                break
+        else:
+            break
+    return word
+
+
+@functools.lru_cache(maxsize=SimilarConfig.TERM_CACHE_SIZE)
+def _term(word):
+    """The term a lowercase word counts as, or None for a stopword."""
+    if word in STOPWORDS:
+        return None
+    return _stem(SYNONYMS.get(word, word))
+
+
+def terms(prompt):
+    """The prompt's content words, stemmed, and the numbers in it."""
+    words = []
+    numbers = []
+    for word in _WORD.findall(str(prompt).lower()):
+        if word.isdigit():
+            numbers.append(word)
+            continue
+        term = _term(word)
+        if term is not None:
+            words.append(term)
+    return words, numbers
+
+
+class Signature:
+    """A prompt's terms and their MinHash signature."""
+
+    __slots__ = ("terms", "minhash")
+
+    def __init__(self, terms, minhash):
+        self.terms = terms
+        self.minhash = minhash
+
+    def similarity(self, other):
+        """Jaccard similarity of the two term sets."""
+        union = len(self.terms | other.terms)
+        return len(self.terms & other.terms) / union if union else 0.0
+
+
+class SimilarCache:
+    """Code answers indexed by a MinHash signature of their prompt, for near-duplicate lookups.
+
+    Each signature is cut into BANDS bands of ROWS values; prompts that agree on
+    any whole band are candidates, and a candidate is served only if the exact
+    Jaccard similarity of the two term sets reaches THRESHOLD. The language,
+    requested model and the numbers in the prompt must match exactly, since
+    "sort 10 items" and "sort 20 items" differ in a single term.
+    """
+
+    def __init__(self, config=SimilarConfig, seed=None):
+        self.config = config
+        rng = random.Random(seed)
+        self._permutations = [
+            (rng.randrange(1, _PRIME), rng.randrange(0, _PRIME)) for _ in range(config.BANDS * config.ROWS)
+        ]
+        self._term_values = {}
+        # entry key -> (expires_at, scope, signature, band keys, value)
+        self._entries = OrderedDict()
+        # (scope, band, band values) -> keys of the entries in that bucket, oldest first
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self.counters = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+
+    def _values(self, term):
+        # The term's value under every permutation; the signature is the element-wise minimum over its terms
+        values = self._term_values.get(term)
+        if values is None:
+            value = (hash(term) & 0xFFFFFFFFFFFFFFFF) % _PRIME
+            values = tuple([(a * value + b) % _PRIME for a, b in self._permutations])
+            if len(self._term_values) >= self.config.TERM_CACHE_SIZE:
+                self._term_values.clear()
+            self._term_values[term] = values
+        return values
+
+    def signature(self, words):
+        """The Signature of a prompt's terms, or None if it has none."""
+        unique = set(words)
+        if len(unique) > self.config.MAX_TERMS:
+            # A consistent sample: near-duplicate long prompts keep mostly the same terms
+            unique = set(heapq.nsmallest(self.config.MAX_TERMS, unique, key=hash))
+        if not unique:
+            return None
+        minhash = tuple(map(min, zip(*[self._values(term) for term in unique])))
+        return Signature(frozenset(unique), minhash)
+
+    def _prepare(self, prompt, language, model):
+        words, numbers = terms(prompt)
+        # Only prompts that agree on all of the scope can share an answer
+        return self.signature(words), (normalize_language(language), model, tuple(numbers))
+
+    def _band_keys(self, scope, signature):
+        rows = self.config.ROWS
+        return [
+            (scope, band, signature.minhash[band * rows:(band + 1) * rows])
+            for band in range(self.config.BANDS)
+        ]
+
+    def get(self, prompt, language, model):
+        """(value, similarity) of the most similar indexed answer at or above THRESHOLD, or None."""
+        signature, scope = self._prepare(prompt, language, model)
+        if signature is None:
+            with self._lock:
+                self.counters["misses"] += 1
+            return None
+        now = time.time()
+        best = best_score = None
+        with self._lock:
+            candidates = set()
+            for band_key in self._band_keys(scope, signature):
+                candidates.update(self._buckets.get(band_key, ()))
+            for key in candidates:
+                expires_at, _, stored, _, value = self._entries[key]
+                if expires_at <= now:
+                    continue
+                score = signature.similarity(stored)
+                if score >= self.config.THRESHOLD and (best_score is None or score > best_score):
+                    best, best_score = key, score
+            if best is None:
+                self.counters["misses"] += 1
+                return None
+            self._entries.move_to_end(best)
+            self.counters["hits"] += 1
+            return self._entries[best][4], best_score
+
+    def set(self, key, prompt, language, model, value):
+        """Index an answer under its exact cache key, replacing any earlier answer for that key."""
+        if self.config.MAX_ENTRIES <= 0:
+            return
+        signature, scope = self._prepare(prompt, language, model)
+        if signature is None:
+            return
+        band_keys = self._band_keys(scope, signature)
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = (time.time() + self.config.TTL, scope, signature, band_keys, value)
+            for band_key in band_keys:
+                bucket = self._buckets.setdefault(band_key, {})
+                bucket[key] = None
+                if len(bucket) > self.config.BUCKET_SIZE:
+                    # The entry stays reachable through its other bands
+                    del bucket[next(iter(bucket))]
+            self.counters["stores"] += 1
+            while len(self._entries) > self.config.MAX_ENTRIES:
+                self._remove(next(iter(self._entries)))
+                self.counters["evictions"] += 1
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        for band_key in entry[3]:
+            bucket = self._buckets.get(band_key)
+            if bucket is not None:
+                bucket.pop(key, None)
+                if not bucket:
+                    del self._buckets[band_key]
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+            stats["entries"] = len(self._entries)
+            stats["buckets"] = len(self._buckets)
+        stats["max_entries"] = self.config.MAX_ENTRIES
+        stats["threshold"] = self.config.THRESHOLD
+        return stats
+
+
+def wants_similar(data, task):
+    if task != "code" or SimilarConfig.MAX_ENTRIES <= 0:
+        return False
+    return bool(data.get('similar', SimilarConfig.AUTO))
+
+
+similar_cache = SimilarCache()
+
+metrics.register_collector(
+    "similar_cache_events_total", "counter", "Near-duplicate cache lookups, writes and evictions by outcome",
+    lambda: [({"event": event}, count) for event, count in similar_cache.stats().items()
+             if event in similar_cache.counters]
+)
+metrics.register_collector(
+    "similar_cache_entries", "gauge", "Answers held in the near-duplicate index",
+    lambda: [({}, similar_cache.stats()["entries"])]
+)
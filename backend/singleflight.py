@@ -0,0 +1,139 @@
+import asyncio
+import os
+import threading
+
+import deadline
+from deadline import DeadlineExceeded
+
+# Coalesce identical concurrent /chat and /code-generate requests unless they opt out
+COALESCE_ENABLED = os.getenv("COALESCE_ENABLED", "true").strip().lower() in ("1", "true", "yes", "on")
+
+
+class InvalidFlag(ValueError):
+    status_code = 400
+
+
+def parse_coalesce(data):
+    """Whether the request may share an identical in-flight call; "coalesce" must be true or false if sent.
+
+    Raises InvalidFlag for anything else, since a string such as "false" would otherwise read as true.
+    """
+    value = data.get('coalesce')
+    if value is None:
+        return COALESCE_ENABLED
+    if not isinstance(value, bool):
+        raise InvalidFlag("coalesce must be true or false")
+    return value
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Share one in-flight call between concurrent callers with the same key.
+
+    The entry is dropped as soon as the call finishes, so an error reaches the
+    callers that were waiting on it but never a later request. The exception is
+    the leader running out of its own deadline: a waiter with a later deadline
+    then makes the call itself, under its own.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.counters = {"leaders": 0, "deduplicated": 0}
+
+    def do(self, key, fn):
+        """Return (result, shared), where shared is True if another caller made the call."""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self.counters["leaders"] += 1
+            else:
+                self.counters["deduplicated"] += 1
+
+        if not leader:
+            if not call.done.wait(deadline.remaining()):
+                raise DeadlineExceeded()
+            if isinstance(call.error, DeadlineExceeded):
+                return fn(), False
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = fn()
+            return call.result, False
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters, in_flight=len(self._calls))
+
+
+class _Flight:
+    def __init__(self, task):
+        self.task = task
+        self.waiters = 0
+
+
+class AsyncSingleFlight:
+    """Event-loop counterpart of SingleFlight; use one instance per loop.
+
+    The shared call runs as its own task, so one waiter being cancelled does
+    not cancel it for the others; once the last waiter has gone, it is cancelled.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self.counters = {"leaders": 0, "deduplicated": 0, "abandoned": 0}
+
+    async def do(self, key, coro_fn):
+        flight = self._calls.get(key)
+        if flight is not None:
+            self.counters["deduplicated"] += 1
+            try:
+                return await self._wait(key, flight), True
+            except DeadlineExceeded:
+                # The leader's deadline, not ours: our own runs out as a cancellation instead
+                return await coro_fn(), False
+
+        self.counters["leaders"] += 1
+        flight = self._calls[key] = _Flight(asyncio.ensure_future(coro_fn()))
+        flight.task.add_done_callback(lambda done: self._forget(key, flight))
+        return await self._wait(key, flight), False
+
+    async def _wait(self, key, flight):
+        flight.waiters += 1
+        try:
+            return await asyncio.shield(flight.task)
+        finally:
+            flight.waiters -= 1
+            if flight.waiters == 0 and not flight.task.done():
+                # Every caller has given up, e.g. at its deadline: stop the upstream calls and free their slots
+                self.counters["abandoned"] += 1
+                flight.task.cancel()
+                # A new caller must start a fresh call rather than join the cancelled one
+                self._forget(key, flight)
+
+    def _forget(self, key, flight):
+        if self._calls.get(key) is flight:
+            del self._calls[key]
+        # Mark the error as retrieved in case every waiter has gone away
+        if flight.task.done() and not flight.task.cancelled():
+            flight.task.exception()
+
+    def stats(self):
+        return dict(self.counters, in_flight=len(self._calls))
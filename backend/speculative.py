@@ -0,0 +1,118 @@
+import asyncio
+import logging
+import os
+
+import providers
+from admission import admission
+from validation import check, normalize_language, validator_for
+
+logger = logging.getLogger(__name__)
+
+
+def _parse_temperatures(value):
+    return [float(part) for part in value.split(",") if part.strip()]
+
+
+class SpeculativeConfig:
+    # Most candidates one /code-generate request may ask for
+    MAX_CANDIDATES = int(os.getenv("SPECULATIVE_MAX_CANDIDATES", "4"))
+    # Temperatures of the candidates beyond one per provider, used in turn
+    TEMPERATURES = _parse_temperatures(os.getenv("SPECULATIVE_TEMPERATURES", "0.7,0.3,1.0"))
+
+
+def wants_candidates(data, task):
+    """How many candidates a request asks for with "candidates"; 1 means a plain request."""
+    if task != "code":
+        return 1
+    try:
+        count = int(data.get('candidates', 1))
+    except (TypeError, ValueError):
+        return 1
+    return max(1, min(count, SpeculativeConfig.MAX_CANDIDATES))
+
+
+def candidate_plan(chain, count):
+    """(provider, model, temperature) of each candidate.
+
+    The first round asks every provider in the chain at its usual settings; later
+    rounds go around the chain again at other temperatures, so a single-model
+    chain still yields different candidates.
+    """
+    temperatures = SpeculativeConfig.TEMPERATURES or [None]
+    plan = []
+    for index in range(count):
+        provider, model = chain[index % len(chain)]
+        round_ = index // len(chain)
+        plan.append((provider, model, None if round_ == 0 else temperatures[(round_ - 1) % len(temperatures)]))
+    return plan
+
+
+async def _limited(limits, provider, model, messages, temperature, wait):
+    async with providers.concurrency_limit(limits, provider), admission.aslot(provider, wait=wait):
+        return await providers.acomplete(provider, model, "code", messages, temperature=temperature)
+
+
+def _describe(index, candidate, error=None):
+    provider, model, temperature = candidate
+    entry = {"index": index, "provider": provider, "model": model, "temperature": temperature}
+    if error is not None:
+        entry["error"] = error
+    return entry
+
+
+async def aspeculative_chain(chain, count, messages, language, limits=None):
+    """Ask for `count` code candidates at once and return the first whose code is valid.
+
+    Each candidate is checked with the validator for `language` as it arrives;
+    the first valid one wins and the rest are cancelled. Without a validator the
+    first candidate back wins. If every candidate is invalid, the first one back
+    is returned, marked as such. Returns None if the chain is empty.
+    """
+    if not chain:
+        return None
+    plan = candidate_plan(chain, count)
+    validated = validator_for(language) is not None
+    # As in a plain chain, only one call queues for a slot; a saturated provider fails the others fast
+    running = {
+        asyncio.ensure_future(_limited(limits, provider, model, messages, temperature, wait=index == 0)): index
+        for index, (provider, model, temperature) in enumerate(plan)
+    }
+    rejected = []
+    fallback = None
+    last_error = None
+
+    def report(completion, index, valid):
+        completion.meta["candidates"] = {
+            "requested": count,
+            "winner": _describe(index, plan[index]),
+            "language": normalize_language(language) if validated else None,
+            "valid": valid,
+            "rejected": [entry for entry in rejected if entry["index"] != index],
+        }
+        return completion
+
+    try:
+        while running:
+            done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+            for attempt in done:
+                index = running.pop(attempt)
+                provider = plan[index][0]
+                try:
+                    completion = attempt.result()
+                except Exception as e:
+                    logger.warning("%s API error: %s", providers.PROVIDER_NAMES[provider], e, extra={"provider": provider})
+                    rejected.append(_describe(index, plan[index], str(e) or type(e).__name__))
+                    last_error = e
+                    continue
+                error = check(completion, language, providers.strip_code_fences(completion.text))
+                if error is None:
+                    return report(completion, index, True if validated else None)
+                rejected.append(_describe(index, plan[index], error))
+                if fallback is None:
+                    fallback = (completion, index)
+        if fallback is not None:
+            return report(fallback[0], fallback[1], False)
+        raise last_error
+    finally:
+        for attempt in running:
+            attempt.cancel()
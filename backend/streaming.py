@@ -0,0 +1,86 @@
+import json
+import math
+
+from providers import strip_code_fences
+
+# Headers that stop proxies from buffering an event stream
+SSE_HEADERS = {
+    "Cache-Control": "no-cache",
+    "X-Accel-Buffering": "no",
+}
+
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def error_event(error, error_body):
+    """The error event ending a failed stream: the non-streaming body plus its status and any retry_after."""
+    body, status_code = error_body(error)
+    body = dict(body, status=status_code)
+    retry_after = getattr(error, "retry_after", None)
+    if retry_after is not None:
+        body["retry_after"] = math.ceil(retry_after)
+    return sse_event("error", body)
+
+
+class StreamCleaner:
+    """Incremental version of the trimming done on a finished completion.
+
+    Leading and trailing whitespace is dropped like str.strip(). With
+    strip_fences, an opening ```lang line, the last ``` and anything after it
+    are removed as the text streams, matching strip_code_fences(). Only the text
+    that might still turn out to be the closing fence, what follows it, or
+    trailing whitespace is held back.
+    """
+
+    def __init__(self, strip_fences=False):
+        self.strip_fences = strip_fences
+        self._started = False
+        self._fenced = False
+        self._pending = ""
+
+    def feed(self, text):
+        self._pending += text
+        if not self._started:
+            head = self._pending.lstrip()
+            if not head:
+                return ""
+            if self.strip_fences and "```".startswith(head[:3]):
+                if len(head) < 3:
+                    return ""
+                # Wait for the whole opening line so a language tag can be dropped
+                newline = head.find("\n")
+                if newline < 0:
+                    return ""
+                # and for the code itself, since a fence line with nothing after it is no fence at all
+                body = head[newline + 1:].lstrip()
+                if not body:
+                    return ""
+                self._fenced = True
+                head = body
+            self._started = True
+            self._pending = head
+
+        if self._fenced:
+            # A fence with another after it is inside the code; the last one may be the closing fence
+            fence = self._pending.rfind("```")
+            if fence >= 0:
+                keep_from = len(self._pending[:fence].rstrip())
+            else:
+                keep_from = len(self._pending.rstrip(" \t\r\n`"))
+        else:
+            keep_from = len(self._pending.rstrip())
+        out, self._pending = self._pending[:keep_from], self._pending[keep_from:]
+        return out
+
+    def finish(self):
+        tail, self._pending = self._pending, ""
+        if not self._started:
+            # The whole response was a single line, so the batch logic applies as is
+            return strip_code_fences(tail) if self.strip_fences else tail.strip()
+        if self._fenced:
+            fence = tail.rfind("```")
+            if fence >= 0:
+                tail = tail[:fence]
+        return tail.rstrip()
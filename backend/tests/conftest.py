@@ -0,0 +1,36 @@
+import os
+import sys
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [BACKEND_DIR, os.path.join(BACKEND_DIR, "benchmarks")]
+
+import pytest  # noqa: E402
+
+from mock_providers import PROVIDERS, MockProfile, MockProviders  # noqa: E402
+
+# The backend reads its settings at import time, so the mocks have to be up before any test imports it
+_mocks = MockProviders({provider: MockProfile(median=0, token_interval=0) for provider in PROVIDERS}).start()
+os.environ.update(_mocks.environ())
+os.environ.update({
+    # Keys only reach the mocks, never a real provider
+    "ANTHROPIC_API_KEY": "test",
+    "OPENAI_API_KEY": "test",
+    "DEEPSEEK_API_KEY": "test",
+    "RATE_LIMIT_ENABLED": "false",
+    "SHARED_STORE_PATH": "",
+    "MODEL_CATALOG_REFRESH_INTERVAL": "0",
+    "LOG_LEVEL": "CRITICAL",
+})
+
+
+@pytest.fixture
+def mocks():
+    """The running mock providers; a test may change their profiles, which are reset afterwards."""
+    saved = {provider: vars(profile).copy() for provider, profile in _mocks.profiles.items()}
+    yield _mocks
+    for provider, settings in saved.items():
+        vars(_mocks.profiles[provider]).update(settings)
+
+
+def pytest_unconfigure(config):
+    _mocks.stop()
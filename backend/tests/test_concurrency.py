@@ -0,0 +1,528 @@
+"""Admission, single-flight, circuit breakers, streaming, retries and rate limiting.
+
+Tests that make provider calls run them against benchmarks/mock_providers.py,
+started by conftest.py.
+"""
+import asyncio
+import threading
+import time
+
+import httpx
+import pytest
+
+import deadline
+from admission import ProviderLimiter, Saturated, error_headers
+from clients import PROVIDER_BASE_URLS, aclose_async_clients
+from deadline import DeadlineExceeded
+from health import CLOSED, HALF_OPEN, OPEN, BreakerConfig, CircuitBreaker, CircuitOpenError, breakers, is_timeout
+from mock_providers import REPLY
+from providers import Completion, astream, default_model, stream, strip_code_fences
+from retries import ProviderError, RetryBudget, RetryConfig, RetryPolicy, from_response, retry_after
+from security.config import SecurityConfig
+from security.rate_limit import MemoryBackend, RateLimiter, SQLiteBackend, client_identity
+from singleflight import AsyncSingleFlight, InvalidFlag, SingleFlight, parse_coalesce
+from streaming import StreamCleaner
+
+
+def _in_thread(fn):
+    """Start fn on a thread; the returned list gets its result or exception."""
+    outcome = []
+
+    def run():
+        try:
+            outcome.append(fn())
+        except Exception as e:
+            outcome.append(e)
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    return thread, outcome
+
+
+# Admission
+
+def test_released_slot_goes_to_the_oldest_waiter():
+    limiter = ProviderLimiter("openai", limit=1, queue_size=2, max_wait=5)
+    limiter.acquire()
+    order = []
+    threads = []
+    for n in range(2):
+        thread, _ = _in_thread(lambda n=n: (limiter.acquire(), order.append(n)))
+        threads.append(thread)
+        # Each waiter has to be queued before the next one
+        while limiter.queued() <= n:
+            time.sleep(0.001)
+    limiter.release()
+    threads[0].join(1)
+    limiter.release()
+    threads[1].join(1)
+    assert order == [0, 1]
+    assert limiter.in_use == 1
+    limiter.release()
+    assert limiter.snapshot()["in_use"] == 0
+
+
+def test_full_queue_is_rejected_at_once():
+    limiter = ProviderLimiter("openai", limit=1, queue_size=0, max_wait=5)
+    limiter.acquire()
+    started = time.monotonic()
+    with pytest.raises(Saturated) as rejected:
+        limiter.acquire()
+    assert time.monotonic() - started < 1
+    assert rejected.value.reason == "queue_full"
+    assert rejected.value.status_code == 503
+    assert error_headers(rejected.value) == {"Retry-After": "5"}
+
+
+def test_wait_without_a_free_slot_times_out():
+    limiter = ProviderLimiter("openai", limit=1, queue_size=1, max_wait=0.05)
+    limiter.acquire()
+    with pytest.raises(Saturated) as rejected:
+        limiter.acquire()
+    assert rejected.value.reason == "timeout"
+    assert limiter.queued() == 0
+    with pytest.raises(Saturated) as spilled:
+        limiter.acquire(wait=False)
+    assert spilled.value.reason == "spilled"
+
+
+def test_wait_cut_short_by_the_deadline_is_not_saturation():
+    limiter = ProviderLimiter("openai", limit=1, queue_size=1, max_wait=5)
+    limiter.acquire()
+    with deadline.scope(time.monotonic() + 0.05):
+        with pytest.raises(DeadlineExceeded):
+            limiter.acquire()
+
+
+def test_cancelled_async_waiter_does_not_leak_its_slot():
+    limiter = ProviderLimiter("openai", limit=1, queue_size=1, max_wait=5)
+
+    async def main():
+        limiter.acquire()
+        waiter = asyncio.ensure_future(limiter.aacquire())
+        while not limiter.queued():
+            await asyncio.sleep(0.001)
+        # The slot is handed to the waiter just as it is cancelled
+        limiter.release()
+        waiter.cancel()
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            pass
+        else:
+            # Cancelled too late: the waiter holds the slot and gives it back as usual
+            limiter.release()
+
+    asyncio.run(main())
+    assert limiter.snapshot()["in_use"] == 0
+    assert limiter.queued() == 0
+
+
+def test_async_waiter_cancelled_while_queued_leaves_the_queue():
+    limiter = ProviderLimiter("openai", limit=1, queue_size=1, max_wait=5)
+
+    async def main():
+        limiter.acquire()
+        waiter = asyncio.ensure_future(limiter.aacquire())
+        while not limiter.queued():
+            await asyncio.sleep(0.001)
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+
+    asyncio.run(main())
+    assert limiter.queued() == 0
+    limiter.release()
+    assert limiter.snapshot()["in_use"] == 0
+
+
+# Single-flight
+
+def test_concurrent_callers_share_one_call():
+    flight = SingleFlight()
+    calls = []
+    release = threading.Event()
+
+    def call():
+        calls.append(1)
+        release.wait(5)
+        return "result"
+
+    leader, leader_outcome = _in_thread(lambda: flight.do("key", call))
+    while not calls:
+        time.sleep(0.001)
+    followers = [_in_thread(lambda: flight.do("key", call)) for _ in range(3)]
+    while flight.counters["deduplicated"] < 3:
+        time.sleep(0.001)
+    release.set()
+    for thread, _ in [(leader, leader_outcome)] + followers:
+        thread.join(5)
+    assert len(calls) == 1
+    assert leader_outcome == [("result", False)]
+    assert [outcome for _, outcome in followers] == [[("result", True)]] * 3
+
+
+def test_error_reaches_waiters_but_not_later_callers():
+    flight = SingleFlight()
+    release = threading.Event()
+
+    def failing():
+        release.wait(5)
+        raise ValueError("boom")
+
+    leader, leader_outcome = _in_thread(lambda: flight.do("key", failing))
+    while not flight.counters["leaders"]:
+        time.sleep(0.001)
+    follower, follower_outcome = _in_thread(lambda: flight.do("key", lambda: "unused"))
+    while not flight.counters["deduplicated"]:
+        time.sleep(0.001)
+    release.set()
+    leader.join(5)
+    follower.join(5)
+    assert isinstance(leader_outcome[0], ValueError)
+    assert isinstance(follower_outcome[0], ValueError)
+    assert flight.do("key", lambda: "fresh") == ("fresh", False)
+
+
+def test_waiter_redispatches_when_the_leader_runs_out_of_time():
+    flight = SingleFlight()
+    started = threading.Event()
+
+    def late():
+        started.set()
+        time.sleep(0.1)
+        raise DeadlineExceeded()
+
+    leader, _ = _in_thread(lambda: flight.do("key", late))
+    started.wait(5)
+    assert flight.do("key", lambda: "own") == ("own", False)
+    leader.join(5)
+
+
+def test_async_waiter_cancellation_leaves_the_shared_call_running():
+    async def main():
+        flight = AsyncSingleFlight()
+        release = asyncio.Event()
+        calls = []
+
+        async def call():
+            calls.append(1)
+            await release.wait()
+            return "result"
+
+        leader = asyncio.ensure_future(flight.do("key", call))
+        follower = asyncio.ensure_future(flight.do("key", call))
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        await asyncio.sleep(0.01)
+        release.set()
+        assert await follower == ("result", True)
+        assert leader.cancelled()
+        assert len(calls) == 1
+        assert flight.counters["abandoned"] == 0
+
+    asyncio.run(main())
+
+
+def test_async_shared_call_is_cancelled_once_every_waiter_has_gone():
+    async def main():
+        flight = AsyncSingleFlight()
+        cancelled = asyncio.Event()
+
+        async def call():
+            try:
+                await asyncio.sleep(5)
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+
+        waiters = [asyncio.ensure_future(flight.do("key", call)) for _ in range(2)]
+        await asyncio.sleep(0.01)
+        for waiter in waiters:
+            waiter.cancel()
+        await asyncio.gather(*waiters, return_exceptions=True)
+        await asyncio.wait_for(cancelled.wait(), 1)
+        assert flight.counters["abandoned"] == 1
+        # The next request starts a call of its own
+        assert await flight.do("key", lambda: asyncio.sleep(0, "fresh")) == ("fresh", False)
+
+    asyncio.run(main())
+
+
+def test_coalesce_flag_must_be_a_boolean():
+    assert parse_coalesce({"coalesce": False}) is False
+    assert parse_coalesce({"coalesce": True}) is True
+    for value in ("false", 0, 1, [], {}):
+        with pytest.raises(InvalidFlag):
+            parse_coalesce({"coalesce": value})
+
+
+# Circuit breakers
+
+class FastBreakerConfig(BreakerConfig):
+    MIN_CALLS = 2
+    ERROR_RATE = 0.5
+    OPEN_SECONDS = 0.05
+    HALF_OPEN_PROBES = 1
+
+
+def _open_breaker():
+    breaker = CircuitBreaker("test", FastBreakerConfig)
+    for _ in range(2):
+        breaker.release(breaker.acquire(), "error")
+    assert breaker.state == OPEN
+    return breaker
+
+
+def test_breaker_opens_on_errors_and_probes_once_half_open():
+    breaker = _open_breaker()
+    with pytest.raises(CircuitOpenError):
+        breaker.acquire()
+    assert not breaker.available()
+    time.sleep(FastBreakerConfig.OPEN_SECONDS)
+    assert breaker.acquire() is True
+    assert breaker.state == HALF_OPEN
+    with pytest.raises(CircuitOpenError):
+        breaker.acquire()
+    breaker.release(True, "success")
+    assert breaker.state == CLOSED
+    assert breaker.snapshot()["calls"] == 0
+
+
+def test_failed_probe_reopens_the_breaker():
+    breaker = _open_breaker()
+    time.sleep(FastBreakerConfig.OPEN_SECONDS)
+    breaker.release(breaker.acquire(), "timeout")
+    assert breaker.state == OPEN
+    assert breaker.snapshot()["retry_in"] > 0
+
+
+def test_cancelled_calls_do_not_count():
+    breaker = CircuitBreaker("test", FastBreakerConfig)
+    for _ in range(5):
+        breaker.release(breaker.acquire(), None)
+    assert breaker.state == CLOSED
+    assert breaker.snapshot()["calls"] == 0
+    # A cancelled probe still gives its place back
+    breaker = _open_breaker()
+    time.sleep(FastBreakerConfig.OPEN_SECONDS)
+    breaker.release(breaker.acquire(), None)
+    assert breaker.acquire() is True
+
+
+def test_forced_state_overrides_the_calls():
+    breaker = CircuitBreaker("test", FastBreakerConfig)
+    breaker.force(OPEN)
+    with pytest.raises(CircuitOpenError):
+        breaker.acquire()
+    breaker.force(None)
+    assert breaker.acquire() is False
+    assert breaker.snapshot()["state"] == CLOSED
+
+
+def test_is_timeout():
+    assert is_timeout(httpx.ReadTimeout("slow"))
+    assert is_timeout(ProviderError("slow", "openai", timeout=True))
+    assert not is_timeout(ProviderError("overloaded", "openai", 529))
+
+
+# Streaming
+
+@pytest.mark.parametrize("text", [
+    REPLY,
+    "```python\ndef f():\n    return '```'\n```\nThis function returns three backticks.",
+    "  plain answer  \n",
+    "```js\nconsole.log(1)",
+    "```one line```",
+    "``` \n```\n",
+    "",
+])
+def test_stream_cleaner_matches_the_batch_trimming(text):
+    for size in (1, 2, 5, len(text) or 1):
+        cleaner = StreamCleaner(strip_fences=True)
+        out = "".join(cleaner.feed(text[i:i + size]) for i in range(0, len(text), size)) + cleaner.finish()
+        assert out == strip_code_fences(text), size
+        cleaner = StreamCleaner()
+        out = "".join(cleaner.feed(text[i:i + size]) for i in range(0, len(text), size)) + cleaner.finish()
+        assert out == text.strip(), size
+
+
+@pytest.mark.parametrize("provider", ["anthropic", "openai", "deepseek"])
+def test_stream_from_the_mock_provider(mocks, provider):
+    model = default_model(provider)
+    completion = Completion("", provider, model)
+    deltas = list(stream(provider, model, "code", [{"role": "user", "content": "add"}], completion))
+    assert len(deltas) > 1
+    assert "".join(deltas) == completion.text == REPLY
+    assert completion.usage == {"input_tokens": 12, "output_tokens": 18}
+
+
+@pytest.mark.parametrize("provider", ["anthropic", "openai", "deepseek"])
+def test_async_stream_from_the_mock_provider(mocks, provider):
+    async def main():
+        model = default_model(provider)
+        completion = Completion("", provider, model)
+        try:
+            deltas = [delta async for delta in astream(provider, model, "chat", [{"role": "user", "content": "hi"}],
+                                                       completion)]
+        finally:
+            await aclose_async_clients()
+        return deltas, completion
+
+    deltas, completion = asyncio.run(main())
+    assert "".join(deltas) == completion.text == REPLY
+
+
+def test_rejected_stream_leaves_the_breaker_alone(mocks):
+    mocks.profiles["openai"].error_rate = 1.0
+    mocks.profiles["openai"].error_status = 400
+    model = default_model("openai")
+    calls = breakers["openai"].snapshot()["calls"]
+    with pytest.raises(Exception):
+        list(stream("openai", model, "chat", [{"role": "user", "content": "hi"}], Completion("", "openai", model)))
+    # A request the provider rejected says nothing about its health
+    assert breakers["openai"].snapshot()["calls"] == calls
+
+
+# Retries
+
+def test_retry_after_headers():
+    assert retry_after({"retry-after-ms": "1500"}) == 1.5
+    assert retry_after({"retry-after-ms": "-200"}) == 0.0
+    assert retry_after({"retry-after": "-3"}) == 0.0
+    assert retry_after({"retry-after": "2"}) == 2.0
+    assert retry_after({"retry-after": "Wed, 21 Oct 2015 07:28:00 GMT"}) == 0.0
+    assert retry_after({"x-ratelimit-reset-requests": "6m0s", "x-ratelimit-reset-tokens": "20ms"}, 429) == 0.02
+    assert retry_after({"x-ratelimit-reset-requests": "1s"}, 500) is None
+    assert retry_after(None) is None
+
+
+class FastRetryConfig(RetryConfig):
+    ENABLED = True
+    max_attempts = staticmethod(lambda provider: 3)
+    base_delay = staticmethod(lambda provider: 0.001)
+    max_delay = staticmethod(lambda provider: 0.01)
+    max_retry_after = staticmethod(lambda provider: 1)
+    budget_ratio = staticmethod(lambda provider: 0.2)
+    budget_min_per_second = staticmethod(lambda provider: 0)
+    budget_burst = staticmethod(lambda provider: 10)
+
+
+def test_backoff_gives_up_on_what_a_retry_cannot_fix():
+    policy = RetryPolicy(["openai"], FastRetryConfig)
+    assert policy.backoff("openai", ProviderError("bad request", "openai", 400), 1) is None
+    assert policy.backoff("openai", ProviderError("overloaded", "openai", 529), 3) is None
+    assert policy.backoff("openai", ProviderError("slow down", "openai", 429, retry_after=60), 1) is None
+    assert 0.5 <= policy.backoff("openai", ProviderError("slow down", "openai", 429, retry_after=0.5), 1) <= 0.55
+    with deadline.scope(time.monotonic() + 0.3):
+        assert policy.backoff("openai", ProviderError("slow down", "openai", 429, retry_after=0.5), 1) is None
+
+
+def test_retry_budget_caps_retries():
+    budget = RetryBudget(ratio=0, min_per_second=0, burst=2)
+    assert [budget.withdraw() for _ in range(3)] == [True, True, False]
+    budget = RetryBudget(ratio=0.5, min_per_second=0, burst=2)
+    budget.tokens = 0
+    budget.deposit()
+    budget.deposit()
+    assert budget.withdraw() and not budget.withdraw()
+
+
+def _post_to_mock(attempts):
+    def call():
+        attempts.append(1)
+        response = httpx.post(PROVIDER_BASE_URLS["openai"] + "/v1/chat/completions", json={"model": "gpt-4"})
+        if response.status_code != 200:
+            raise from_response("OpenAI", "openai", response)
+        return response.json()
+
+    return call
+
+
+def test_run_retries_a_failing_provider_up_to_max_attempts(mocks):
+    policy = RetryPolicy(["openai"], FastRetryConfig)
+    mocks.profiles["openai"].error_rate = 1.0
+    attempts = []
+    with pytest.raises(ProviderError) as failed:
+        policy.run("openai", _post_to_mock(attempts))
+    assert failed.value.status_code == 529
+    assert len(attempts) == 3
+
+    mocks.profiles["openai"].error_rate = 0.0
+    attempts = []
+    assert policy.run("openai", _post_to_mock(attempts))["object"] == "chat.completion"
+    assert len(attempts) == 1
+
+
+def test_arun_does_not_retry_a_rejected_request(mocks):
+    policy = RetryPolicy(["openai"], FastRetryConfig)
+    mocks.profiles["openai"].error_rate = 1.0
+    mocks.profiles["openai"].error_status = 401
+    attempts = []
+
+    async def call():
+        return _post_to_mock(attempts)()
+
+    with pytest.raises(ProviderError):
+        asyncio.run(policy.arun("openai", call))
+    assert len(attempts) == 1
+
+
+# Rate limiting
+
+@pytest.fixture(params=["memory", "sqlite"])
+def backend(request, tmp_path):
+    if request.param == "sqlite":
+        return SQLiteBackend(str(tmp_path / "rate_limits.db"))
+    return MemoryBackend()
+
+
+def test_take_charges_the_cost(backend):
+    now = time.monotonic()
+    assert backend.take(["a"], 10, 3600, now, cost=4) == (True, 6, 0)
+    assert backend.take(["a"], 10, 3600, now, cost=6)[:2] == (True, 0)
+    allowed, remaining, wait = backend.take(["a"], 10, 3600, now, cost=3)
+    assert not allowed
+    assert wait > 0
+
+
+def test_rejection_draws_from_no_bucket(backend):
+    now = time.monotonic()
+    backend.take(["key"], 2, 3600, now, cost=2)
+    assert not backend.take(["ip", "key"], 2, 3600, now)[0]
+    # The IP bucket was not charged for the rejected request
+    assert backend.take(["ip"], 2, 3600, now, cost=2)[0]
+
+
+class LimitedConfig(SecurityConfig):
+    RATE_LIMIT_ENABLED = True
+    RATE_LIMIT_ROUTES = {"/chat": (2, 3600), "/code-generate/batch": (5, 3600)}
+    RATE_LIMIT_ITEM_ROUTES = {"/code-generate/batch"}
+
+
+def test_limiter_charges_batches_per_item(backend):
+    limiter = RateLimiter(LimitedConfig, backend)
+    # An item route passes the middleware and is charged by its handler
+    assert limiter.check("POST", "/code-generate/batch", "1.2.3.4") == (True, {})
+    allowed, headers = limiter.check("POST", "/code-generate/batch", "1.2.3.4", cost=6)
+    assert not allowed
+    assert headers["X-RateLimit-Remaining"] == "0"
+    assert int(headers["Retry-After"]) > 0
+    assert limiter.check("POST", "/code-generate/batch", "1.2.3.4", cost=3)[1]["X-RateLimit-Remaining"] == "2"
+
+
+def test_limiter_tracks_each_ip_and_key(backend):
+    limiter = RateLimiter(LimitedConfig, backend)
+    for _ in range(2):
+        assert limiter.check("POST", "/chat", "1.2.3.4", "secret")[0]
+    assert not limiter.check("POST", "/chat", "1.2.3.4", "secret")[0]
+    # The key's bucket is empty wherever it comes from
+    assert not asyncio.run(limiter.acheck("POST", "/chat", "5.6.7.8", "secret"))[0]
+    assert asyncio.run(limiter.acheck("POST", "/chat", "5.6.7.8"))[0]
+    assert limiter.check("OPTIONS", "/chat", "1.2.3.4") == (True, {})
+
+
+def test_client_identity_reads_bearer_keys():
+    assert client_identity({"Authorization": "Bearer secret"}, "1.2.3.4") == ("1.2.3.4", "secret")
+    assert client_identity({"X-API-Key": "key", "Authorization": "Bearer other"}, "1.2.3.4") == ("1.2.3.4", "key")
+    assert client_identity({}, "1.2.3.4") == ("1.2.3.4", None)
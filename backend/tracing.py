@@ -0,0 +1,292 @@
+import asyncio
+import collections
+import contextlib
+import contextvars
+import itertools
+import json
+import logging
+import os
+import random
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def _env_bool(name, default):
+    return os.getenv(name, default).strip().lower() in ("1", "true", "yes", "on")
+
+
+class TracingConfig:
+    ENABLED = _env_bool("TRACING_ENABLED", "true")
+    # Comma-separated exporters finished traces are sent to: memory, file, log
+    EXPORTERS = [name.strip() for name in os.getenv("TRACING_EXPORTERS", "memory").split(",") if name.strip()]
+    # Fraction of traces exported; Server-Timing is sent for every request either way
+    SAMPLE_RATE = float(os.getenv("TRACING_SAMPLE_RATE", "1"))
+    # Most recent traces kept by the memory exporter and shown at /admin/traces
+    MEMORY_SIZE = int(os.getenv("TRACING_MEMORY_SIZE", "100"))
+    # JSON-lines file written by the file exporter
+    FILE = os.getenv("TRACING_FILE", "traces.jsonl")
+    SERVER_TIMING = _env_bool("TRACING_SERVER_TIMING", "true")
+    # Server-Timing entries per response, to keep the header small
+    SERVER_TIMING_MAX_ENTRIES = 32
+
+
+# Trace of the request being served and the span currently open in this thread or task
+_trace = contextvars.ContextVar("trace", default=None)
+_span = contextvars.ContextVar("span", default=None)
+
+
+class Span:
+    __slots__ = ("id", "parent_id", "name", "attributes", "start", "end", "status", "error")
+
+    def __init__(self, span_id, parent_id, name, attributes):
+        self.id = span_id
+        self.parent_id = parent_id
+        self.name = name
+        self.attributes = attributes
+        self.start = time.perf_counter()
+        self.end = None
+        self.status = "ok"
+        self.error = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def skip(self):
+        """Leave the span out of the trace, e.g. when there turned out to be nothing to time."""
+        self.status = "skipped"
+
+    def duration(self):
+        return (self.end or time.perf_counter()) - self.start
+
+    def to_dict(self, origin):
+        entry = {
+            "id": self.id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start_ms": round((self.start - origin) * 1000, 3),
+            "duration_ms": round(self.duration() * 1000, 3),
+            "status": self.status,
+        }
+        if self.error:
+            entry["error"] = self.error
+        entry.update(self.attributes)
+        return entry
+
+
+class _NoSpan:
+    """Stands in for a span when the request is not traced."""
+
+    def set(self, **attributes):
+        pass
+
+    def skip(self):
+        pass
+
+
+NO_SPAN = _NoSpan()
+
+
+class Trace:
+    """The spans recorded while serving one request.
+
+    Spans from every thread and task working on the request land here: the
+    trace travels in a context variable, which tasks and the background loop copy.
+    """
+
+    def __init__(self, trace_id, name):
+        self.trace_id = trace_id
+        self.name = name
+        self.started_at = time.time()
+        self.start = time.perf_counter()
+        self.end = None
+        self.spans = []
+        # A streamed response ends its trace itself, once the last event is sent
+        self.streaming = False
+        self._ids = itertools.count(1)
+
+    def new_span(self, parent, name, attributes):
+        return Span(next(self._ids), parent.id if parent is not None else None, name, attributes)
+
+    def duration(self):
+        return (self.end or time.perf_counter()) - self.start
+
+    def to_dict(self):
+        return {
+            "trace_id": self.trace_id,
+            "name": self.name,
+            "started_at": self.started_at,
+            "duration_ms": round(self.duration() * 1000, 3),
+            "spans": [span.to_dict(self.start) for span in sorted(self.spans, key=lambda span: span.start)],
+        }
+
+
+@contextlib.contextmanager
+def span(name, **attributes):
+    """Time the block as a span of the current trace; a no-op when the request is not traced."""
+    trace = _trace.get()
+    if trace is None:
+        yield NO_SPAN
+        return
+    parent = _span.get()
+    current = trace.new_span(parent, name, attributes)
+    _span.set(current)
+    try:
+        yield current
+    except (asyncio.CancelledError, GeneratorExit):
+        current.status = "cancelled"
+        raise
+    except BaseException as e:
+        current.status = "error"
+        current.error = f"{type(e).__name__}: {e}"[:200]
+        raise
+    finally:
+        current.end = time.perf_counter()
+        # set() rather than reset(): a streaming generator may close in another context
+        _span.set(parent)
+        if current.status != "skipped":
+            trace.spans.append(current)
+
+
+class MemoryExporter:
+    """Keeps the most recent traces in memory, for /admin/traces and tests."""
+
+    def __init__(self, size=TracingConfig.MEMORY_SIZE):
+        self.traces = collections.deque(maxlen=size)
+
+    def export(self, trace):
+        self.traces.append(trace)
+
+    def recent(self, limit=None):
+        traces = list(reversed(self.traces))
+        return traces[:limit] if limit else traces
+
+    def find(self, trace_id):
+        return next((trace for trace in reversed(self.traces) if trace["trace_id"] == trace_id), None)
+
+
+class FileExporter:
+    """Appends each trace to a JSON-lines file."""
+
+    def __init__(self, path=TracingConfig.FILE):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def export(self, trace):
+        line = json.dumps(trace, default=str) + "\n"
+        with self._lock, open(self.path, "a") as f:
+            f.write(line)
+
+
+class LogExporter:
+    """Logs each trace as one record, so it goes out through the non-blocking log pipeline."""
+
+    def export(self, trace):
+        logger.info("Trace %s: %s %.1fms", trace["trace_id"], trace["name"], trace["duration_ms"], extra={"trace": trace})
+
+
+EXPORTERS = {
+    "memory": MemoryExporter,
+    "file": FileExporter,
+    "log": LogExporter,
+}
+
+
+class Tracer:
+    """Starts and ends request traces and hands finished ones to the exporters."""
+
+    def __init__(self, config=TracingConfig):
+        self.config = config
+        self.enabled = config.ENABLED
+        self.exporters = []
+        for name in config.EXPORTERS:
+            if name not in EXPORTERS:
+                logger.warning("Unknown trace exporter %s, expected one of: %s", name, ", ".join(EXPORTERS))
+                continue
+            self.exporters.append(EXPORTERS[name]())
+
+    def add_exporter(self, exporter):
+        """Send finished traces to exporter.export(trace_dict) as well."""
+        self.exporters.append(exporter)
+
+    def exporter(self, kind):
+        return next((exporter for exporter in self.exporters if isinstance(exporter, kind)), None)
+
+    def begin(self, trace_id, name):
+        """Start the current request's trace; None when tracing is off."""
+        if not self.enabled:
+            return None
+        trace = Trace(trace_id, name)
+        _trace.set(trace)
+        _span.set(None)
+        return trace
+
+    def end(self, trace):
+        """Finish a trace and export it, if it recorded any spans and is sampled."""
+        if trace is None or trace.end is not None:
+            return
+        trace.end = time.perf_counter()
+        if not trace.spans or not self.exporters or random.random() >= self.config.SAMPLE_RATE:
+            return
+        data = trace.to_dict()
+        for exporter in self.exporters:
+            try:
+                exporter.export(data)
+            except Exception as e:
+                logger.warning("Could not export trace %s: %s", trace.trace_id, e)
+
+    def streamed(self, trace, events):
+        """Wrap a streamed body so its trace ends after the last chunk rather than when the response starts."""
+        if trace is None:
+            return events
+        trace.streaming = True
+
+        def body():
+            try:
+                yield from events
+            finally:
+                self.end(trace)
+        return body()
+
+    def astreamed(self, trace, events):
+        """Async counterpart of streamed()."""
+        if trace is None:
+            return events
+        trace.streaming = True
+
+        async def body():
+            try:
+                async for chunk in events:
+                    yield chunk
+            finally:
+                self.end(trace)
+        return body()
+
+    def server_timing(self, trace):
+        """Server-Timing header value for the trace's spans so far, or None.
+
+        Only innermost spans are listed, such as anthropic.sdk, anthropic.direct or
+        openai.backoff, so the durations show where the request's time went.
+        """
+        if trace is None or not self.config.SERVER_TIMING or not trace.spans:
+            return None
+        spans = sorted(trace.spans, key=lambda span: span.start)
+        parents = {span.parent_id for span in spans}
+        entries = []
+        for span in spans:
+            if span.id in parents:
+                continue
+            provider = span.attributes.get("provider")
+            entry = f"{span.name if provider is None else f'{provider}.{span.name}'};dur={span.duration() * 1000:.1f}"
+            if span.status != "ok":
+                entry += f';desc="{span.status}"'
+            elif "hit" in span.attributes:
+                entry += ';desc="hit"' if span.attributes["hit"] else ';desc="miss"'
+            entries.append(entry)
+        entries = entries[:self.config.SERVER_TIMING_MAX_ENTRIES]
+        entries.append(f"total;dur={trace.duration() * 1000:.1f}")
+        return ", ".join(entries)
+
+
+tracer = Tracer()
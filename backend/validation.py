@@ -0,0 +1,118 @@
+import ast
+import json
+import os
+import threading
+
+from metrics import metrics
+
+
+class ValidationConfig:
+    # Checked completions of a model in a language before the router trusts its invalid rate
+    MIN_SAMPLES = int(os.getenv("VALIDATION_MIN_SAMPLES", "5"))
+    ALPHA = float(os.getenv("VALIDATION_EWMA_ALPHA", "0.2"))
+
+
+# Other names clients send for a validated language
+ALIASES = {
+    "py": "python",
+    "python3": "python",
+}
+
+
+def normalize_language(language):
+    language = " ".join(str(language or "").split()).lower()
+    return ALIASES.get(language, language)
+
+
+def _python(code):
+    try:
+        ast.parse(code)
+    except SyntaxError as e:
+        return f"line {e.lineno}: {e.msg}"
+    except (ValueError, RecursionError, MemoryError) as e:
+        # Null bytes, or nesting too deep for the parser
+        return str(e) or type(e).__name__
+    return None
+
+
+def _json(code):
+    try:
+        json.loads(code)
+    except ValueError as e:
+        return str(e)
+    return None
+
+
+# language -> validator(code), which returns None for valid code or a short description of the first error
+VALIDATORS = {
+    "python": _python,
+    "json": _json,
+}
+
+
+def register_validator(language, validator):
+    """Check generated code in `language` with validator(code) from now on."""
+    VALIDATORS[normalize_language(language)] = validator
+
+
+def validator_for(language):
+    return VALIDATORS.get(normalize_language(language))
+
+
+class ValidationTracker:
+    """How often each model's code passes the validator, per language.
+
+    Only models and languages with a validator are tracked; the router uses the
+    invalid rate to rank providers for code requests in that language.
+    """
+
+    def __init__(self, config=ValidationConfig):
+        self.config = config
+        # (model, language) -> [valid, invalid, ewma invalid rate]
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def record(self, provider, model, language, valid):
+        language = normalize_language(language)
+        with self._lock:
+            stats = self._stats.get((model, language))
+            if stats is None:
+                stats = self._stats[(model, language)] = [0, 0, 0.0]
+            stats[0 if valid else 1] += 1
+            stats[2] += self.config.ALPHA * ((0.0 if valid else 1.0) - stats[2])
+        metrics.inc("code_validations_total", {
+            "provider": provider, "model": model, "language": language, "outcome": "valid" if valid else "invalid",
+        })
+
+    def invalid_rate(self, model, language):
+        """The model's recent invalid rate for the language, or None until it has MIN_SAMPLES checks."""
+        stats = self._stats.get((model, normalize_language(language)))
+        if stats is None or stats[0] + stats[1] < self.config.MIN_SAMPLES:
+            return None
+        return stats[2]
+
+    def snapshot(self):
+        with self._lock:
+            return [
+                {"model": model, "language": language, "valid": valid, "invalid": invalid, "invalid_rate": round(rate, 4)}
+                for (model, language), (valid, invalid, rate) in sorted(self._stats.items())
+            ]
+
+
+validation_stats = ValidationTracker()
+
+
+def valid_code(language, code):
+    """Whether code passes the language's validator; True when there is none. Not recorded in the stats."""
+    validator = validator_for(language)
+    return validator is None or validator(code) is None
+
+
+def check(completion, language, code):
+    """Validate a completion's code and record the outcome; returns the error, or None if valid or unchecked."""
+    validator = validator_for(language)
+    if validator is None:
+        return None
+    error = validator(code)
+    validation_stats.record(completion.provider, completion.model, language, error is None)
+    return error
@@ -0,0 +1,190 @@
+import asyncio
+import concurrent.futures
+import contextlib
+import importlib
+import logging
+import os
+import threading
+import time
+
+import providers
+from clients import get_async_clients, get_clients, ssl_context
+
+logger = logging.getLogger(__name__)
+
+
+class WarmupConfig:
+    ENABLED = os.getenv("WARMUP_ENABLED", "true").strip().lower() in ("1", "true", "yes", "on")
+    # Keep-alive connections opened per configured provider before the worker reports ready
+    CONNECTIONS = int(os.getenv("WARMUP_CONNECTIONS", "2"))
+
+
+# Imported up front so the first request does not pay for them
+SDK_MODULES = ("anthropic", "openai", "deepseek")
+OPTIONAL_MODULES = ("deepseek",)
+
+PENDING = "pending"
+RUNNING = "running"
+READY = "ready"
+
+
+class Warmup:
+    """Startup phase that imports the SDKs, loads the CA bundle and opens provider connections.
+
+    Every phase is timed, so the report behind /ready shows where startup time goes.
+    A failed phase is recorded but does not hold readiness back.
+    """
+
+    def __init__(self, config=WarmupConfig):
+        self.config = config
+        self.state = PENDING if config.ENABLED else READY
+        self.phases = {}
+        self.errors = {}
+        self.started_at = None
+        self.finished_at = None
+        # Set by a pre-fork master: start() then waits until it is called again in each worker
+        self.deferred = False
+        self._lock = threading.Lock()
+
+    def record(self, name, seconds):
+        self.phases[name] = round(seconds, 4)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        except Exception as e:
+            self.errors[name] = str(e)
+        finally:
+            self.record(name, time.perf_counter() - started)
+
+    def ready(self):
+        return self.state == READY
+
+    def _begin(self):
+        with self._lock:
+            if self.state != PENDING:
+                return False
+            self.state = RUNNING
+        self.started_at = time.perf_counter()
+        return True
+
+    def _finish(self):
+        self.finished_at = time.perf_counter()
+        self.state = READY
+        slowest = sorted(self.phases.items(), key=lambda phase: phase[1], reverse=True)[:3]
+        logger.info("Warm-up finished in %.2fs (slowest: %s)", self.finished_at - self.started_at,
+                    ", ".join(f"{name} {seconds:.2f}s" for name, seconds in slowest))
+
+    def _prepare(self):
+        for module in SDK_MODULES:
+            with self.phase(f"import {module}"):
+                try:
+                    importlib.import_module(module)
+                except ImportError:
+                    if module not in OPTIONAL_MODULES:
+                        raise
+        with self.phase("load CA bundle"):
+            ssl_context()
+
+    def _configured(self):
+        return [provider for provider in providers.PROVIDER_MODELS if providers.api_key(provider)]
+
+    def _build_sdk_clients(self, clients, configured):
+        with self.phase("build SDK clients"):
+            for provider in configured:
+                if provider == "deepseek" and not hasattr(clients, "deepseek"):
+                    # There is no async DeepSeek SDK
+                    continue
+                getattr(clients, provider)(providers.api_key(provider))
+
+    @staticmethod
+    def _open_connection(client):
+        # Any response, even a 404, leaves a connected keep-alive socket in the pool
+        started = time.perf_counter()
+        client.head("/")
+        return time.perf_counter() - started
+
+    def run(self):
+        """Warm this worker's sync clients; used by the Flask app."""
+        if not self._begin():
+            return
+        try:
+            self._prepare()
+            clients = get_clients()
+            configured = self._configured()
+            self._build_sdk_clients(clients, configured)
+            if configured and self.config.CONNECTIONS > 0:
+                workers = len(configured) * self.config.CONNECTIONS
+                with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+                    futures = {
+                        provider: [pool.submit(self._open_connection, clients.http(provider))
+                                   for _ in range(self.config.CONNECTIONS)]
+                        for provider in configured
+                    }
+                    for provider, pending in futures.items():
+                        self._record_connections(provider, [future.exception() or future.result() for future in pending])
+        finally:
+            self._finish()
+
+    def start(self):
+        """Run the sync warm-up on a background thread."""
+        if self.state == PENDING and not self.deferred:
+            threading.Thread(target=self.run, name="warmup", daemon=True).start()
+
+    def preload(self):
+        """Import the SDKs and load the CA bundle without opening connections.
+
+        Run in a pre-fork master, so workers share those pages copy-on-write
+        and only have to open their own connections.
+        """
+        self._prepare()
+
+    async def arun(self):
+        """Warm the running event loop's async clients; used by the ASGI app."""
+        if not self._begin():
+            return
+        try:
+            # Imports and CA loading block, so they run off the event loop
+            await asyncio.get_running_loop().run_in_executor(None, self._prepare)
+            clients = get_async_clients()
+            configured = self._configured()
+            self._build_sdk_clients(clients, configured)
+
+            async def open_connection(client):
+                started = time.perf_counter()
+                await client.head("/")
+                return time.perf_counter() - started
+
+            results = await asyncio.gather(*(
+                asyncio.gather(*(open_connection(clients.http(provider)) for _ in range(self.config.CONNECTIONS)),
+                               return_exceptions=True)
+                for provider in configured
+            ))
+            for provider, provider_results in zip(configured, results):
+                self._record_connections(provider, provider_results)
+        finally:
+            self._finish()
+
+    def _record_connections(self, provider, results):
+        timings = [result for result in results if not isinstance(result, BaseException)]
+        failures = [result for result in results if isinstance(result, BaseException)]
+        if timings:
+            self.record(f"connect {provider}", max(timings))
+        if failures:
+            self.errors[f"connect {provider}"] = str(failures[0]) or type(failures[0]).__name__
+
+    def report(self):
+        elapsed = None
+        if self.started_at is not None:
+            elapsed = round((self.finished_at or time.perf_counter()) - self.started_at, 4)
+        return {
+            "status": self.state,
+            "warmup_seconds": elapsed,
+            "phases": dict(self.phases),
+            "errors": dict(self.errors),
+        }
+
+
+warmup = Warmup()